@@ -0,0 +1,715 @@
+#!/usr/bin/python
+'''
+ '  Copyright 2015 Doug Campbell
+ '
+ '  This program is free software: you can redistribute it and/or modify
+ '  it under the terms of the GNU General Public License as published by
+ '  the Free Software Foundation, either version 3 of the License, or
+ '  (at your option) any later version.
+ '
+ '  This program is distributed in the hope that it will be useful,
+ '  but WITHOUT ANY WARRANTY; without even the implied warranty of
+ '  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ '  GNU General Public License for more details.
+ '
+ '  You should have received a copy of the GNU General Public License
+ '  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import BaseHTTPServer
+import datetime
+import getopt
+import imp
+import itertools
+import os
+import random
+import resource
+import shutil
+import simplejson
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+
+from email.parser import Parser
+from googleapiclient.discovery import build_from_document
+from oauth2client import GOOGLE_TOKEN_URI
+from urlparse import urlparse, parse_qs
+
+# load the uploader script as a module
+uploader = imp.load_source('mbox_uploader', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         'mbox-uploader-osx-tb.py'))
+
+"""
+ * parseCommandLine
+ *
+ * Parses the benchmark command line switches.
+ *
+ * Returns:
+ *     options dictionary
+ *
+"""
+def parseCommandLine():
+    # mbox-uploader-bench.py [--folders N] [--messages N] [--sizes SPEC] [--deleted P] [--unread P]
+    #                        [--latency MS] [--error-rate P] [--workers N] [--parallel-folders N]
+    #                        [--quota-rate N] [--chunk-size KB] [--resumable-threshold KB]
+    #                        [--memory-budget MB] [--rerun] [--seed N] [--keep] [--help]
+    options = {'folders': 10,
+               'messages': 500,
+               'sizes': '4k:60,40k:30,400k:9,4m:1',
+               'deleted': 0.05,
+               'unread': 0.2,
+               'latency': 20,
+               'error_rate': 0.0,
+               'workers': 1,
+               'parallel_folders': 1,
+               'quota_rate': 1000000,
+               'chunk_size': uploader.UPLOAD_CHUNK_SIZE / 1024,
+               'resumable_threshold': uploader.RESUMABLE_THRESHOLD / 1024,
+               'memory_budget': uploader.MEMORY_BUDGET / 1048576,
+               'rerun': False,
+               'seed': 1,
+               'keep': False}
+    opts, remainder = getopt.getopt(sys.argv[1:], "", ['help', 'folders=', 'messages=', 'sizes=', 'deleted=',
+                                                       'unread=', 'latency=', 'error-rate=', 'workers=',
+                                                       'parallel-folders=', 'quota-rate=', 'chunk-size=',
+                                                       'resumable-threshold=', 'memory-budget=', 'rerun', 'seed=',
+                                                       'keep'])
+    for opt, value in opts:
+        if opt == '--help':
+            print
+            print "Usage: mbox-uploader-bench.py [options]"
+            print
+            print "       --folders N          : number of mbox files in the synthetic profile (default 10)"
+            print "       --messages N         : messages per mbox file (default 500)"
+            print "       --sizes SPEC         : message size distribution as size:weight pairs"
+            print "                            : (default 4k:60,40k:30,400k:9,4m:1)"
+            print "       --deleted P          : fraction of messages marked deleted (default 0.05)"
+            print "       --unread P           : fraction of messages marked unread (default 0.2)"
+            print "       --latency MS         : fake server latency per request in ms (default 20)"
+            print "       --error-rate P       : fraction of imports answered with 429/503 (default 0)"
+            print "       --workers N          : upload workers, as for the uploader (default 1)"
+            print "       --parallel-folders N : folder processes, as for the uploader (default 1)"
+            print "       --quota-rate N       : quota units per second (default 1000000, Gmail allows 250)"
+            print "       --chunk-size KB      : resumable upload chunk size, as for the uploader (default {0})".format(
+                options['chunk_size'])
+            print "       --resumable-threshold KB : messages larger than this use resumable uploads"
+            print "                            : (default {0})".format(options['resumable_threshold'])
+            print "       --memory-budget MB   : memory for uploads in flight, as for the uploader (default {0})".format(
+                options['memory_budget'])
+            print "       --rerun              : also time a second run over the migrated profile with"
+            print "                            : the label cache cleared"
+            print "       --seed N             : random seed for the synthetic profile (default 1)"
+            print "       --keep               : keep the synthetic profile and database"
+            print
+            sys.exit()
+        name = opt[2:].replace('-', '_')
+        if name in ('folders', 'messages', 'latency', 'workers', 'parallel_folders', 'quota_rate', 'seed',
+                    'chunk_size', 'resumable_threshold', 'memory_budget'):
+            options[name] = int(value)
+        elif name in ('deleted', 'unread', 'error_rate'):
+            options[name] = float(value)
+        elif name == 'sizes':
+            options[name] = value
+        else:
+            options[name] = True
+    return options
+
+"""
+ * parseSizes
+ *
+ * Parse a message size distribution such as "4k:60,40k:30,4m:10".
+ *
+ * Args:
+ *     spec: comma separated size:weight pairs
+ *
+ * Returns:
+ *     list of (size in bytes, weight) tuples
+"""
+def parseSizes(spec):
+    sizes = []
+    for item in spec.split(','):
+        size, weight = item.split(':')
+        multiplier = {'k': 1024, 'm': 1048576}.get(size[-1].lower(), 1)
+        if multiplier > 1:
+            size = size[:-1]
+        sizes.append((int(float(size) * multiplier), float(weight)))
+    return sizes
+
+"""
+ * generateProfile
+ *
+ * Write a synthetic Thunderbird account folder of mbox files.  Every third
+ * folder is nested in an Archive.sbd hierarchy and every mbox file has a
+ * .msf file next to it, as Thunderbird leaves them.
+ *
+ * Args:
+ *     mailroot: account folder to create
+ *     options: options dictionary
+ *
+ * Returns:
+ *     number of messages written, number of bytes written
+"""
+def generateProfile(mailroot, options):
+    rand = random.Random(options['seed'])
+    sizes = parseSizes(options['sizes'])
+    total_weight = sum(weight for size, weight in sizes)
+    line = "The quick brown fox jumps over the lazy dog. 0123456789 abcdefghijklmnopqrstuvwxyz\n"
+
+    total_messages = 0
+    total_bytes = 0
+    os.makedirs(mailroot)
+    os.makedirs(os.path.join(mailroot, 'Archive.sbd'))
+    for folder in range(options['folders']):
+        if folder == 0:
+            path = os.path.join(mailroot, 'Inbox')
+        elif folder % 3 == 2:
+            path = os.path.join(mailroot, 'Archive.sbd', 'Folder {0}'.format(folder))
+        else:
+            path = os.path.join(mailroot, 'Folder {0}'.format(folder))
+
+        fh = open(path, 'wb')
+        for n in range(options['messages']):
+            # pick a message size
+            pick = rand.uniform(0, total_weight)
+            for size, weight in sizes:
+                pick -= weight
+                if pick <= 0:
+                    break
+
+            value = rand.random()
+            if value < options['deleted']:
+                status = '0009'
+            elif value < options['deleted'] + options['unread']:
+                status = '0000'
+            else:
+                status = '0001'
+
+            date = datetime.datetime(2015, 1, 1) + datetime.timedelta(minutes=folder * options['messages'] + n)
+            headers = ("From - {0}\n"
+                       "X-Mozilla-Status: {1}\n"
+                       "X-Mozilla-Status2: 00000000\n"
+                       "Message-ID: <{2}.{3}@bench.invalid>\n"
+                       "Date: {4}\n"
+                       "From: Sender {2} <sender{2}@bench.invalid>\n"
+                       "To: Receiver <receiver@bench.invalid>\n"
+                       "Subject: Benchmark message {3} in folder {2}\n"
+                       "MIME-Version: 1.0\n"
+                       "Content-Type: text/plain; charset=us-ascii\n"
+                       "\n").format(date.strftime('%a %b %d %H:%M:%S %Y'), status, folder, n,
+                                    date.strftime('%a, %d %b %Y %H:%M:%S +0000'))
+            body = line * max(1, (size - len(headers)) / len(line))
+            fh.write(headers)
+            fh.write(">From an escaped line\n")
+            fh.write(body)
+            fh.write("\n")
+            total_messages += 1
+            total_bytes += len(headers) + len(body) + 23
+        fh.close()
+        open(path + '.msf', 'wb').close()
+
+    return total_messages, total_bytes
+
+"""
+ * discoveryDocument
+ *
+ * Minimal Gmail API discovery document covering the methods the uploader
+ * uses, pointing at the fake server.
+ *
+ * Args:
+ *     root_url: root URL of the fake server
+ *
+ * Returns:
+ *     discovery document as a JSON string
+"""
+def discoveryDocument(root_url):
+    def method(name, path, http_method, params=(), request=None, response=None, media=False):
+        parameters = {'userId': {'type': 'string', 'required': True, 'location': 'path'}}
+        order = ['userId']
+        if '{id}' in path:
+            parameters['id'] = {'type': 'string', 'required': True, 'location': 'path'}
+            order.append('id')
+        for param, param_type in params:
+            parameters[param] = {'type': param_type, 'location': 'query'}
+        desc = {'id': 'gmail.users.' + name, 'path': '{userId}/' + path, 'httpMethod': http_method,
+                'parameters': parameters, 'parameterOrder': order}
+        if request:
+            desc['request'] = {'$ref': request}
+        if response:
+            desc['response'] = {'$ref': response}
+        if media:
+            desc['supportsMediaUpload'] = True
+            desc['mediaUpload'] = {'accept': ['message/rfc822'], 'maxSize': '35MB',
+                                   'protocols': {'simple': {'multipart': True,
+                                                            'path': '/upload/gmail/v1/users/{userId}/' + path},
+                                                 'resumable': {'multipart': True,
+                                                               'path': '/resumable/upload/gmail/v1/users/{userId}/' + path}}}
+        return desc
+
+    schema = lambda name: {'id': name, 'type': 'object', 'properties': {}}
+    document = {
+        'kind': 'discovery#restDescription', 'discoveryVersion': 'v1', 'id': 'gmail:v1', 'name': 'gmail',
+        'version': 'v1', 'revision': 'bench', 'protocol': 'rest', 'rootUrl': root_url,
+        'servicePath': 'gmail/v1/users/', 'batchPath': 'batch/gmail/v1', 'parameters': {},
+        'schemas': dict((name, schema(name)) for name in ('Message', 'Label', 'ListLabelsResponse', 'Profile',
+                                                          'ListHistoryResponse', 'ModifyMessageRequest',
+                                                          'BatchModifyMessagesRequest')),
+        'resources': {'users': {
+            'methods': {'getProfile': dict(method('getProfile', 'profile', 'GET', response='Profile'),
+                                           path='{userId}/profile')},
+            'resources': {
+                'messages': {'methods': {
+                    'import': method('messages.import', 'messages/import', 'POST',
+                                     [('internalDateSource', 'string'), ('neverMarkSpam', 'boolean'),
+                                      ('processForCalendar', 'boolean'), ('deleted', 'boolean')],
+                                     'Message', 'Message', media=True),
+                    'get': method('messages.get', 'messages/{id}', 'GET', [('format', 'string')],
+                                  response='Message'),
+                    'modify': method('messages.modify', 'messages/{id}/modify', 'POST',
+                                     request='ModifyMessageRequest', response='Message'),
+                    'batchModify': method('messages.batchModify', 'messages/batchModify', 'POST',
+                                          request='BatchModifyMessagesRequest')}},
+                'labels': {'methods': {
+                    'list': method('labels.list', 'labels', 'GET', response='ListLabelsResponse'),
+                    'create': method('labels.create', 'labels', 'POST', request='Label', response='Label')}},
+                'history': {'methods': {
+                    'list': method('history.list', 'history', 'GET',
+                                   [('startHistoryId', 'string'), ('pageToken', 'string')],
+                                   response='ListHistoryResponse')}}}}}}
+    return simplejson.dumps(document)
+
+"""
+ * FakeGmailServer class
+ *
+ * Local stand-in for the parts of the Gmail API the uploader uses: message
+ * import (simple, multipart and resumable), get, modify, batchModify,
+ * labels, profile, history and the batch endpoint.  Every request waits
+ * the configured latency, and imports fail with 429 or 503 at the
+ * configured error rate.
+ *
+"""
+class FakeGmailServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    def __init__(self, latency, error_rate, seed):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeGmailHandler)
+        self.latency = latency / 1000.0
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.messages = {}
+        self.labels = {}
+        self.sessions = {}
+        self.counts = {}
+        self.bytes_received = 0
+        self.history_id = 1
+        self.connections = set()
+
+    def count(self, name, nbytes=0):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.bytes_received += nbytes
+
+    def failImport(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def newMessage(self, label_ids):
+        with self.lock:
+            google_id = '{0:016x}'.format(next(self.ids))
+            self.messages[google_id] = set(label_ids)
+            self.history_id += 1
+        return {'id': google_id, 'labelIds': sorted(label_ids)}
+
+    def dispatch(self, method, url, headers, body):
+        # handle one API request; returns (status, headers, body)
+        parsed = urlparse(url)
+        path = parsed.path
+        query = parse_qs(parsed.query)
+
+        if path.endswith('/messages/import') or path.startswith('/upload-session/'):
+            return self.handleImport(method, path, query, headers, body)
+
+        parts = path.split('/users/me/', 1)
+        route = parts[1] if len(parts) > 1 else ''
+        if route == 'labels' and method == 'GET':
+            self.count('labels.list')
+            labels = [{'id': name, 'name': name, 'type': 'system'} for name in ('INBOX', 'SENT', 'DRAFTS', 'UNREAD')]
+            with self.lock:
+                labels += [{'id': label_id, 'name': name, 'type': 'user'} for name, label_id in self.labels.items()]
+            return self.json(200, {'labels': labels})
+        if route == 'labels' and method == 'POST':
+            self.count('labels.create')
+            name = simplejson.loads(body)['name']
+            with self.lock:
+                label_id = self.labels.setdefault(name, 'Label_{0}'.format(len(self.labels) + 1))
+            return self.json(200, {'id': label_id, 'name': name, 'type': 'user'})
+        if route == 'profile':
+            self.count('getProfile')
+            return self.json(200, {'emailAddress': 'bench@bench.invalid', 'historyId': str(self.history_id)})
+        if route == 'history':
+            self.count('history.list')
+            return self.json(200, {'historyId': str(self.history_id)})
+        if route == 'messages/batchModify':
+            self.count('batchModify')
+            request = simplejson.loads(body)
+            with self.lock:
+                for google_id in request['ids']:
+                    if google_id in self.messages:
+                        self.messages[google_id].update(request.get('addLabelIds', []))
+            return 204, {}, ''
+        if route.startswith('messages/'):
+            google_id = route.split('/')[1]
+            with self.lock:
+                labels = self.messages.get(google_id)
+            if labels is None:
+                return self.json(404, {'error': {'code': 404, 'message': 'Not Found',
+                                                 'errors': [{'reason': 'notFound'}]}})
+            if route.endswith('/modify'):
+                self.count('modify')
+                with self.lock:
+                    labels.update(simplejson.loads(body).get('addLabelIds', []))
+            else:
+                self.count('get')
+            return self.json(200, {'id': google_id, 'labelIds': sorted(labels)})
+
+        return self.json(404, {'error': {'code': 404, 'message': 'Unknown method ' + path}})
+
+    def handleImport(self, method, path, query, headers, body):
+        upload_type = query.get('uploadType', [''])[0]
+
+        if path.startswith('/upload-session/'):
+            # resumable upload chunk
+            self.count('import.chunk', len(body))
+            session_id = path.rsplit('/', 1)[1]
+            with self.lock:
+                session = self.sessions.get(session_id)
+            if session is None:
+                return self.json(404, {'error': {'code': 404, 'message': 'No such upload session'}})
+            session['received'] += len(body)
+            total = headers.get('content-range', '').rsplit('/', 1)[-1]
+            if total.isdigit() and session['received'] < int(total):
+                return 308, {'Range': 'bytes=0-{0}'.format(session['received'] - 1)}, ''
+            with self.lock:
+                del self.sessions[session_id]
+            return self.json(200, self.newMessage(session['labelIds']))
+
+        if self.failImport():
+            self.count('import.error')
+            if self.random.random() < 0.5:
+                return self.json(429, {'error': {'code': 429, 'message': 'Rate Limit Exceeded',
+                                                 'errors': [{'reason': 'rateLimitExceeded'}]}})
+            return self.json(503, {'error': {'code': 503, 'message': 'Backend Error',
+                                             'errors': [{'reason': 'backendError'}]}})
+
+        if upload_type == 'resumable':
+            # start resumable upload session
+            self.count('import.session')
+            metadata = simplejson.loads(body) if body else {}
+            session_id = '{0:x}'.format(next(self.ids))
+            with self.lock:
+                self.sessions[session_id] = {'labelIds': metadata.get('labelIds', []), 'received': 0}
+            return 200, {'Location': 'http://{0}:{1}/upload-session/{2}'.format(self.server_address[0],
+                                                                                   self.server_address[1],
+                                                                                   session_id)}, ''
+
+        # simple or multipart upload
+        self.count('import.' + (upload_type or 'simple'), len(body))
+        label_ids = []
+        if upload_type == 'multipart':
+            message = Parser().parsestr('Content-Type: ' + headers.get('content-type', '') + '\r\n\r\n' + body)
+            for part in message.get_payload():
+                if part.get_content_type() == 'application/json':
+                    label_ids = simplejson.loads(part.get_payload()).get('labelIds', [])
+                    break
+        return self.json(200, self.newMessage(label_ids))
+
+    def handleBatch(self, headers, body):
+        # split a multipart/mixed batch request into its requests
+        self.count('batch')
+        message = Parser().parsestr('Content-Type: ' + headers.get('content-type', '') + '\r\n\r\n' + body)
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            request_line, rest = request.split('\n', 1)
+            method, url = request_line.split(' ')[:2]
+            head, _, inner_body = rest.replace('\r\n', '\n').partition('\n\n')
+            inner_headers = dict((key.strip().lower(), value.strip())
+                                 for key, _, value in (line.partition(':') for line in head.split('\n') if line))
+            status, response_headers, response_body = self.dispatch(method, url, inner_headers, inner_body)
+            content_id = part['Content-ID'][1:-1]
+            parts.append('--batch_bench\r\n'
+                         'Content-Type: application/http\r\n'
+                         'Content-ID: <response-{0}>\r\n\r\n'
+                         'HTTP/1.1 {1} {2}\r\n'
+                         'Content-Type: application/json\r\n'
+                         'Content-Length: {3}\r\n\r\n'
+                         '{4}\r\n'.format(content_id, status, BaseHTTPServer.BaseHTTPRequestHandler.responses[status][0],
+                                          len(response_body), response_body))
+        return 200, {'Content-Type': 'multipart/mixed; boundary=batch_bench'}, ''.join(parts) + '--batch_bench--\r\n'
+
+    def json(self, status, value):
+        return status, {'Content-Type': 'application/json'}, simplejson.dumps(value)
+
+    def server_close(self):
+        # drop keep-alive connections the uploader left open
+        BaseHTTPServer.HTTPServer.server_close(self)
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+"""
+ * FakeGmailHandler class
+ *
+ * HTTP/1.1 keep-alive request handler for FakeGmailServer.
+ *
+"""
+class FakeGmailHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer the status line and headers so each response is one send
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.connection)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def respond(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        time.sleep(self.server.latency)
+        headers = dict((key.lower(), value) for key, value in self.headers.items())
+        if self.path.startswith('/batch/'):
+            status, response_headers, response_body = self.server.handleBatch(headers, body)
+        else:
+            status, response_headers, response_body = self.server.dispatch(self.command, self.path, headers, body)
+        self.send_response(status)
+        for key, value in response_headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    do_GET = do_POST = do_PUT = respond
+
+    # redefine log_message to prevent output to console log
+    def log_message(self, format, *args):
+        return
+
+"""
+ * seedCredentials
+ *
+ * Save a refresh token and an access token that never expires in the
+ * database, so the uploader authorizes without a browser and never
+ * attempts a token refresh.
+ *
+"""
+def seedCredentials():
+    conn = uploader.openDatabase(uploader.DATABASE)
+    uploader.setConfig(conn, 'refresh_token', 'bench')
+    conn.close()
+    uploader.saveAccessToken(uploader.SharedCredentials('bench-token', uploader.CLIENT_ID, uploader.CLIENT_SECRET,
+                                                        'bench', datetime.datetime.utcnow() + datetime.timedelta(days=1),
+                                                        GOOGLE_TOKEN_URI, None))
+
+"""
+ * timeStage
+ *
+ * Wrap a function so the time spent in it is added to a stage timing.
+ *
+ * Args:
+ *     timings: dictionary of stage timings in seconds
+ *     stage: stage name
+ *     function: function to time
+ *
+ * Returns:
+ *     wrapped function
+"""
+def timeStage(timings, stage, function):
+    def timed(*args, **kwargs):
+        started = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings[stage] = timings.get(stage, 0) + time.time() - started
+            timings['finished'] = time.time()
+    return timed
+
+"""
+ * runMigration
+ *
+ * Migrate the synthetic profile with the uploader's migrateAccount, as a
+ * --batch run over the profile's mailroot would.  The stages are timed by
+ * wrapping the functions migrateAccount calls for them; startup is the
+ * time before the others, close the time after the last of them.
+ *
+ * Args:
+ *     mailroot: synthetic account folder
+ *     options: options dictionary
+ *     log_file: path to the uploader's log file
+ *
+ * Returns:
+ *     dictionary of stage timings in seconds, total messages, total failed
+"""
+def runMigration(mailroot, options, log_file):
+    account_options = uploader.defaultOptions()
+    account_options.update({'batch': True,
+                            'mailroot': mailroot,
+                            'database': uploader.DATABASE,
+                            'log_file': log_file,
+                            'workers': options['workers'],
+                            'parallel_folders': options['parallel_folders'],
+                            'chunk_size': max(1, options['chunk_size'] / 256) * 256 * 1024,
+                            'memory_budget': options['memory_budget'] * 1048576})
+
+    timings = {}
+    stages = [(uploader, 'refreshLabelCache', 'labels'),
+              (uploader.LabelManager, 'load', 'labels'),
+              (uploader.LabelManager, 'ensure', 'labels'),
+              (uploader, 'migrateFoldersInParallel', 'migrate'),
+              (uploader, 'migrateMBOX', 'migrate'),
+              (uploader, 'drainRetryQueue', 'retry')]
+    originals = [(owner, name, owner.__dict__[name]) for owner, name, stage in stages]
+    for owner, name, stage in stages:
+        setattr(owner, name, timeStage(timings, stage, owner.__dict__[name]))
+    try:
+        started = time.time()
+        total_messages, total_failed, retries_remaining = uploader.migrateAccount(account_options)
+        finished = time.time()
+    finally:
+        for owner, name, function in originals:
+            setattr(owner, name, function)
+
+    # time spent in migrateAccount outside the timed stages
+    timings['close'] = finished - timings.pop('finished', started)
+    timings['startup'] = finished - started - sum(timings.values())
+
+    return timings, total_messages, total_failed
+
+"""
+ * peakRSS
+ *
+ * Returns:
+ *     peak resident set size of this process and its children in MB
+"""
+def peakRSS():
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+    return rss / (1048576.0 if sys.platform == 'darwin' else 1024.0)
+
+"""
+ * printReport
+ *
+ * Print throughput and timings of a benchmark run.
+ *
+"""
+def printReport(title, timings, total_messages, total_failed, counts, nbytes, metrics):
+    elapsed = sum(timings.values())
+    uploaded = sum(count for name, count in counts.items()
+                   if name in ('import.multipart', 'import.simple', 'import.media', 'import.session'))
+
+    print
+    print title
+    print "-" * len(title)
+    print "Messages processed:   {0} ({1} failed)".format(total_messages, total_failed)
+    print "Messages imported:    {0}".format(uploaded)
+    print "Elapsed:              {0:.2f} s".format(elapsed)
+    print "Throughput:           {0:.1f} messages/s, {1:.2f} MB/s".format(total_messages / elapsed if elapsed else 0,
+                                                                        nbytes / 1048576.0 / elapsed if elapsed else 0)
+    print "Peak RSS:             {0:.1f} MB".format(peakRSS())
+    print "Stage timings:"
+    for stage in ('startup', 'labels', 'migrate', 'retry', 'close'):
+        print "    {0:<16} {1:8.3f} s".format(stage, timings.get(stage, 0))
+    print "Pipeline stages:      count     mean       p95"
+    for stage, count, mean, p95 in metrics.stages():
+        print "    {0:<16} {1:8} {2:7.2f}ms {3:7g}ms".format(stage, count, mean * 1000, p95 * 1000)
+    for name, count in sorted(metrics.counters.items()):
+        print "    {0:<16} {1:8}".format(name, count)
+    print "Server requests:"
+    for name in sorted(counts):
+        if counts[name]:
+            print "    {0:<16} {1:8}".format(name, counts[name])
+
+"""
+ * main
+ *
+ * Generate a synthetic profile, start the fake server and time a migration.
+ *
+"""
+def main():
+    options = parseCommandLine()
+
+    workdir = tempfile.mkdtemp(prefix='mbox-uploader-bench-')
+    mailroot = os.path.join(workdir, 'ImapMail', 'imap.bench.invalid')
+    uploader.DATABASE = os.path.join(workdir, 'mbox-uploader-osx-tb.db')
+    log_file = os.path.join(workdir, 'mbox-uploader-osx-tb.log')
+
+    # quiet the uploader's per-message progress output
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        started = time.time()
+        total_messages, total_bytes = generateProfile(mailroot, options)
+        generated = time.time() - started
+
+        server = FakeGmailServer(options['latency'], options['error_rate'], options['seed'])
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        document = discoveryDocument('http://127.0.0.1:{0}/'.format(server.server_address[1]))
+
+        # talk to the fake server within the chosen quota
+        uploader.buildService = lambda credentials: build_from_document(document,
+                                                                        http=credentials.authorize(uploader.ConnectionPool()))
+        uploader.QUOTA_RATE = options['quota_rate']
+        uploader.REQUEST_RETRIES = 8
+        uploader.RESUMABLE_THRESHOLD = options['resumable_threshold'] * 1024
+        seedCredentials()
+
+        runs = [('First run', False)]
+        if options['rerun']:
+            runs.append(('Re-run', True))
+
+        results = []
+        for title, rerun in runs:
+            if rerun:
+                # second run over the migrated profile, checking labels with the server
+                conn = uploader.openDatabase(uploader.DATABASE)
+                conn.execute("DELETE FROM folder_state")
+                conn.execute("DELETE FROM message_labels")
+                conn.commit()
+                conn.close()
+            counts_before = dict(server.counts)
+            bytes_before = server.bytes_received
+            timings, number_messages, number_failed = runMigration(mailroot, options, log_file)
+            counts = dict((name, count - counts_before.get(name, 0)) for name, count in server.counts.items())
+            results.append((title, timings, number_messages, number_failed, counts,
+                            server.bytes_received - bytes_before, uploader.metrics))
+
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    finally:
+        sys.stdout = sys.__stdout__
+
+    print "Synthetic profile:    {0} folders, {1} messages, {2:.1f} MB, generated in {3:.2f} s".format(
+        options['folders'], total_messages, total_bytes / 1048576.0, generated)
+    for result in results:
+        printReport(*result)
+
+    if options['keep']:
+        print "\nProfile and database kept in {0}".format(workdir)
+    else:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
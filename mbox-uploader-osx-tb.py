@@ -16,43 +16,196 @@
  '  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-import apiclient
+import array
 import BaseHTTPServer
+import bisect
+import collections
+import datetime
 import email.utils
+import fnmatch
 import getopt
-import httplib2
+import hashlib
+import heapq
+import httplib
+import importlib
 import io
 import logging
-import mailbox
 import md5
+import mmap
+import multiprocessing
+import multiprocessing.managers
+import multiprocessing.pool
 import os
+import Queue
 import random
 import re
+import signal
 import simplejson
+import socket
 import sqlite3
+import struct
 import sys
+import threading
 import time
+import traceback
 import webbrowser
+import zlib
 
-from apiclient import errors
 from credentials import *
-from googleapiclient.discovery import build
-from oauth2client.client import OAuth2WebServerFlow
-from oauth2client.client import OAuth2Credentials
-from oauth2client import GOOGLE_AUTH_URI
-from oauth2client import GOOGLE_REVOKE_URI
-from oauth2client import GOOGLE_TOKEN_URI
 from urlparse import urlparse, parse_qs
 
-# turn on logging
-logging.basicConfig(filename='mbox-uploader-osx-tb.log',level=logging.INFO)
+# maildir folders are listed with scandir where it is available
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+"""
+ * LazyModule class
+ *
+ * Stand-in for a module that is only imported when one of its attributes is
+ * first used.  The Google API client libraries take longer to import than
+ * planning a migration or printing usage takes altogether, so they are kept
+ * out of startup until a request is actually made.
+ *
+"""
+class LazyModule(object):
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+discovery = LazyModule('googleapiclient.discovery')
+errors = LazyModule('googleapiclient.errors')
+googlehttp = LazyModule('googleapiclient.http')
+httplib2 = LazyModule('httplib2')
+oauth2client = LazyModule('oauth2client')
+oauth2 = LazyModule('oauth2client.client')
 
 # configure needed Google Scopes
 SCOPES = ("https://www.googleapis.com/auth/gmail.modify",)
 
+# mbox-uploader-osx-tb database
+DATABASE = 'mbox-uploader-osx-tb.db'
+
+# mbox-uploader-osx-tb log file
+LOG_FILE = 'mbox-uploader-osx-tb.log'
+
+# cached copy of the Gmail API discovery document
+DISCOVERY_CACHE = 'mbox-uploader-osx-tb-discovery.json'
+
+# Gmail API discovery document location
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/gmail/v1/rest'
+
+# the cached discovery document is fetched again after this many seconds
+DISCOVERY_TTL = 7 * 24 * 3600
+
+# saved access tokens this close to expiring are refreshed instead of used
+TOKEN_EXPIRY_MARGIN = 300
+
+# format of access token expiry times saved in the config table
+TOKEN_EXPIRY_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
 # 32 backspaces
 BS32 = "\b"*32
 
+# Thunderbird header lines left out of uploaded messages
+MOZILLA_HEADERS = ('x-mozilla-status', 'x-mozilla-status2')
+
+# Gmail API quota units used by each request
+QUOTA_UNITS = {'import': 25,
+               'get': 5,
+               'modify': 5,
+               'batchModify': 50,
+               'labels.list': 1,
+               'labels.create': 5,
+               'history.list': 2,
+               'getProfile': 1}
+
+# Gmail per-user quota units per second
+QUOTA_RATE = 250
+
+# transient request errors are retried this many times before giving up
+REQUEST_RETRIES = 5
+
+# messages are dropped from the retry queue after this many failed runs
+RETRY_LIMIT = 10
+
+# Gmail cannot import messages larger than 35MB (less 1024B overhead just in case)
+MAX_MESSAGE_SIZE = 36699136
+
+# messages up to this size are imported in a single multipart request, larger
+# ones in a resumable upload session
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+
+# resumable upload chunk size; must be a multiple of 256KB
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+upload_chunk_size = UPLOAD_CHUNK_SIZE
+
+# subfolders of a Thunderbird maildir folder holding message files
+MAILDIR_SUBDIRS = ('cur', 'tmp')
+
+# threads reading maildir message files ahead of migration
+MAILDIR_READERS = 16
+
+# staging spool blob files are started anew once they reach this size
+SPOOL_BLOB_SIZE = 1024 * 1024 * 1024
+
+# folders are split into work units of about this many bytes for the shared
+# work queue
+WORK_UNIT_SIZE = 64 * 1024 * 1024
+
+# a work unit lease that has not been renewed for this many seconds may be
+# taken over by another worker
+LEASE_TTL = 300
+
+# seconds between renewals of a work unit lease
+LEASE_HEARTBEAT = 30
+
+# seconds to wait for a lock on a database shared between hosts
+SHARED_DATABASE_TIMEOUT = 120
+
+# seconds between checks on uploads made by other folder processes that
+# copies of a message are waiting for
+CLAIM_POLL_INTERVAL = 0.1
+
+# messages larger than this are read from the mbox file with ordinary reads
+# instead of through the memory map, so their pages stay out of the process
+STREAM_THRESHOLD = 1024 * 1024
+
+# bytes of message data that uploads in flight may hold in memory
+MEMORY_BUDGET = 256 * 1024 * 1024
+
+# stack size of upload worker threads, far below the platform default, so
+# that hundreds of workers cost little memory
+WORKER_STACK_SIZE = 512 * 1024
+
+# an access token refreshed this recently is not refreshed again when a
+# request that was already under way is rejected
+REFRESH_GRACE = 60
+
+# cached label ids are refreshed from Gmail after this many seconds
+LABEL_CACHE_TTL = 24 * 3600
+
+# Thunderbird folder names migrated to Gmail system labels
+SYSTEM_LABELS = {'DRAFTS': 'DRAFTS',
+                 'Drafts': 'DRAFTS',
+                 'INBOX': 'INBOX',
+                 'Inbox': 'INBOX',
+                 'Incoming': 'INBOX',
+                 'SENT': 'SENT',
+                 'Sent': 'SENT'}
+
+# headers that, along with the body, identify a message's content
+CONTENT_HASH_HEADERS = ('from', 'to', 'cc', 'date', 'subject', 'message-id')
+
 # disable output buffering on OS X
 class Unbuffered(object):
    def __init__(self, stream):
@@ -63,95 +216,708 @@ class Unbuffered(object):
    def __getattr__(self, attr):
        return getattr(self.stream, attr)
 
-sys.stdout = Unbuffered(sys.stdout)
+# set in folder worker processes; progress is reported to the main process
+# through this queue instead of being printed
+progress_channel = None
+
+# seconds between progress redraws on a terminal
+PROGRESS_INTERVAL = 0.25
+
+# seconds between progress lines when output is not a terminal
+PROGRESS_LINE_INTERVAL = 10
 
 """
- * parseCommandLine
+ * formatDuration
  *
- * Parses the command line to see if either the --reauth or --redoallmessages
- * switches are used.
+ * Args:
+ *     seconds: duration in seconds, or None if not known
  *
  * Returns:
- *     True/False values for reauth and redoall
+ *     duration as h:mm:ss
+"""
+def formatDuration(seconds):
+    if seconds is None:
+        return "-:--:--"
+    seconds = int(seconds)
+    return "{0}:{1:02d}:{2:02d}".format(seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+"""
+ * FolderProgress class
+ *
+ * Counters of the migration of one mbox file.
  *
 """
-def parseCommandLine():
-    # parse command line arguments
-    # mbox-uploader-osx-tb.py [--reauth] [--redoallmessages] [--help]
-    reauth = False
-    redoall = False
-    options, remainder = getopt.getopt(sys.argv[1:], "", ['help', 'reauth', 'redoallmessages'])
-    for opt in options:
-        if '--help' in opt:
-            print
-            print "Usage: mbox-uploader-osx-tb.py [--reauth] [--redoallmessages]"
-            print "       mbox-uploader-osx-tb.py [--help]"
-            print
-            print "       --help            : displays this message"
-            print "       --reauth          : forces reauthorization"
-            print "       --redoallmessages : migrated message database entries will be cleared for"
-            print "                         : the mailbox being migrated so that all messages will be"
-            print "                         : attempted to migrate again."
-            print
-            sys.exit()
-        if '--reauth' in opt:
-            reauth = True
-        if '--redoallmessages' in opt:
-            redoall = True
-    return reauth,redoall    
-
-"""
- * getUserLabels
- *
- * Get a list all labels in account.
+class FolderProgress(object):
+    def __init__(self, name, total_messages, total_bytes):
+        self.name = name
+        self.total_messages = total_messages
+        self.total_bytes = total_bytes
+        self.messages = 0
+        self.bytes = 0
+        self.uploaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.started = time.time()
+        self.verb = 'uploaded'
+
+    def summary(self):
+        # one line of final counts
+        elapsed = max(time.time() - self.started, 0.001)
+        return "{0}: {1} messages, {2} {3}, {4} skipped, {5} failed, {6:.1f} msg/s".format(
+            self.name, self.messages, self.uploaded, self.verb, self.skipped, self.failed, self.messages / elapsed)
+
+"""
+ * ProgressReporter class
+ *
+ * Live progress of the folders being migrated.  Counters are updated for
+ * every message, but the progress line is only redrawn every
+ * PROGRESS_INTERVAL seconds on a terminal; when output is not a terminal a
+ * plain line is written every PROGRESS_LINE_INTERVAL seconds instead.  The
+ * line shows messages/sec, MB/sec, the time left and the skip and failure
+ * counts, summed over the folders being migrated.  Folder worker processes
+ * send their counters to the main process, which draws them.
+ *
+"""
+class ProgressReporter(object):
+    def __init__(self):
+        self.folders = {}
+        self.drawn = 0
+        self.width = 0
+
+    def begin(self, key, name, total_messages, total_bytes):
+        # start counting a folder
+        folder = self.folders[key] = FolderProgress(name, total_messages, total_bytes)
+        return folder
+
+    def update(self, key, state):
+        # counters of a folder migrated in another process
+        folder = self.folders.get(key)
+        if folder is None:
+            folder = self.folders[key] = FolderProgress(state['name'], 0, 0)
+        folder.__dict__.update(state)
+        self.tick()
+
+    def tick(self):
+        # called often; draws or sends the counters once every interval
+        metrics.tick()
+        now = time.time()
+        if progress_channel is not None:
+            if now - self.drawn >= PROGRESS_INTERVAL:
+                self.drawn = now
+                for key, folder in self.folders.items():
+                    progress_channel.put(('progress', key, dict(vars(folder))))
+            return
+        tty = sys.stdout.isatty()
+        if now - self.drawn >= (PROGRESS_INTERVAL if tty else PROGRESS_LINE_INTERVAL):
+            self.drawn = now
+            self.draw(tty)
+
+    def line(self):
+        # progress line of all folders being migrated
+        folders = self.folders.values()
+        messages = sum(folder.messages for folder in folders)
+        total_messages = sum(folder.total_messages for folder in folders)
+        remaining = sum(max(0, folder.total_bytes - folder.bytes) for folder in folders)
+        message_rate = 0.0
+        byte_rate = 0.0
+        for folder in folders:
+            elapsed = max(time.time() - folder.started, 0.001)
+            message_rate += folder.messages / elapsed
+            byte_rate += folder.bytes / elapsed
+        if len(folders) == 1:
+            name = folders[0].name
+            name = (name[:23] + '..') if len(name) > 25 else name
+        else:
+            name = "{0} folders".format(len(folders))
+        return "{0}: {1} of {2}  {3:.1f} msg/s  {4:.2f} MB/s  ETA {5}  skipped {6}  failed {7}".format(
+            name, messages, total_messages, message_rate, byte_rate / 1048576,
+            formatDuration(remaining / byte_rate if byte_rate > 0 else None),
+            sum(folder.skipped for folder in folders), sum(folder.failed for folder in folders))
+
+    def draw(self, tty):
+        if not self.folders:
+            return
+        line = self.line()
+        if tty:
+            # redraw in place
+            sys.stdout.write("\r" + line.ljust(self.width))
+            self.width = len(line)
+        else:
+            sys.stdout.write(line + "\n")
+
+    def clear(self):
+        # remove the progress line before other output
+        if self.width:
+            sys.stdout.write("\r" + " " * self.width + "\r")
+            self.width = 0
+
+    def end(self, key):
+        # stop counting a folder and show its final counts
+        folder = self.folders.pop(key)
+        if progress_channel is not None:
+            progress_channel.put(('progress', key, dict(vars(folder))))
+            return folder
+        self.clear()
+        print("Folder " + folder.summary())
+        return folder
+
+reporter = ProgressReporter()
+
+"""
+ * QuotaScheduler class
+ *
+ * Token bucket shared by every thread making Gmail API requests.  Requests
+ * acquire the quota units they cost before being sent, which keeps the
+ * request rate within the per-user quota.  When Gmail reports that a rate
+ * limit was exceeded, all requests pause with exponential backoff and jitter
+ * and the rate is halved; it then creeps back up with every success.
+ *
+"""
+class QuotaScheduler(object):
+    def __init__(self, rate=QUOTA_RATE, minimum=10.0):
+        self.max_rate = float(rate)
+        self.minimum = minimum
+        self.rate = float(rate)
+        self.tokens = float(rate)
+        self.updated = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, units):
+        # wait until the request may be sent
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(max(self.rate, units), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= units:
+                        self.tokens -= units
+                        return
+                    wait = (units - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def backoff(self, attempt, rate_limited):
+        # pause all requests after a transient error
+        delay = min(64, 2 ** attempt) + random.random()
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + delay)
+            if rate_limited:
+                self.rate = max(self.minimum, self.rate / 2)
+        logging.info("Backing off for {0:.1f} seconds".format(delay))
+
+    def success(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 1)
+
+quota = QuotaScheduler()
+
+# upper bounds in seconds of the metrics histogram buckets
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+# seconds between metrics summaries
+METRICS_INTERVAL = 30
+
+"""
+ * Metrics class
+ *
+ * Timing histograms for each stage of the upload pipeline, plus counters.
+ * Durations go into fixed buckets, so recording one costs a bisect and a
+ * few additions however long the run.  Every METRICS_INTERVAL seconds a
+ * summary line is logged and, when a metrics file is set, a snapshot is
+ * written to it in the Prometheus text format, or as JSON when the file
+ * name ends in .json.  Folder worker processes send their observations to
+ * the main process instead, which merges them.
+ *
+ * Stages:
+ *     scan: indexing the "From " lines of an mbox file
+ *     summary: reading the .msf summary file of an mbox file
+ *     parse: reading the header fields of a message
+ *     serialize: hashing a message and preparing it for upload
+ *     upload: one successful import request, all chunks included
+ *     label_check: one batch of label checks
+ *     db_write: one database commit
+ *
+"""
+class Metrics(object):
+    def __init__(self, path=None, interval=METRICS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+        self.reported = time.time()
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        # record how long one run of a stage took
+        bucket = bisect.bisect_left(METRICS_BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = [[0] * (len(METRICS_BUCKETS) + 1), 0, 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def take(self):
+        # return the observations recorded so far and start afresh
+        with self.lock:
+            taken = (self.histograms, self.counters)
+            self.histograms = {}
+            self.counters = {}
+        return taken
+
+    def merge(self, taken):
+        # add observations returned by take() in another process
+        histograms, counters = taken
+        with self.lock:
+            for stage, (buckets, count, total) in histograms.items():
+                histogram = self.histograms.setdefault(stage, [[0] * (len(METRICS_BUCKETS) + 1), 0, 0.0])
+                for bucket, n in enumerate(buckets):
+                    histogram[0][bucket] += n
+                histogram[1] += count
+                histogram[2] += total
+            for name, n in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def percentile(self, stage, fraction):
+        # upper bound of the bucket holding the given fraction of durations
+        buckets, count, total = self.histograms[stage]
+        seen = 0
+        for bucket, n in enumerate(buckets):
+            seen += n
+            if seen >= fraction * count:
+                break
+        return METRICS_BUCKETS[bucket] if bucket < len(METRICS_BUCKETS) else float('inf')
+
+    def stages(self):
+        # (stage, count, mean, 95th percentile) of every stage observed
+        with self.lock:
+            return [(stage, count, total / count, self.percentile(stage, 0.95))
+                    for stage, (buckets, count, total) in sorted(self.histograms.items())]
+
+    def summary(self):
+        # one line of per-stage counts, mean and 95th percentile durations
+        stages = ["{0} n={1} mean={2:.1f}ms p95={3:g}ms".format(stage, count, mean * 1000, p95 * 1000)
+                  for stage, count, mean, p95 in self.stages()]
+        with self.lock:
+            counters = ["{0}={1}".format(name, n) for name, n in sorted(self.counters.items())]
+        return "; ".join(stages + counters)
+
+    def snapshot(self, json_format):
+        # metrics file contents
+        with self.lock:
+            histograms = sorted((stage, list(buckets), count, total)
+                                for stage, (buckets, count, total) in self.histograms.items())
+            counters = sorted(self.counters.items())
+        bounds = ["{0:g}".format(bound) for bound in METRICS_BUCKETS] + ['+Inf']
+        if json_format:
+            stages = {}
+            for stage, buckets, count, total in histograms:
+                cumulative = [sum(buckets[:n + 1]) for n in range(len(buckets))]
+                stages[stage] = {'count': count, 'sum': total, 'buckets': dict(zip(bounds, cumulative))}
+            return simplejson.dumps({'elapsed': time.time() - self.started, 'stages': stages,
+                                     'counters': dict(counters)}, indent=2, sort_keys=True)
+
+        lines = ["# HELP mbox_uploader_stage_seconds Duration of upload pipeline stages.",
+                 "# TYPE mbox_uploader_stage_seconds histogram"]
+        for stage, buckets, count, total in histograms:
+            cumulative = 0
+            for bound, n in zip(bounds, buckets):
+                cumulative += n
+                lines.append('mbox_uploader_stage_seconds_bucket{{stage="{0}",le="{1}"}} {2}'.format(
+                    stage, bound, cumulative))
+            lines.append('mbox_uploader_stage_seconds_sum{{stage="{0}"}} {1!r}'.format(stage, total))
+            lines.append('mbox_uploader_stage_seconds_count{{stage="{0}"}} {1}'.format(stage, count))
+        for name, n in counters:
+            lines.append("# TYPE mbox_uploader_{0}_total counter".format(name))
+            lines.append("mbox_uploader_{0}_total {1}".format(name, n))
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        # log a summary line and write the metrics file
+        self.reported = time.time()
+        logging.info("Metrics: " + self.summary())
+        if self.path is None:
+            return
+        # replace the file in one step so it is never read half written
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fh:
+            fh.write(self.snapshot(self.path.endswith('.json')))
+        os.rename(temp_path, self.path)
+
+    def tick(self):
+        # called often; reports once every interval
+        if time.time() - self.reported < self.interval:
+            return
+        if progress_channel is not None:
+            self.reported = time.time()
+            progress_channel.put(('metrics', self.take()))
+        else:
+            self.report()
+
+metrics = Metrics()
+
+"""
+ * isRateLimitError
  *
  * Args:
- *     service: Authorized Gmail API service instance.
- *     user_id: Account email address. The special value "me"
- *              can be used to indicate the authenticated user.
+ *     error: exception raised by a request
  *
  * Returns:
- *     A list all labels in account.
+ *     True if Gmail rejected the request because a rate limit was exceeded
 """
-def getUserLabels(service, user_id):
-    labels = {}
-    
-    try:
-        response = service.users().labels().list(userId=user_id).execute()
-        labelsList = response['labels']
-        for label in labelsList:
-            if label['type'] == "user":
-                labels[label['name']] = label['id']
-    except errors.HttpError, error:
-        logging.error('function getUserLabels: An error occurred: %s' % error)
-        print 'An error occurred: %s' % error
-    
-    return labels
+def isRateLimitError(error):
+    if not isinstance(error, errors.HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    if error.resp.status == 403:
+        try:
+            reason = simplejson.loads(error.content)['error']['errors'][0]['reason']
+        except (ValueError, KeyError, IndexError, TypeError):
+            return False
+        return reason in ('rateLimitExceeded', 'userRateLimitExceeded')
+    return False
+
+"""
+ * isTransientError
+ *
+ * Args:
+ *     error: exception raised by a request
+ *
+ * Returns:
+ *     True if the request may succeed when tried again later
+"""
+def isTransientError(error):
+    if isinstance(error, errors.HttpError):
+        return isRateLimitError(error) or error.resp.status >= 500
+    return isinstance(error, (socket.error, httplib.HTTPException, httplib2.HttpLib2Error))
+
+"""
+ * executeWithRetry
+ *
+ * Execute a request within the quota, retrying transient errors.
+ *
+ * Args:
+ *     request: request object (HttpRequest or BatchHttpRequest)
+ *     units: quota units used by the request
+ *
+ * Returns:
+ *     response of the request.  The last error is raised if the request
+ *     still fails after REQUEST_RETRIES retries.
+"""
+def executeWithRetry(request, units):
+    attempt = 0
+    while True:
+        quota.acquire(units)
+        try:
+            response = request.execute()
+            quota.success()
+            return response
+        except Exception, error:
+            if not isTransientError(error) or attempt >= REQUEST_RETRIES:
+                raise
+            quota.backoff(attempt, isRateLimitError(error))
+            metrics.count('request_retries')
+            attempt += 1
 
 """
- * createLabel
+ * executeBatch
  *
- * Create a new label for account.
+ * Execute requests together in batch requests within the quota.  Parts of
+ * the batch that fail with a transient error, e.g. a rate limit on a single
+ * messages.get, are sent again in the next batch, with the same backoff as
+ * executeWithRetry.
  *
  * Args:
  *     service: Authorized Gmail API service instance.
- *     user_id: Account email address. The special value "me"
- *              can be used to indicate the authenticated user.
- *     label_object: label object for label to be added.
+ *     requests: list of (request id, request object) tuples
+ *     units: quota units used by each request
+ *
+ * Returns:
+ *     request id to (response, exception) dictionary.  Parts that still
+ *     fail after REQUEST_RETRIES retries keep their last exception.  An
+ *     error of the whole batch request is raised.
+"""
+def executeBatch(service, requests, units):
+    responses = {}
+    def callback(request_id, response, exception):
+        responses[request_id] = (response, exception)
+
+    attempt = 0
+    while True:
+        batch = service.new_batch_http_request()
+        for request_id, request in requests:
+            batch.add(request, callback=callback, request_id=request_id)
+        executeWithRetry(batch, units * len(requests))
+
+        failed = [(request_id, request) for request_id, request in requests
+                  if isTransientError(responses.get(request_id, (None, None))[1])]
+        if not failed or attempt >= REQUEST_RETRIES:
+            return responses
+        quota.backoff(attempt, any(isRateLimitError(responses[request_id][1]) for request_id, request in failed))
+        metrics.count('request_retries')
+        requests = failed
+        attempt += 1
+
+"""
+ * OPTION_SWITCHES
+ *
+ * Command line switches, in getopt long option form.  The same names,
+ * without the leading "--", are used as keys of --config files.
+ *
+"""
+OPTION_SWITCHES = ['help', 'reauth', 'redoallmessages', 'workers=', 'verify-remote', 'parallel-folders=', 'plan=',
+                   'manifest=', 'metrics-file=', 'chunk-size=', 'memory-budget=', 'batch', 'mailroot=', 'folders=',
+                   'database=', 'log-file=', 'token-file=', 'config=', 'concurrent-accounts=', 'compress',
+                   'work-queue=']
+
+"""
+ * defaultOptions
+ *
+ * Returns:
+ *     options dictionary with the value of every switch that is not used
+"""
+def defaultOptions():
+    return {'reauth': False,
+            'redoall': False,
+            'workers': 1,
+            'verify_remote': False,
+            'parallel_folders': 1,
+            'plan': None,
+            'manifest': None,
+            'metrics_file': None,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+            'memory_budget': MEMORY_BUDGET,
+            'batch': False,
+            'mailroot': None,
+            'folders': None,
+            'database': DATABASE,
+            'log_file': LOG_FILE,
+            'token_file': None,
+            'config': None,
+            'concurrent_accounts': 1,
+            'compress': False,
+            'command': None,
+            'spool': None,
+            'work_queue': None,
+            'name': None}
+
+"""
+ * printUsage
+ *
+ * Print the command line usage message.
+ *
+"""
+def printUsage():
+    print
+    print "Usage: mbox-uploader-osx-tb.py [--reauth] [--redoallmessages] [--workers N] [--verify-remote]"
+    print "                                 [--parallel-folders N] [--plan FILE] [--manifest FILE]"
+    print "                                 [--metrics-file FILE] [--chunk-size KB] [--memory-budget MB]"
+    print "                                 [--batch] [--mailroot DIR] [--folders GLOBS] [--database FILE]"
+    print "                                 [--log-file FILE] [--token-file FILE] [--work-queue FILE]"
+    print "       mbox-uploader-osx-tb.py --config FILE [--concurrent-accounts N] [switches]"
+    print "       mbox-uploader-osx-tb.py stage DIR [--compress] [--mailroot DIR] [--folders GLOBS]"
+    print "       mbox-uploader-osx-tb.py upload DIR [switches]"
+    print "       mbox-uploader-osx-tb.py [--help]"
+    print
+    print "       --help            : displays this message"
+    print "       --reauth          : forces reauthorization"
+    print "       --redoallmessages : migrated message database entries will be cleared for"
+    print "                         : the mailbox being migrated so that all messages will be"
+    print "                         : attempted to migrate again."
+    print "       --workers N       : number of messages to upload in parallel (default 1)"
+    print "       --verify-remote   : refresh the local label cache with the label changes made"
+    print "                         : in Gmail since the last run."
+    print "       --parallel-folders N : number of mbox files to migrate at the same time in"
+    print "                         : separate processes (default 1)"
+    print "       --plan FILE       : scan the mailbox without uploading anything and write a"
+    print "                         : JSON manifest of what would be migrated to FILE"
+    print "       --manifest FILE   : migrate the mailbox and folders listed in a manifest"
+    print "                         : written by --plan"
+    print "       --metrics-file FILE : write stage timing metrics to FILE every {0} seconds,".format(METRICS_INTERVAL)
+    print "                         : as JSON if FILE ends in .json, otherwise in the"
+    print "                         : Prometheus text format"
+    print "       --chunk-size KB   : chunk size of resumable uploads, used for messages larger"
+    print "                         : than {0}KB, in multiples of 256KB (default {1})".format(
+        RESUMABLE_THRESHOLD / 1024, UPLOAD_CHUNK_SIZE / 1024)
+    print "       --memory-budget MB : message data that uploads in flight may hold in memory,"
+    print "                         : shared by all workers (default {0})".format(MEMORY_BUDGET / 1048576)
+    print "       --batch           : never ask for input; fail instead of opening a browser"
+    print "                         : when there is no refresh token"
+    print "       --mailroot DIR    : account folder to migrate instead of asking for one"
+    print "       --folders GLOBS   : only migrate folders whose label matches one of these"
+    print "                         : comma separated patterns, e.g. Inbox,Archive/*"
+    print "       --database FILE   : migration database (default {0})".format(DATABASE)
+    print "       --log-file FILE   : log file (default {0})".format(LOG_FILE)
+    print "       --token-file FILE : file holding the refresh token to use"
+    print "       --config FILE     : migrate every account listed in a JSON config file in"
+    print "                         : batch mode"
+    print "       --concurrent-accounts N : number of accounts of a config file to migrate at"
+    print "                         : the same time in separate processes (default 1)"
+    print "       --compress        : compress the messages written by stage"
+    print "       --work-queue FILE : share the migration with workers on other hosts through"
+    print "                         : the database FILE on shared storage, used instead of"
+    print "                         : --database"
+    print
+    print "       stage DIR         : parse the mailbox into a spool of ready to import messages"
+    print "                         : in DIR, without connecting to Gmail"
+    print "       upload DIR        : upload a spool written by stage"
+    print
+
+"""
+ * setOption
+ *
+ * Set the option of a single switch.
+ *
+ * Args:
+ *     options: options dictionary
+ *     opt: switch, e.g. "--workers"
+ *     value: value of the switch, or '' for switches without a value
+ *
+"""
+def setOption(options, opt, value):
+    if opt == '--help':
+        printUsage()
+        sys.exit()
+    if opt == '--reauth':
+        options['reauth'] = True
+    if opt == '--redoallmessages':
+        options['redoall'] = True
+    if opt in ('--workers', '--parallel-folders', '--concurrent-accounts'):
+        try:
+            options[opt[2:].replace('-', '_')] = max(1, int(value))
+        except ValueError:
+            sys.exit("Invalid value for {0}: {1}".format(opt, value))
+    if opt == '--verify-remote':
+        options['verify_remote'] = True
+    if opt in ('--plan', '--manifest', '--metrics-file', '--mailroot', '--database', '--log-file', '--token-file',
+               '--config', '--work-queue'):
+        options[opt[2:].replace('-', '_')] = value
+    if opt == '--chunk-size':
+        try:
+            # resumable uploads need chunks in multiples of 256KB
+            options['chunk_size'] = max(1, int(value) / 256) * 256 * 1024
+        except ValueError:
+            sys.exit("Invalid value for --chunk-size: {0}".format(value))
+    if opt == '--memory-budget':
+        try:
+            options['memory_budget'] = max(1, int(value)) * 1048576
+        except ValueError:
+            sys.exit("Invalid value for --memory-budget: {0}".format(value))
+    if opt == '--batch':
+        options['batch'] = True
+    if opt == '--compress':
+        options['compress'] = True
+    if opt == '--folders':
+        options['folders'] = [glob.strip() for glob in value.split(',') if glob.strip()]
+
+"""
+ * parseCommandLine
+ *
+ * Parses the command line switches listed in OPTION_SWITCHES and the
+ * optional stage or upload command.
+ *
+ * Returns:
+ *     options dictionary, see defaultOptions
+ *
+"""
+def parseCommandLine():
+    # parse command line arguments
+    # mbox-uploader-osx-tb.py [--reauth] [--redoallmessages] [--workers N] [--verify-remote]
+    #                         [--parallel-folders N] [--plan FILE] [--manifest FILE]
+    #                         [--metrics-file FILE] [--chunk-size KB] [--memory-budget MB]
+    #                         [--batch] [--mailroot DIR] [--folders GLOBS] [--database FILE]
+    #                         [--log-file FILE] [--token-file FILE] [--config FILE]
+    #                         [--concurrent-accounts N] [--compress] [--work-queue FILE] [--help]
+    #                         [stage DIR | upload DIR]
+    options = defaultOptions()
+    opts, remainder = getopt.gnu_getopt(sys.argv[1:], "", OPTION_SWITCHES)
+    for opt, value in opts:
+        setOption(options, opt, value)
+    if remainder:
+        if len(remainder) != 2 or remainder[0] not in ('stage', 'upload'):
+            printUsage()
+            sys.exit(2)
+        options['command'], options['spool'] = remainder
+    return options
+
+"""
+ * loadConfig
+ *
+ * Read the accounts of a batch mode config file.  The file holds a JSON
+ * object whose keys are switch names without the leading "--", plus an
+ * "accounts" list of objects of the same form.  Switches given at the top
+ * level apply to every account and account entries override them, e.g.
+ *
+ *     {"workers": 8,
+ *      "concurrent-accounts": 2,
+ *      "accounts": [{"name": "alice", "mailroot": "/profiles/alice/ImapMail/imap.gmail.com",
+ *                    "database": "alice.db", "log-file": "alice.log",
+ *                    "token-file": "alice.token", "folders": ["Inbox", "Archive/*"]}]}
+ *
+ * Switches given on the command line apply to every account as well, but
+ * the config file takes precedence.
+ *
+ * Args:
+ *     path: path to JSON config file
+ *     options: options dictionary from the command line
  *
- *  Returns:
- *     Label ID
+ * Returns:
+ *     list of options dictionaries, one per account, and the number of
+ *     accounts to migrate at the same time
 """
-def createLabel(service, user_id, label_object):
+def loadConfig(path, options):
     try:
-        label = service.users().labels().create(userId=user_id,
-                                                body=label_object).execute()
-        print("\rLabel created for folder: {0}".format((label_object['name'].ljust(55,' ')[:53] + '..') if len(label_object['name'].ljust(55,' ')) > 55 else label_object['name'].ljust(55,' ')))
-        logging.info("Label created for folder: {0}".format(label_object['name']))
-        return label['id']
-    except errors.HttpError, error:
-        logging.error('function createLabel: An error occurred: %s' % error)
-        print 'An error occurred: %s' % error
+        fh = open(path)
+        try:
+            config = simplejson.load(fh)
+        finally:
+            fh.close()
+    except (IOError, ValueError), error:
+        sys.exit("Cannot read config {0}: {1}".format(path, error))
+
+    def apply(account_options, settings):
+        for key, value in settings.items():
+            if key == 'accounts':
+                continue
+            if key == 'name':
+                account_options['name'] = value
+                continue
+            if key not in OPTION_SWITCHES and key + '=' not in OPTION_SWITCHES or key in ('help', 'config'):
+                sys.exit("Unknown setting in config {0}: {1}".format(path, key))
+            if isinstance(value, list):
+                value = ','.join(value)
+            if value is False:
+                continue
+            setOption(account_options, '--' + key, '' if value is True else str(value))
+
+    defaults = dict(options)
+    apply(defaults, config)
+    accounts = []
+    for n, settings in enumerate(config.get('accounts', [])):
+        account_options = dict(defaults)
+        apply(account_options, settings)
+        account_options['batch'] = True
+        if account_options['name'] is None:
+            account_options['name'] = 'account {0}'.format(n + 1)
+        if account_options['mailroot'] is None and account_options['manifest'] is None:
+            sys.exit("No mailroot for {0} in config {1}".format(account_options['name'], path))
+        accounts.append(account_options)
+
+    if len(set(account['database'] for account in accounts)) < len(accounts):
+        sys.exit("Every account in config {0} needs its own database".format(path))
+
+    return accounts, defaults['concurrent_accounts']
 
 """
  * makeLabel
@@ -173,90 +939,651 @@ def makeLabel(label_name, mlv='show', llv='labelShow'):
     return label
 
 """
- * checkAddLabel
- *
- * If not exists, add label.
+ * labelPaths
  *
  * Args:
- *     service: Authorized Gmail API service instance.
- *     label: label name
- *     current_labels: list of current labels for account
+ *     label: label name, with "/" between nested folder names
  *
+ * Returns:
+ *     names of the label and of all its parent labels, parents first
 """
-def checkAddLabel(service, label, current_labels):
-    if label not in current_labels:
-        current_labels[label] = createLabel(service,'me',makeLabel(label))
-        
+def labelPaths(label):
+    parts = label.split('/')
+    return ['/'.join(parts[:n]) for n in range(1, len(parts) + 1)]
+
 """
- * getMigrateMessageInfo
+ * LabelManager class
+ *
+ * Label name to label id mapping for the account, kept in the labels table
+ * so that later runs do not need to list the account's labels.  The cached
+ * mapping is refreshed from Gmail when it is older than LABEL_CACHE_TTL
+ * seconds, when --verify-remote is used, and when Gmail reports that a
+ * label being created already exists.
+ *
+ * ensure() creates all missing labels of the folders being migrated, along
+ * with their parent labels, before any message is migrated.  Labels are
+ * created through the batch endpoint, one batch per nesting level so that
+ * parents always exist before their children.
+ *
+"""
+class LabelManager(object):
+    BATCH_SIZE = 50
+
+    def __init__(self, service, conn):
+        self.service = service
+        self.conn = conn
+        self.ids = dict(conn.execute("SELECT name, label_id FROM labels").fetchall())
+        self.ids.update(SYSTEM_LABELS)
+
+    def refresh(self):
+        # replace the cached mapping with the account's current user labels
+        response = executeWithRetry(self.service.users().labels().list(userId='me'), QUOTA_UNITS['labels.list'])
+        ids = dict((label['name'], label['id']) for label in response.get('labels', []) if label['type'] == "user")
+        self.conn.execute("DELETE FROM labels")
+        self.conn.executemany("INSERT INTO labels VALUES (?,?)", ids.items())
+        self.conn.commit()
+        setConfig(self.conn, 'labels_refreshed', str(time.time()))
+        self.ids = ids
+        self.ids.update(SYSTEM_LABELS)
+        logging.info("Label cache refreshed with {0} labels".format(len(ids)))
+
+    def load(self, refresh=False):
+        # refresh the cached mapping if asked to or if it is out of date
+        refreshed = getConfig(self.conn, 'labels_refreshed')
+        if refresh or refreshed is None or time.time() - float(refreshed) > LABEL_CACHE_TTL:
+            self.refresh()
+
+    def ensure(self, labels):
+        # create the given labels and their parents where they do not exist
+        levels = {}
+        for label in labels:
+            for name in labelPaths(label):
+                if name not in self.ids:
+                    levels.setdefault(name.count('/'), set()).add(name)
+
+        conflicts = []
+        for depth in sorted(levels):
+            names = sorted(levels[depth])
+            for i in range(0, len(names), self.BATCH_SIZE):
+                conflicts.extend(self.create(names[i:i + self.BATCH_SIZE]))
+
+        if conflicts:
+            # created elsewhere since the cache was refreshed
+            self.refresh()
+            for name in conflicts:
+                if name not in self.ids:
+                    logging.error("Label {0} exists but could not be found".format(name))
+
+    def create(self, names):
+        # create labels in one batch request; returns the names that already
+        # existed in Gmail
+        requests = [(str(n), self.service.users().labels().create(userId='me', body=makeLabel(name)))
+                    for n, name in enumerate(names)]
+        responses = executeBatch(self.service, requests, QUOTA_UNITS['labels.create'])
+
+        conflicts = []
+        for n, name in enumerate(names):
+            response, exception = responses.get(str(n), (None, None))
+            if exception is not None:
+                if isinstance(exception, errors.HttpError) and exception.resp.status == 409:
+                    conflicts.append(name)
+                else:
+                    logging.error('Label {0} could not be created: {1}'.format(name, exception))
+                    print 'An error occurred: %s' % exception
+                continue
+            if response is None:
+                continue
+            self.ids[name] = response['id']
+            self.conn.execute("INSERT OR REPLACE INTO labels VALUES (?,?)", [name, response['id']])
+            print("\rLabel created for folder: {0}".format((name.ljust(55,' ')[:53] + '..') if len(name.ljust(55,' ')) > 55 else name.ljust(55,' ')))
+            logging.info("Label created for folder: {0}".format(name))
+        self.conn.commit()
+        return conflicts
+
+"""
+ * SCHEMA
+ *
+ * Database schema upgrades.  Entry n upgrades the database from schema
+ * version n to n + 1; the current version is kept in "PRAGMA user_version".
+ *
+"""
+SCHEMA = [
+    # 1: message_info ledger
+    ["CREATE TABLE IF NOT EXISTS message_info (mailbox text, message_id text, google_id text, UNIQUE (mailbox, message_id))",
+     "CREATE INDEX IF NOT EXISTS message_info_google_id ON message_info (google_id)"],
+    # 2: label ids each message was imported or modified with
+    ["CREATE TABLE IF NOT EXISTS config (name text unique, value text)",
+     "CREATE TABLE IF NOT EXISTS message_labels (google_id text PRIMARY KEY, label_ids text)"],
+    # 3: per mbox file fingerprint and resume checkpoint
+    ["CREATE TABLE IF NOT EXISTS folder_state (path text PRIMARY KEY, mailbox text, size integer, mtime real, "
+     "head_sum text, tail_sum text, offset integer)"],
+    # 4: messages whose upload failed with a transient error
+    ["CREATE TABLE IF NOT EXISTS retry_queue (mailbox text, path text, start integer, stop integer, "
+     "message_id text, label_ids text, attempts integer, error text, UNIQUE (path, start))"],
+    # 5: content hashes of uploaded messages, across all mailboxes
+    ["CREATE TABLE IF NOT EXISTS content_hash (hash text PRIMARY KEY, google_id text)"],
+    # 6: label name to label id cache
+    ["CREATE TABLE IF NOT EXISTS labels (name text PRIMARY KEY, label_id text)"],
+    # 7: Message-ID hashes for the in-memory MessageIndex
+    ["ALTER TABLE message_info ADD COLUMN message_hash integer",
+     "UPDATE message_info SET message_hash = message_hash(message_id)",
+     "CREATE INDEX IF NOT EXISTS message_info_hash ON message_info (mailbox, message_hash)"],
+    # 8: shared work queue of folder byte ranges
+    ["CREATE TABLE IF NOT EXISTS work_units (path text, label text, start integer, stop integer, offset integer, "
+     "state text, owner text, lease_expiry real, attempts integer, PRIMARY KEY (path, start))"],
+]
+
+"""
+ * openDatabase
  *
- * Retrieves message info (message-id, google id) from database for messages
- * that have already been migrated from this mailbox.
+ * Open the mbox-uploader-osx-tb database in WAL mode and bring its schema up
+ * to date.  A database shared by workers on several hosts uses a rollback
+ * journal instead, since WAL needs memory shared between its users.
  *
  * Args:
- *     conn: database connection handler
- *     mailbox : mailbox associated with messages
- *     redoall: indicates whether to remove all message info and migrate all messages again
+ *     path: path to database file
+ *     shared: whether the database is on storage shared between hosts
  *
  * Returns:
- *     message info list
+ *     database connection handle
 """
-def getMigrateMessageInfo(conn,mailbox,redoall):
-    c = conn.cursor()
-
-    # does message_info table exist?
-    message_info = {}
-    c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = ? AND name = ?", ["table", "message_info"])
-    if c.fetchone()[0] > 0:
-        # message_info table exists, retrieve message-id and google id values
-        if redoall:
-            c.execute("DELETE FROM message_info where mailbox = ?", [mailbox])
-            conn.commit()
-        c.execute("SELECT * FROM message_info where mailbox = ?", [mailbox])
-        while True:
-            row = c.fetchone()
-            if row is None:
-                break
-            message_info[row[1]] = row[2]
+def openDatabase(path, shared=False):
+    if shared:
+        conn = sqlite3.connect(path, timeout=SHARED_DATABASE_TIMEOUT)
+        conn.execute("PRAGMA journal_mode=DELETE")
     else:
-        # create table
-        c.execute("CREATE TABLE message_info (mailbox text, message_id text, google_id text, UNIQUE (mailbox, message_id))")
-        conn.commit()
+        conn = sqlite3.connect(path)
+
+        # write-ahead logging lets commits skip most fsyncs
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    conn.create_function('message_hash', 1, messageHash)
+
+    # apply any outstanding schema upgrades, each with its version bump in
+    # one transaction so a failed upgrade leaves the database as it was
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for n in range(version, len(SCHEMA)):
+            conn.execute("BEGIN")
+            try:
+                for statement in SCHEMA[n]:
+                    conn.execute(statement)
+                conn.execute("PRAGMA user_version = {0}".format(n + 1))
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+    finally:
+        conn.isolation_level = isolation_level
 
-    return message_info
+    return conn
 
 """
- * getAuthCredentials
+ * getConfig
  *
- * Gets a credentials object that can be used to authorize a service object
+ * Get a value from the config table.
  *
  * Args:
- *     conn: database connection handler
- *     reauth: indicates whether to remove all message-id and migrate all messages again
+ *     conn: database connection handle
+ *     name: config value name
  *
+ * Returns:
+ *     config value or None if not set
 """
-def getAuthCredentials(conn,reauth):
-    c = conn.cursor()
+def getConfig(conn, name):
+    row = conn.execute("SELECT value FROM config WHERE name = ?", [name]).fetchone()
+    return None if row is None else row[0]
 
-    # does config table exist?
-    c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = ? AND name = ?", ["table", "config"])
-    if c.fetchone()[0] > 0:
-        # config table exists, retrieve refresh_token if it exists
-        c.execute("SELECT * FROM config WHERE name='refresh_token'")
-        result = c.fetchone()
-    else:
-        result = None
+"""
+ * setConfig
+ *
+ * Save a value in the config table.
+ *
+ * Args:
+ *     conn: database connection handle
+ *     name: config value name
+ *     value: config value
+"""
+def setConfig(conn, name, value):
+    conn.execute("INSERT OR REPLACE INTO config (name, value) VALUES (?,?)", [name, value])
+    conn.commit()
 
-    # retrieve refresh token, if one exists
-    if result is None or reauth:
-        # no refresh token.  need to get authorized.
+"""
+ * Ledger class
+ *
+ * Batches database writes into transactions.  Writes are queued and
+ * committed together once max_rows writes are pending or max_delay seconds
+ * have passed since the first pending write.  flush() must be called before
+ * exiting so that no queued writes are lost.
+ *
+ * The ledger also keeps the label cache: the label ids each uploaded message
+ * was imported or modified with, and the content hash index of uploaded
+ * messages.  It saves FolderCheckpoints in the same transaction as the
+ * message_info rows they cover.
+ *
+"""
+class Ledger(object):
+    FOLDER_STATE_SQL = "INSERT OR REPLACE INTO folder_state VALUES (?,?,?,?,?,?,?)"
 
-        # get user authorization URL
-        flow = OAuth2WebServerFlow(CLIENT_ID, CLIENT_SECRET, " ".join(SCOPES), redirect_uri="http://127.0.0.1:8000")
-        auth_uri = flow.step1_get_authorize_url()
+    def __init__(self, conn, max_rows=500, max_delay=5.0):
+        self.conn = conn
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.pending = []
+        self.first_pending = None
+        self.labels = {}
+        self.hashes = {}
+        self.messages = {}
+        self.checkpoints = {}
 
-        print("\nLaunching your preferred web browser to continue sign-in at")
-        print("your account provider website.  When you have granted access,")
+    def execute(self, sql, params):
+        # queue a write
+        if not self.pending:
+            self.first_pending = time.time()
+        self.pending.append((sql, params))
+        if len(self.pending) >= self.max_rows or time.time() - self.first_pending >= self.max_delay:
+            self.flush()
+
+    def recordMessage(self, mailbox, message_id, google_id):
+        self.messages.setdefault((mailbox, message_id), google_id)
+        self.execute("INSERT OR IGNORE into message_info VALUES (?,?,?,?)",
+                     [mailbox, message_id, google_id, messageHash(message_id)])
+
+    def getMessage(self, mailbox, message_id):
+        # google id of a message migrated from the mailbox or None
+        if (mailbox, message_id) in self.messages:
+            return self.messages[(mailbox, message_id)]
+        row = self.conn.execute("SELECT google_id FROM message_info WHERE mailbox = ? AND message_id = ?",
+                                [mailbox, message_id]).fetchone()
+        return None if row is None else row[0]
+
+    def recordLabels(self, google_id, label_ids):
+        # cache the full set of label ids of a message
+        value = ','.join(sorted(set(label_ids)))
+        self.labels[google_id] = value
+        self.execute("INSERT OR REPLACE INTO message_labels VALUES (?,?)", [google_id, value])
+
+    def forgetLabels(self, google_id):
+        # drop the cached label ids of a message
+        self.labels[google_id] = None
+        self.execute("DELETE FROM message_labels WHERE google_id = ?", [google_id])
+
+    def getLabels(self, google_id):
+        # cached label ids of a message or None if they are not known
+        if google_id in self.labels:
+            value = self.labels[google_id]
+        else:
+            row = self.conn.execute("SELECT label_ids FROM message_labels WHERE google_id = ?", [google_id]).fetchone()
+            value = None if row is None else row[0]
+        if value is None:
+            return None
+        return set(label_id for label_id in value.split(',') if label_id)
+
+    def recordContentHash(self, content_hash, google_id):
+        # remember which message has this content
+        self.hashes[content_hash] = google_id
+        self.execute("INSERT OR IGNORE INTO content_hash VALUES (?,?)", [content_hash, google_id])
+
+    def getContentHash(self, content_hash):
+        # google id of the message with this content or None
+        if content_hash in self.hashes:
+            return self.hashes[content_hash]
+        row = self.conn.execute("SELECT google_id FROM content_hash WHERE hash = ?", [content_hash]).fetchone()
+        return None if row is None else row[0]
+
+    def queueRetry(self, mailbox, job):
+        # add a failed UploadJob to the retry queue
+        self.execute("INSERT OR REPLACE INTO retry_queue VALUES (?,?,?,?,?,?,"
+                     "COALESCE((SELECT attempts FROM retry_queue WHERE path = ? AND start = ?), 0) + 1,?)",
+                     [mailbox, job.file, job.record.start, job.record.stop, job.message_id, ','.join(job.labels),
+                      job.file, job.record.start, str(job.error)])
+
+    def dropRetry(self, path, start):
+        # remove a message from the retry queue
+        self.execute("DELETE FROM retry_queue WHERE path = ? AND start = ?", [path, start])
+
+    def checkpoint(self, folder):
+        # save the FolderCheckpoint with every commit until it is released
+        self.checkpoints[folder.path] = folder
+
+    def release(self, folder):
+        # save the FolderCheckpoint one last time and stop tracking it
+        self.flush()
+        del self.checkpoints[folder.path]
+
+    def apply(self, pending, rows):
+        # queue writes and folder_state rows sent by a ChannelLedger
+        for sql, params in pending:
+            self.execute(sql, params)
+        for row in rows:
+            self.execute(self.FOLDER_STATE_SQL, row)
+
+    def flush(self):
+        # commit all queued writes in one transaction
+        if not self.pending and not self.checkpoints:
+            return
+        started = time.time()
+        for sql, params in self.pending:
+            self.conn.execute(sql, params)
+        for folder in self.checkpoints.values():
+            self.conn.execute(folder.SQL, folder.row())
+        self.conn.commit()
+        metrics.observe('db_write', time.time() - started)
+        self.pending = []
+        self.first_pending = None
+        self.labels = {}
+        self.hashes = {}
+        self.messages = {}
+
+"""
+ * ChannelLedger class
+ *
+ * Ledger used by folder worker processes.  Reads go to the process's own
+ * database connection, but writes and checkpoints are sent through a
+ * multiprocessing queue to the main process, which is the only writer.
+ *
+"""
+class ChannelLedger(Ledger):
+    def __init__(self, conn, channel):
+        Ledger.__init__(self, conn)
+        self.channel = channel
+
+    def flush(self):
+        rows = [folder.row() for folder in self.checkpoints.values()]
+        if not self.pending and not rows:
+            return
+        self.channel.put(('write', self.pending, rows))
+        self.pending = []
+        self.first_pending = None
+        # the caches are kept: the main process commits the writes some time
+        # later, and until then the database does not know these messages
+
+"""
+ * checksum
+ *
+ * MD5 checksum of a byte range, used to fingerprint mbox files.
+ *
+ * Args:
+ *     data: file contents (string or memory-mapped file)
+ *     start: start of byte range
+ *     end: end of byte range
+ *
+ * Returns:
+ *     hex digest
+"""
+CHECKSUM_WINDOW = 65536
+
+def checksum(data, start, end):
+    return md5.new(data[start:end]).hexdigest()
+
+"""
+ * FolderCheckpoint class
+ *
+ * Tracks how far into an mbox file migration has safely got.  The checkpoint
+ * offset is the start of the first message that has not been fully
+ * processed: either not read yet, still being uploaded, waiting for its
+ * label change to be sent, or failed.  Along
+ * with the file size, modification time and checksums of the head of the file
+ * and of the bytes just before the checkpoint it is kept in the folder_state
+ * table.
+ *
+"""
+class FolderCheckpoint(object):
+    SQL = Ledger.FOLDER_STATE_SQL
+
+    def __init__(self, path, mailbox, mbox):
+        self.path = path
+        self.mailbox = mailbox
+        self.data = mbox.data
+        self.size = mbox.size
+        self.mtime = mbox.mtime
+        self.head_sum = checksum(mbox.data, 0, min(mbox.size, CHECKSUM_WINDOW))
+        self.scanned = mbox.start
+        self.inflight = {}
+        self.blocked = None
+
+    def begin(self, msg_number, record):
+        # message handed off for upload
+        self.inflight[msg_number] = record.start
+
+    def hold(self, msg_number, start):
+        # message whose label change has not been sent yet
+        self.inflight[msg_number] = start
+
+    def end(self, msg_number, succeeded):
+        # upload finished
+        start = self.inflight.pop(msg_number)
+        if not succeeded and (self.blocked is None or start < self.blocked):
+            self.blocked = start
+
+    def advance(self, stop):
+        # messages before stop have been read and dealt with or handed off
+        self.scanned = stop
+
+    def offset(self):
+        offsets = [self.scanned] + self.inflight.values()
+        if self.blocked is not None:
+            offsets.append(self.blocked)
+        return min(offsets)
+
+    def row(self):
+        offset = self.offset()
+        tail_sum = checksum(self.data, max(0, offset - CHECKSUM_WINDOW), offset)
+        return [self.path, self.mailbox, self.size, self.mtime, self.head_sum, tail_sum, offset]
+
+"""
+ * getResumeOffset
+ *
+ * Work out where migration of an mbox file should start from its saved
+ * folder_state.  Unchanged files are recognised by size and modification
+ * time alone, without being opened.  Files that have only been appended to
+ * since, which is how Thunderbird normally grows them, are recognised by
+ * their head and checkpoint checksums and resume at the checkpoint.  Any
+ * other change starts migration from the beginning.  Maildir folders are
+ * treated the same way, as laid out by MaildirReader; the modification time
+ * is that of their cur and tmp subfolders.
+ *
+ * Args:
+ *     conn: database connection handle
+ *     path: path to MBOX file or maildir folder
+ *
+ * Returns:
+ *     byte offset to start from, or None if the file is unchanged and was
+ *     fully migrated
+"""
+def getResumeOffset(conn, path):
+    row = conn.execute("SELECT size, mtime, head_sum, tail_sum, offset FROM folder_state WHERE path = ?", [path]).fetchone()
+    if row is None:
+        return 0
+    size, mtime, head_sum, tail_sum, offset = row
+
+    if os.path.isdir(path):
+        # maildir folder, as laid out by MaildirReader
+        folder = MaildirReader(path)
+        if folder.size == size and folder.mtime == mtime:
+            return None if offset >= size else offset
+        if folder.size < offset:
+            return 0
+        head = folder.data[0:min(size, CHECKSUM_WINDOW)]
+        tail = folder.data[max(0, offset - CHECKSUM_WINDOW):offset]
+        folder.close()
+    else:
+        stat = os.stat(path)
+        if stat.st_size == size and stat.st_mtime == mtime:
+            return None if offset >= size else offset
+        if stat.st_size < offset:
+            return 0
+
+        fh = open(path, 'rb')
+        try:
+            head = fh.read(min(size, CHECKSUM_WINDOW))
+            fh.seek(max(0, offset - CHECKSUM_WINDOW))
+            tail = fh.read(offset - max(0, offset - CHECKSUM_WINDOW))
+        finally:
+            fh.close()
+
+    if checksum(head, 0, len(head)) == head_sum and checksum(tail, 0, len(tail)) == tail_sum:
+        return offset
+    return 0
+
+"""
+ * messageHash
+ *
+ * 64-bit hash of a Message-ID, as a signed integer so SQLite can store it.
+ *
+ * Args:
+ *     message_id: Message-ID header value
+ *
+ * Returns:
+ *     hash value, or None for messages without a Message-ID, which older
+ *     versions recorded with a NULL message_id
+"""
+def messageHash(message_id):
+    if message_id is None:
+        return None
+    if isinstance(message_id, unicode):
+        message_id = message_id.encode('utf-8')
+    return struct.unpack('<q', hashlib.md5(message_id).digest()[:8])[0]
+
+"""
+ * MessageIndex class
+ *
+ * Compact index of the Message-IDs already migrated from a mailbox.  Only a
+ * sorted array of 64-bit Message-ID hashes is held in memory, 8 bytes per
+ * message; the google id is read through the ledger when a hash matches, so
+ * a hash collision costs one query and is never mistaken for an upload.
+ * Message-IDs recorded during the run are kept in a set, which is merged
+ * into the array once it holds a quarter as many hashes.
+ *
+"""
+class MessageIndex(object):
+    MERGE_MIN = 65536
+
+    def __init__(self, mailbox, hashes):
+        self.mailbox = mailbox
+        self.hashes = hashes
+        self.added = set()
+
+    def __len__(self):
+        return len(self.hashes) + len(self.added)
+
+    def __contains__(self, message_id):
+        # true for every migrated Message-ID, and rarely for a colliding one
+        if message_id is None:
+            return False
+        key = messageHash(message_id)
+        if key in self.added:
+            return True
+        i = bisect.bisect_left(self.hashes, key)
+        return i < len(self.hashes) and self.hashes[i] == key
+
+    def get(self, ledger, message_id):
+        # google id of a migrated message or None
+        if message_id not in self:
+            return None
+        return ledger.getMessage(self.mailbox, message_id)
+
+    def record(self, ledger, message_id, google_id):
+        # save a migrated message
+        ledger.recordMessage(self.mailbox, message_id, google_id)
+        self.added.add(messageHash(message_id))
+        if len(self.added) >= max(self.MERGE_MIN, len(self.hashes) / 4):
+            self.hashes = array.array(self.hashes.typecode, heapq.merge(self.hashes, sorted(self.added)))
+            self.added = set()
+
+"""
+ * getMigrateMessageInfo
+ *
+ * Retrieves the MessageIndex of messages that have already been migrated
+ * from this mailbox.  The hashes are read from the database index in order,
+ * a few thousand rows at a time.
+ *
+ * Args:
+ *     conn: database connection handler
+ *     mailbox : mailbox associated with messages
+ *     redoall: indicates whether to remove all message info and migrate all messages again
+ *
+ * Returns:
+ *     MessageIndex
+"""
+MESSAGE_FETCH_SIZE = 10000
+
+def getMigrateMessageInfo(conn,mailbox,redoall):
+    c = conn.cursor()
+
+    if redoall:
+        c.execute("DELETE FROM content_hash where google_id IN (SELECT google_id FROM message_info where mailbox = ?)", [mailbox])
+        c.execute("DELETE FROM message_info where mailbox = ?", [mailbox])
+        c.execute("DELETE FROM folder_state where mailbox = ?", [mailbox])
+        conn.commit()
+
+    # retrieve message-id hashes
+    hashes = array.array('l')
+    c.execute("SELECT message_hash FROM message_info WHERE mailbox = ? AND message_hash IS NOT NULL "
+              "ORDER BY message_hash", [mailbox])
+    while True:
+        rows = c.fetchmany(MESSAGE_FETCH_SIZE)
+        if not rows:
+            break
+        hashes.extend(row[0] for row in rows)
+
+    return MessageIndex(mailbox, hashes)
+
+"""
+ * getAuthCredentials
+ *
+ * Gets a credentials object that can be used to authorize a service object
+ *
+ * Args:
+ *     conn: database connection handler
+ *     reauth: indicates whether to remove all message-id and migrate all messages again
+ *     token_file: optional file holding the refresh token to use
+ *     batch: when set, exit instead of asking for authorization
+ *
+"""
+def getAuthCredentials(conn,reauth,token_file=None,batch=False):
+    c = conn.cursor()
+
+    # does config table exist?
+    c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = ? AND name = ?", ["table", "config"])
+    if c.fetchone()[0] > 0:
+        # config table exists, retrieve refresh_token if it exists
+        c.execute("SELECT * FROM config WHERE name='refresh_token'")
+        result = c.fetchone()
+    else:
+        result = None
+
+    if token_file is not None:
+        # refresh token handed over from elsewhere replaces the saved one
+        try:
+            fh = open(token_file)
+            try:
+                result = ('refresh_token', fh.read().strip())
+            finally:
+                fh.close()
+        except IOError, error:
+            sys.exit("Cannot read token file {0}: {1}".format(token_file, error))
+        if getConfig(conn, 'refresh_token') != result[1]:
+            # the saved access token belongs to the old refresh token
+            conn.execute("DELETE FROM config WHERE name IN ('access_token', 'token_expiry')")
+        setConfig(conn, 'refresh_token', result[1])
+        reauth = False
+
+    # retrieve refresh token, if one exists
+    if (result is None or reauth) and batch:
+        logging.info('Authorization Failed!')
+        sys.exit("No refresh token in {0}.  Authorize once without --batch or use --token-file.".format(DATABASE))
+    if result is None or reauth:
+        # no refresh token.  need to get authorized.
+
+        # get user authorization URL
+        flow = oauth2.OAuth2WebServerFlow(CLIENT_ID, CLIENT_SECRET, " ".join(SCOPES), redirect_uri="http://127.0.0.1:8000")
+        auth_uri = flow.step1_get_authorize_url()
+
+        print("\nLaunching your preferred web browser to continue sign-in at")
+        print("your account provider website.  When you have granted access,")
         print("please return here to continue.")
         
         # open authorization url in preferred browser
@@ -266,183 +1593,3044 @@ def getAuthCredentials(conn,reauth):
         httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 8000), CustomHandler)
         httpd.handle_request()
 
-        if auth_code:
-            # retrieve authorization credentials using auth code
-            credentials = flow.step2_exchange(auth_code)
-            refresh_token = credentials.refresh_token
-            print("\n\nAuthorization completed.\n")
-        else:
-            print("\nNo authorization code!")
-            logging.info('Authorization Failed!')
-            sys.exit("Exiting...")
+        if auth_code:
+            # retrieve authorization credentials using auth code
+            credentials = SharedCredentials.from_json(flow.step2_exchange(auth_code).to_json())
+            refresh_token = credentials.refresh_token
+            print("\n\nAuthorization completed.\n")
+        else:
+            print("\nNo authorization code!")
+            logging.info('Authorization Failed!')
+            sys.exit("Exiting...")
+
+        # create `config` table
+        conn.execute("CREATE TABLE IF NOT EXISTS config (name text unique, value text)")
+
+        # insert refresh_token into `config` table
+        conn.execute("INSERT OR REPLACE INTO config (name, value) VALUES ('refresh_token','{0}')".format(refresh_token))
+
+        # save changes
+        conn.commit()
+        saveAccessToken(credentials)
+    else:
+        refresh_token = result[1]
+        access_token, token_expiry = loadAccessToken(conn)
+        credentials = SharedCredentials(access_token, CLIENT_ID,
+                                   CLIENT_SECRET, refresh_token, token_expiry,
+                                   oauth2client.GOOGLE_TOKEN_URI, None,
+                                   revoke_uri=oauth2client.GOOGLE_REVOKE_URI,
+                                   id_token=None,
+                                   token_response=None)
+
+    return credentials
+    
+"""
+ * getHeader
+ *
+ * Get the value of a header from a raw header block without parsing the
+ * rest of the message.  Folded header lines are unfolded and surrounding
+ * whitespace is removed, so a value folded onto its own line compares equal
+ * to the same value written on the header line.
+ *
+ * Args:
+ *     header_block: raw message header block
+ *     name: header name
+ *
+ * Returns:
+ *     Header value or None if the header is not present.
+"""
+def getHeader(header_block, name):
+    match = re.search(r'^' + re.escape(name) + r'[ \t]*:[ \t]*(.*(?:\r?\n[ \t].*)*)',
+                      header_block, re.IGNORECASE | re.MULTILINE)
+    if match is None:
+        return None
+    return re.sub(r'\r?\n[ \t]+', ' ', match.group(1)).strip()
+
+"""
+ * FileBuffer class
+ *
+ * Sliceable stand-in for a memory-mapped file.  Each slice is an ordinary
+ * read from a file handle opened for just that read, so any number of
+ * threads can slice one FileBuffer, and data read from it is freed as soon
+ * as it has been used instead of staying mapped into the process.
+ *
+"""
+class FileBuffer(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __getitem__(self, key):
+        fh = open(self.path, 'rb')
+        try:
+            fh.seek(key.start)
+            return fh.read(max(0, key.stop - key.start))
+        finally:
+            fh.close()
+
+"""
+ * MessageView class
+ *
+ * Read-only file object over a message stored in a larger buffer, such as a
+ * memory-mapped mbox file or a FileBuffer.  The message is described as a list of
+ * (start, end) byte ranges within the buffer so that header lines can be
+ * left out without copying or re-encoding the rest of the message.  Only the
+ * bytes asked for by each read() are copied.
+ *
+"""
+class MessageView(object):
+    def __init__(self, data, segments):
+        self.data = data
+        self.segments = segments
+        self.length = sum(end - start for start, end in segments)
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0 or self.pos + size > self.length:
+            size = self.length - self.pos
+        chunks = []
+        pos = 0
+        for start, end in self.segments:
+            if size <= 0:
+                break
+            seglen = end - start
+            if self.pos < pos + seglen:
+                begin = start + max(0, self.pos - pos)
+                stop = min(end, begin + size)
+                chunks.append(self.data[begin:stop])
+                size -= stop - begin
+                self.pos += stop - begin
+            pos += seglen
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.pos = min(max(0, offset), self.length)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        pass
+
+"""
+ * spliceHeaders
+ *
+ * Work out the byte ranges of a message that remain once some header lines
+ * are left out.
+ *
+ * Args:
+ *     record: MboxRecord of the message
+ *     names: lower case names of the headers to leave out
+ *
+ * Returns:
+ *     list of (start, end) byte ranges relative to the start of the buffer
+ *     holding the message
+"""
+def spliceHeaders(record, names):
+    segments = []
+    start = record.offset
+    skipping = False
+    pos = 0
+    headers = record.headers
+    while pos < len(headers):
+        eol = headers.find('\n', pos)
+        eol = len(headers) if eol == -1 else eol + 1
+        if headers[pos] in ' \t':
+            # folded continuation line belongs to the previous header
+            drop = skipping
+        else:
+            name = headers[pos:eol].split(':', 1)[0].strip().lower()
+            drop = skipping = name in names
+        if drop and start < record.offset + pos:
+            segments.append((start, record.offset + pos))
+        if drop:
+            start = record.offset + eol
+        pos = eol
+    if start < record.offset + record.length:
+        segments.append((start, record.offset + record.length))
+    return segments
+
+"""
+ * contentHash
+ *
+ * Hash identifying a message's content: its key headers, whitespace and case
+ * normalized, and its body with line endings normalized.  The same message
+ * stored in several folders or mailboxes has the same hash, whether or not it
+ * has a usable Message-ID.
+ *
+ * Args:
+ *     data: buffer holding the message, such as a memory-mapped mbox file
+ *     record: MboxRecord of the message
+ *
+ * Returns:
+ *     hex digest
+"""
+def contentHash(data, record):
+    digest = hashlib.sha1()
+    for name in CONTENT_HASH_HEADERS:
+        value = getHeader(record.headers, name) or ''
+        digest.update(name + ':' + ' '.join(value.split()).lower() + '\n')
+
+    pos = record.offset + record.header_length
+    end = record.offset + record.length
+    carry = ''
+    while pos < end:
+        chunk = carry + data[pos:min(end, pos + 1048576)]
+        pos += 1048576
+        carry = ''
+        if chunk.endswith('\r') and pos < end:
+            # keep a split CRLF together
+            carry = '\r'
+            chunk = chunk[:-1]
+        digest.update(chunk.replace('\r\n', '\n'))
+    digest.update(carry)
+
+    return digest.hexdigest()
+
+"""
+ * MboxRecord class
+ *
+ * Location of a single message within an mbox file.
+ *
+ *     start: byte offset of the message's "From " line
+ *     stop: byte offset of the next message's "From " line, or the file size
+ *     offset: byte offset of the message, just past its "From " line
+ *     length: length of the message in bytes
+ *     header_length: length of the message header block in bytes
+ *     headers: raw message header block
+ *
+"""
+class MboxRecord(object):
+    __slots__ = ('start', 'stop', 'offset', 'length', 'header_length', 'headers')
+
+    def __init__(self, start, stop, offset, length, header_length, headers):
+        self.start = start
+        self.stop = stop
+        self.offset = offset
+        self.length = length
+        self.header_length = header_length
+        self.headers = headers
+
+"""
+ * MboxReader class
+ *
+ * Streaming mbox reader.  The mbox file is memory-mapped and split on
+ * "From " lines in a single sequential pass, keeping only a byte-offset
+ * index of where each message starts.  Iterating yields an MboxRecord per
+ * message holding just its header block; message bodies are only read when
+ * asked for, so memory use stays flat regardless of mailbox size.
+ *
+ * Reading can start part way into the file at the byte offset of a
+ * "From " line, which is how interrupted and appended folders are resumed,
+ * and can end before the end of the file at another "From " line.
+ *
+"""
+class MboxReader(object):
+    def __init__(self, file, start=0, end=None):
+        self.path = file
+        self.fh = open(file, 'rb')
+        stat = os.fstat(self.fh.fileno())
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.start = start
+        self.end = self.size if end is None else min(end, self.size)
+        if self.size > 0:
+            self.data = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # empty files cannot be memory-mapped
+            self.data = ''
+        self.offsets = None
+
+    def index(self):
+        # find the start of every "From " line
+        if self.offsets is not None:
+            return self.offsets
+        offsets = array.array('L')
+        data = self.data
+        if self.start < self.end and data[self.start:self.start + 5] == 'From ':
+            offsets.append(self.start)
+        pos = data.find('\nFrom ', self.start, self.end)
+        while pos != -1:
+            offsets.append(pos + 1)
+            pos = data.find('\nFrom ', pos + 1, self.end)
+        self.offsets = offsets
+        return offsets
+
+    def __len__(self):
+        return len(self.index())
+
+    def __iter__(self):
+        for start, stop in self.spans():
+            yield self.record(start, stop)
+
+    def spans(self):
+        # (start, stop) byte offsets of every message, without reading them
+        offsets = self.index()
+        count = len(offsets)
+        for n in xrange(count):
+            yield offsets[n], offsets[n + 1] if n + 1 < count else self.end
+
+    def starts(self):
+        # byte offsets of every message
+        return self.index()
+
+    def token(self, start):
+        # key of the message in the folder's summary file
+        return start
+
+    def record(self, start, stop):
+        # MboxRecord of the message between two "From " lines
+        data = self.data
+        end = stop
+
+        # skip "From " line
+        offset = data.find('\n', start, end)
+        offset = end if offset == -1 else offset + 1
+
+        # drop the line separator that precedes the next "From " line
+        if end > offset and data[end - 1] == '\n':
+            end -= 1
+            if end > offset and data[end - 1] == '\r':
+                end -= 1
+
+        # header block ends at the first empty line
+        header_end = data.find('\n\n', offset, end)
+        header_end = end if header_end == -1 else header_end + 1
+        crlf_end = data.find('\r\n\r\n', offset, end)
+        if crlf_end != -1 and crlf_end + 2 < header_end:
+            header_end = crlf_end + 2
+
+        return MboxRecord(start, stop, offset, end - offset, header_end - offset, data[offset:header_end])
+
+    def read(self, record):
+        # return the full raw message
+        return self.data[record.offset:record.offset + record.length]
+
+    def buffer(self, record):
+        # buffer to read the message from: the memory map, or plain file
+        # reads for messages larger than STREAM_THRESHOLD
+        if record.length > STREAM_THRESHOLD:
+            return FileBuffer(self.fh.name)
+        return self.data
+
+    def view(self, record, drop_headers=()):
+        # return a file object over the raw message without copying it,
+        # leaving out the given header lines
+        return MessageView(self.buffer(record), spliceHeaders(record, drop_headers))
+
+    def close(self):
+        if self.size > 0:
+            self.data.close()
+        self.fh.close()
+
+"""
+ * isMaildir
+ *
+ * Args:
+ *     path: path to a directory within the mail folder tree
+ *
+ * Returns:
+ *     True if the directory is a Thunderbird maildir folder, which holds
+ *     one file per message in its cur and tmp subfolders.  Subfolder
+ *     directories (.sbd) never are.
+"""
+def isMaildir(path):
+    return not path.endswith('.sbd') and os.path.isdir(os.path.join(path, 'cur'))
+
+"""
+ * listMaildir
+ *
+ * List the message files of a maildir folder, with scandir when it is
+ * available.  Empty files are left out.
+ *
+ * Args:
+ *     path: path to maildir folder
+ *
+ * Returns:
+ *     list of (file name, subfolder number, size) tuples sorted by file name
+"""
+def listMaildir(path):
+    files = []
+    for n, subdir in enumerate(MAILDIR_SUBDIRS):
+        directory = os.path.join(path, subdir)
+        if not os.path.isdir(directory):
+            continue
+        if scandir is not None:
+            for entry in scandir(directory):
+                if entry.is_file():
+                    files.append((entry.name, n, entry.stat().st_size))
+        else:
+            for name in os.listdir(directory):
+                file = os.path.join(directory, name)
+                if os.path.isfile(file):
+                    files.append((name, n, os.path.getsize(file)))
+    files = [entry for entry in files if entry[2] > 0]
+    files.sort()
+    return files
+
+"""
+ * MaildirData class
+ *
+ * Sliceable view of a maildir folder's message files as if they were one
+ * file, in the order MaildirReader puts them.  It is only used for the
+ * checksums of FolderCheckpoint, so each slice opens the files it covers.
+ *
+"""
+class MaildirData(object):
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __getitem__(self, key):
+        reader = self.reader
+        chunks = []
+        pos = key.start
+        n = bisect.bisect_right(reader.offsets, pos) - 1
+        while pos < key.stop and 0 <= n < len(reader.names):
+            end = min(key.stop, reader.stop(n))
+            try:
+                fh = open(reader.file(n), 'rb')
+                try:
+                    fh.seek(pos - reader.offsets[n])
+                    chunks.append(fh.read(end - pos))
+                finally:
+                    fh.close()
+            except (IOError, OSError):
+                pass
+            pos = end
+            n += 1
+        return ''.join(chunks)
+
+"""
+ * MaildirReader class
+ *
+ * Reader of a Thunderbird maildir folder with the same interface as
+ * MboxReader, so the folder goes through the same upload, ledger, resume and
+ * skip handling.  The message files, sorted by name, are given consecutive
+ * byte ranges as if they had been concatenated into an mbox file; those
+ * offsets are what checkpoints and the retry queue record.  Message files
+ * are read ahead by MAILDIR_READERS threads while migration works through
+ * them in order.  Files up to STREAM_THRESHOLD bytes are read whole, larger
+ * ones only as far as the end of their header block.
+ *
+"""
+class MaildirReader(object):
+    def __init__(self, path, start=0, end=None):
+        self.path = path
+        self.start = start
+        self.mtime = max(os.path.getmtime(os.path.join(path, subdir)) for subdir in MAILDIR_SUBDIRS
+                         if os.path.isdir(os.path.join(path, subdir)))
+        self.names = []
+        self.subdirs = array.array('B')
+        self.offsets = array.array('L')
+        self.size = 0
+        for name, subdir, size in listMaildir(path):
+            self.names.append(name)
+            self.subdirs.append(subdir)
+            self.offsets.append(self.size)
+            self.size += size
+        self.end = self.size if end is None else min(end, self.size)
+        self.data = MaildirData(self)
+        self.current = None
+
+    def file(self, n):
+        return os.path.join(self.path, MAILDIR_SUBDIRS[self.subdirs[n]], self.names[n])
+
+    def stop(self, n):
+        return self.offsets[n + 1] if n + 1 < len(self.names) else self.size
+
+    def first(self):
+        # number of the first message at or after the start offset
+        return bisect.bisect_left(self.offsets, self.start)
+
+    def last(self):
+        # number of the first message at or after the end offset
+        return bisect.bisect_left(self.offsets, self.end)
+
+    def __len__(self):
+        return self.last() - self.first()
+
+    def __iter__(self):
+        for start, stop in self.spans():
+            yield self.record(start, stop)
+
+    def spans(self):
+        # (start, stop) offsets of every message, while the files are read
+        # ahead in parallel.  Files that have disappeared are left out.
+        count = self.last()
+        ahead = self.first()
+        pending = collections.deque()
+        pool = multiprocessing.pool.ThreadPool(MAILDIR_READERS)
+        try:
+            for n in xrange(self.first(), count):
+                while ahead < count and len(pending) < MAILDIR_READERS * 2:
+                    pending.append(pool.apply_async(self.load, (ahead,)))
+                    ahead += 1
+                # wait with a timeout so that Ctrl-C still gets through
+                result = pending.popleft()
+                while not result.ready():
+                    result.wait(1)
+                loaded = result.get()
+                if loaded is None:
+                    continue
+                self.current = loaded
+                yield self.offsets[n], self.stop(n)
+        finally:
+            pool.terminate()
+            self.current = None
+
+    def load(self, n):
+        # (record, contents) of message n; contents is None for files
+        # larger than STREAM_THRESHOLD
+        try:
+            fh = open(self.file(n), 'rb')
+            try:
+                size = os.fstat(fh.fileno()).st_size
+                if size <= STREAM_THRESHOLD:
+                    contents = head = fh.read()
+                else:
+                    contents = None
+                    head = fh.read(CHECKSUM_WINDOW)
+                    while '\n\n' not in head and '\r\n\r\n' not in head and len(head) < size:
+                        chunk = fh.read(CHECKSUM_WINDOW)
+                        if not chunk:
+                            break
+                        head += chunk
+            finally:
+                fh.close()
+        except (IOError, OSError):
+            return None
+
+        # Thunderbird may begin the file with a "From " line
+        offset = 0
+        if head.startswith('From '):
+            offset = head.find('\n')
+            offset = len(head) if offset == -1 else offset + 1
+
+        # header block ends at the first empty line
+        header_end = head.find('\n\n', offset)
+        header_end = len(head) if header_end == -1 else header_end + 1
+        crlf_end = head.find('\r\n\r\n', offset)
+        if crlf_end != -1 and crlf_end + 2 < header_end:
+            header_end = crlf_end + 2
+
+        record = MboxRecord(self.offsets[n], self.stop(n), offset, size - offset, header_end - offset,
+                            head[offset:header_end])
+        return record, contents
+
+    def starts(self):
+        # byte offsets of every message, without reading them
+        return self.offsets[self.first():self.last()]
+
+    def token(self, start):
+        # key of the message in the folder's summary file: its file name
+        return self.names[bisect.bisect_left(self.offsets, start)]
+
+    def record(self, start, stop):
+        # MboxRecord of the message at the start offset, or None if there is
+        # no such message
+        if self.current is not None and self.current[0].start == start:
+            return self.current[0]
+        n = bisect.bisect_left(self.offsets, start)
+        if n == len(self.names) or self.offsets[n] != start or self.stop(n) != stop:
+            return None
+        loaded = self.load(n)
+        if loaded is None:
+            return None
+        self.current = loaded
+        return loaded[0]
+
+    def read(self, record):
+        # return the full raw message
+        return self.buffer(record)[record.offset:record.offset + record.length]
+
+    def buffer(self, record):
+        # buffer to read the message from: the contents read ahead, or plain
+        # file reads for messages larger than STREAM_THRESHOLD.  Record
+        # offsets are relative to the message file.
+        if self.current is not None and self.current[0] is record and self.current[1] is not None:
+            return self.current[1]
+        return FileBuffer(self.file(bisect.bisect_left(self.offsets, record.start)))
+
+    def view(self, record, drop_headers=()):
+        # return a file object over the raw message, leaving out the given
+        # header lines
+        return MessageView(self.buffer(record), spliceHeaders(record, drop_headers))
+
+    def close(self):
+        self.current = None
+
+"""
+ * openFolder
+ *
+ * Args:
+ *     path: path to MBOX file or maildir folder
+ *     start: byte offset to start reading from
+ *     end: byte offset to stop reading at, or None for the end of the folder
+ *
+ * Returns:
+ *     MboxReader or MaildirReader for the folder
+"""
+def openFolder(path, start=0, end=None):
+    if os.path.isdir(path):
+        return MaildirReader(path, start, end)
+    return MboxReader(path, start, end)
+
+"""
+ * folderSize
+ *
+ * Args:
+ *     path: path to MBOX file or maildir folder
+ *
+ * Returns:
+ *     size of the MBOX file, or total size of the maildir folder's messages
+"""
+def folderSize(path):
+    if os.path.isdir(path):
+        return sum(size for name, subdir, size in listMaildir(path))
+    return os.path.getsize(path)
+
+"""
+ * MORK_TOKEN
+ *
+ * Tokens of the Mork text format of Thunderbird's .msf summary files:
+ * dictionary, row and table brackets, cells with their escapes, group
+ * markers, comments and bare ids.
+ *
+"""
+MORK_TOKEN = re.compile(r'\s*(?://[^\n]*|@\$\$[{}][^@]*@|\((?:[^)\\]|\\.)*\)|[<>\[\]{}]|[^\s()<>\[\]{}]+)', re.S)
+MORK_ESCAPE = re.compile(r'\\\r?\n|\\(.)|\$([0-9A-Fa-f]{2})', re.S)
+
+"""
+ * morkValue
+ *
+ * Args:
+ *     text: escaped Mork cell value
+ *
+ * Returns:
+ *     value with escapes and line continuations removed
+"""
+def morkValue(text):
+    def unescape(match):
+        if match.group(2) is not None:
+            return chr(int(match.group(2), 16))
+        return match.group(1) or ''
+    return MORK_ESCAPE.sub(unescape, text)
+
+"""
+ * parseMork
+ *
+ * Read the rows of a Mork file.  Dictionaries of column names and atoms are
+ * resolved, and later updates to a row are merged into it.  A row update
+ * outside any table that gives no scope belongs to the current row scope,
+ * that of the row before it.
+ *
+ * Args:
+ *     text: contents of the Mork file
+ *
+ * Returns:
+ *     dictionary of (row scope, row id) to a dictionary of column name to
+ *     value
+"""
+def parseMork(text):
+    columns = {}
+    atoms = {}
+    rows = {}
+    dict_depth = 0
+    dict_scope = 'a'
+    table_depth = 0
+    table_scope = None
+    table_pending = False
+    row = None
+    row_scope = None
+    row_pending = False
+
+    def scopeOf(row_id, default):
+        # split "id:scope" and resolve the scope
+        if ':' not in row_id:
+            return row_id, default
+        row_id, scope = row_id.split(':', 1)
+        if scope.startswith('^'):
+            scope = columns.get(scope[1:].upper(), scope)
+        return row_id, scope
+
+    for match in MORK_TOKEN.finditer(text):
+        token = match.group().strip()
+        if not token or token.startswith('//') or token.startswith('@$$'):
+            continue
+        if token == '<':
+            dict_depth += 1
+            if dict_depth == 1:
+                dict_scope = 'a'
+        elif token == '>':
+            dict_depth = max(0, dict_depth - 1)
+        elif dict_depth > 0:
+            if token.startswith('(') and '=' in token:
+                key, value = token[1:-1].split('=', 1)
+                if dict_depth > 1:
+                    # dictionary meta, e.g. (a=c) for the column dictionary
+                    if key == 'a':
+                        dict_scope = value
+                elif dict_scope == 'c':
+                    columns[key.upper()] = morkValue(value)
+                else:
+                    atoms[key.upper()] = morkValue(value)
+        elif token == '{':
+            table_depth += 1
+            table_pending = table_depth == 1
+        elif token == '}':
+            table_depth = max(0, table_depth - 1)
+            if table_depth == 0:
+                table_scope = None
+        elif token == '[':
+            row_pending = True
+        elif token == ']':
+            row = None
+        elif row_pending:
+            row_pending = False
+            cut = token.startswith('-')
+            row_id, scope = scopeOf(token.lstrip('-'), table_scope)
+            if scope is None:
+                scope = row_scope
+            row_scope = scope
+            key = (scope, row_id.upper())
+            if cut or key not in rows:
+                rows[key] = {}
+            row = rows[key]
+        elif table_pending:
+            table_pending = False
+            table_scope = scopeOf(token.lstrip('-'), None)[1]
+        elif row is not None and token.startswith('('):
+            cell = token[1:-1]
+            if cell.startswith('^'):
+                end = 1
+                while end < len(cell) and cell[end] not in '=^':
+                    end += 1
+                name = columns.get(cell[1:end].upper(), cell[1:end])
+                cell = cell[end:]
+            else:
+                name, _, cell = cell.partition('=')
+                cell = '=' + cell
+            if cell.startswith('^'):
+                row[name] = atoms.get(cell[1:].upper(), '')
+            elif cell.startswith('='):
+                row[name] = morkValue(cell[1:])
+    return rows
+
+"""
+ * readSummary
+ *
+ * Read the flags and Message-IDs of the messages of an mbox file or maildir
+ * folder from the .msf summary file Thunderbird keeps next to it.  A summary
+ * written before the folder last changed is stale and is not used.  Rows
+ * that give neither the message's storeToken nor its msgOffset are left
+ * out, since their row id is not a byte offset in IMAP folders.
+ *
+ * Args:
+ *     path: path to MBOX file or maildir folder
+ *     mtime: modification time of the folder
+ *
+ * Returns:
+ *     dictionary of the byte offset of each message's "From " line, or the
+ *     message's file name in a maildir folder, to its (flags, Message-ID)
+ *     tuple.  Message-ID is None if the summary does not hold the message's
+ *     real Message-ID.
+"""
+def readSummary(path, mtime):
+    summary = {}
+    try:
+        if os.path.getmtime(path + '.msf') < mtime:
+            return summary
+        fh = open(path + '.msf', 'rb')
+        try:
+            text = fh.read()
+        finally:
+            fh.close()
+    except (IOError, OSError):
+        return summary
+
+    started = time.time()
+    for (scope, row_id), row in parseMork(text).items():
+        if scope is not None and ':msgs:' not in scope:
+            # folder info and thread rows
+            continue
+        if 'message-id' not in row and 'flags' not in row:
+            continue
+        try:
+            if 'storeToken' in row:
+                # the file name of a message in a maildir folder
+                offset = row['storeToken']
+                if offset.isdigit():
+                    offset = int(offset)
+            elif 'msgOffset' in row:
+                offset = int(row['msgOffset'], 16)
+            else:
+                # the row id is only a message key, e.g. the IMAP UID of a
+                # message not stored offline
+                continue
+            flags = int(row.get('flags') or '0', 16)
+        except ValueError:
+            continue
+        message_id = row.get('message-id')
+        if not message_id or message_id.startswith('md5:'):
+            # Thunderbird makes one up for messages without a Message-ID
+            message_id = None
+        else:
+            message_id = '<' + message_id + '>'
+        summary[offset] = (flags, message_id)
+    metrics.observe('summary', time.time() - started)
+    return summary
+
+"""
+ * isUnread
+ *
+ * Args:
+ *     status: message flags, from the X-Mozilla-Status header or the
+ *             summary file, which also hold flags such as Offline, Marked
+ *             and HasRe
+ *
+ * Returns:
+ *     True if the message's Read flag is not set
+"""
+MSG_FLAG_READ = 0x1
+
+def isUnread(status):
+    return not status & MSG_FLAG_READ
+
+"""
+ * buildHttp
+ *
+ * Create the httplib2.Http object for API requests.  Newer httplib2 releases
+ * follow 308 as a redirect, but the resumable upload protocol answers each
+ * partial chunk with a 308 and no Location, so it is taken out of the
+ * redirect codes.
+ *
+ * Returns:
+ *     httplib2.Http object
+"""
+def buildHttp():
+    http = httplib2.Http()
+    if hasattr(http, 'redirect_codes'):
+        http.redirect_codes = http.redirect_codes - set([308])
+    return http
+
+"""
+ * ConnectionPool class
+ *
+ * Thread safe stand-in for httplib2.Http.  Each request borrows an idle
+ * httplib2.Http object, which keeps its connection to Gmail alive between
+ * requests, and returns it afterwards; a new one is only made when all are
+ * busy.  A service object built on a ConnectionPool can be shared by any
+ * number of threads, and the pool never holds more connections than there
+ * were requests in flight at once.
+ *
+"""
+class ConnectionPool(object):
+    def __init__(self):
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def request(self, *args, **kwargs):
+        # borrow the most recently used connection, or open a new one
+        with self.lock:
+            http = self.idle.pop() if self.idle else None
+        if http is None:
+            http = buildHttp()
+        try:
+            return http.request(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.idle.append(http)
+
+"""
+ * LazyClass class
+ *
+ * Stand-in for a class that derives from a LazyModule class.  The class is
+ * made by the given function the first time it is called or one of its
+ * attributes is used.
+ *
+"""
+class LazyClass(object):
+    def __init__(self, make):
+        self.make = make
+        self.cls = None
+
+    def resolve(self):
+        if self.cls is None:
+            self.cls = self.make()
+        return self.cls
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+
+"""
+ * SharedCredentials class
+ *
+ * OAuth2Credentials that can be used by many threads at once.  When the
+ * access token expires every request in flight is rejected at about the
+ * same time; the first thread refreshes the token while the others wait,
+ * then they retry with the new token instead of refreshing it again.  Each
+ * new access token is saved so that the next run can start with it.
+ *
+"""
+def makeSharedCredentials():
+    class SharedCredentials(oauth2.OAuth2Credentials):
+        refresh_lock = threading.Lock()
+        refreshed = 0
+
+        def _refresh(self, http):
+            with self.refresh_lock:
+                if self.access_token is not None and not self.access_token_expired and \
+                   time.time() - self.refreshed < REFRESH_GRACE:
+                    return
+                oauth2.OAuth2Credentials._refresh(self, http)
+                self.refreshed = time.time()
+                saveAccessToken(self)
+
+    return SharedCredentials
+
+SharedCredentials = LazyClass(makeSharedCredentials)
+
+"""
+ * saveAccessToken
+ *
+ * Save the access token and its expiry time in the config table.  Tokens
+ * are refreshed by whichever thread or folder process finds them expired,
+ * so a connection of its own is opened for the write.
+ *
+ * Args:
+ *     credentials: credentials object holding the access token
+"""
+def saveAccessToken(credentials):
+    if credentials.access_token is None or credentials.token_expiry is None:
+        return
+    try:
+        conn = sqlite3.connect(DATABASE)
+        try:
+            conn.executemany("INSERT OR REPLACE INTO config (name, value) VALUES (?,?)",
+                             [('access_token', credentials.access_token),
+                              ('token_expiry', credentials.token_expiry.strftime(TOKEN_EXPIRY_FORMAT))])
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error, error:
+        logging.warning("Cannot save access token: {0}".format(error))
+
+"""
+ * loadAccessToken
+ *
+ * Get the access token saved by an earlier run, unless it expires within
+ * TOKEN_EXPIRY_MARGIN seconds.
+ *
+ * Args:
+ *     conn: database connection handle
+ *
+ * Returns:
+ *     (access_token, token_expiry) tuple, or (None, None) if there is no
+ *     usable saved token.
+"""
+def loadAccessToken(conn):
+    access_token = getConfig(conn, 'access_token')
+    token_expiry = getConfig(conn, 'token_expiry')
+    if access_token is None or token_expiry is None:
+        return None, None
+    try:
+        token_expiry = datetime.datetime.strptime(token_expiry, TOKEN_EXPIRY_FORMAT)
+    except ValueError:
+        return None, None
+    if token_expiry - datetime.datetime.utcnow() < datetime.timedelta(seconds=TOKEN_EXPIRY_MARGIN):
+        return None, None
+    return access_token, token_expiry
+
+"""
+ * isGmailDiscovery
+ *
+ * Check that a discovery document describes the version of the Gmail API
+ * this script was written for.
+ *
+ * Args:
+ *     document: discovery document JSON text
+ *
+ * Returns:
+ *     True if the document can be used to build the service object.
+"""
+def isGmailDiscovery(document):
+    try:
+        description = simplejson.loads(document)
+    except ValueError:
+        return False
+    return isinstance(description, dict) and description.get('name') == 'gmail' and \
+           description.get('version') == 'v1' and 'resources' in description
+
+# Gmail API discovery document, once loaded
+discovery_document = None
+
+"""
+ * loadDiscoveryDocument
+ *
+ * Get the Gmail API discovery document.  The copy in DISCOVERY_CACHE is used
+ * while it is younger than DISCOVERY_TTL and describes the right API
+ * version; otherwise the document is fetched again and the cache replaced.
+ * An out of date cached copy is still used if fetching fails.  The document
+ * is kept in memory, so folder processes started afterwards need not read
+ * it again.
+ *
+ * Returns:
+ *     Discovery document JSON text.
+"""
+def loadDiscoveryDocument():
+    global discovery_document
+
+    if discovery_document is not None:
+        return discovery_document
+
+    # use the cached copy while it is current
+    cached = None
+    try:
+        with open(DISCOVERY_CACHE) as fh:
+            cached = fh.read()
+        if not isGmailDiscovery(cached):
+            cached = None
+        elif time.time() - os.path.getmtime(DISCOVERY_CACHE) < DISCOVERY_TTL:
+            discovery_document = cached
+            return discovery_document
+    except (IOError, OSError):
+        cached = None
+
+    # fetch the document and replace the cached copy
+    try:
+        response, content = buildHttp().request(DISCOVERY_URL)
+        if response.status != 200:
+            raise errors.HttpError(response, content, uri=DISCOVERY_URL)
+        if not isGmailDiscovery(content):
+            raise ValueError("Unexpected discovery document from {0}".format(DISCOVERY_URL))
+    except Exception, error:
+        if cached is None:
+            raise
+        logging.warning("Using out of date discovery document: {0}".format(error))
+        discovery_document = cached
+        return discovery_document
+    # each process writes its own temporary file, so migrations running side
+    # by side never write into the same file; the last rename wins
+    temp_path = '{0}.{1}.tmp'.format(DISCOVERY_CACHE, os.getpid())
+    try:
+        with open(temp_path, 'w') as fh:
+            fh.write(content)
+        os.rename(temp_path, DISCOVERY_CACHE)
+    except (IOError, OSError), error:
+        logging.warning("Cannot cache discovery document: {0}".format(error))
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+    discovery_document = content
+    return discovery_document
+
+"""
+ * buildService
+ *
+ * Create a Gmail API service object on its own ConnectionPool.  The
+ * service object may be shared by several threads.
+ *
+ * Args:
+ *     credentials: credentials object used to authorize requests
+ *
+ * Returns:
+ *     Authorized Gmail API service instance.
+"""
+def buildService(credentials):
+    # Create a pool of httplib2.Http objects to handle our HTTP requests and
+    # authorize it with the credentials.
+    http = credentials.authorize(ConnectionPool())
+
+    # get Gmail API service object
+    return discovery.build_from_document(loadDiscoveryDocument(), http=http)
+
+"""
+ * uploadMessage
+ *
+ * Import a single raw message into the account.  Messages up to
+ * RESUMABLE_THRESHOLD bytes are sent with their metadata in one multipart
+ * request; larger ones use a resumable upload session, which costs an extra
+ * round trip to start but sends the message in upload_chunk_size chunks.
+ *
+ * Args:
+ *     service: Authorized Gmail API service instance.
+ *     fh: file object holding the raw message contents
+ *     labels: list of label ids to assign to the message
+ *
+ * Returns:
+ *     Google id of the imported message.  Any upload error is raised to the
+ *     caller.
+"""
+def uploadMessage(service, fh, labels):
+    try:
+        # find message size
+        fh.seek(0, os.SEEK_END)
+        resumable = fh.tell() > RESUMABLE_THRESHOLD
+        fh.seek(0)
+
+        # create media upload object
+        media = googlehttp.MediaIoBaseUpload( fh, mimetype='message/rfc822', chunksize=upload_chunk_size,
+                                                  resumable=resumable )
+
+        # import message
+        postBody = { "labelIds": labels }
+
+        # create import message request object
+        request = service.users().messages().import_(userId='me', body=postBody, media_body=media, internalDateSource=None,
+                                                     neverMarkSpam=True, processForCalendar=None, deleted=None)
+
+        started = time.time()
+        if resumable:
+            # upload message in resumable chunks
+            response = None
+            while response is None:
+                status, response = request.next_chunk()
+                metrics.count('upload_chunks')
+            metrics.count('upload_resumable')
+        else:
+            # upload message and its metadata in one request
+            response = request.execute()
+            metrics.count('upload_multipart')
+        metrics.observe('upload', time.time() - started)
+    finally:
+        fh.close()
+
+    return response['id']
+
+"""
+ * uploadWithRetry
+ *
+ * Import a single raw message within the quota, retrying transient errors.
+ *
+ * Args:
+ *     service: Authorized Gmail API service instance.
+ *     fh: file object holding the raw message contents
+ *     labels: list of label ids to assign to the message
+ *
+ * Returns:
+ *     Google id of the imported message.  The last error is raised if the
+ *     upload still fails after REQUEST_RETRIES retries.
+"""
+def uploadWithRetry(service, fh, labels):
+    attempt = 0
+    while True:
+        quota.acquire(QUOTA_UNITS['import'])
+        try:
+            google_id = uploadMessage(service, fh, labels)
+            quota.success()
+            return google_id
+        except Exception, error:
+            if not isTransientError(error) or attempt >= REQUEST_RETRIES:
+                raise
+            quota.backoff(attempt, isRateLimitError(error))
+            metrics.count('upload_retries')
+            attempt += 1
+            fh.seek(0)
+
+"""
+ * UploadJob class
+ *
+ * A message to upload.  Once uploaded google_id is set, or error is set to
+ * the exception that made the upload fail.
+ *
+"""
+class UploadJob(object):
+    def __init__(self, msg_number, message_id, subject, labels, file, record, fh):
+        self.msg_number = msg_number
+        self.message_id = message_id
+        self.subject = subject
+        self.labels = labels
+        self.file = file
+        self.record = record
+        self.fh = fh
+        self.footprint = 0
+        self.content_hash = None
+        self.claim = None
+        self.google_id = None
+        self.error = None
+
+    def run(self, service):
+        try:
+            self.google_id = uploadWithRetry(service, self.fh, self.labels)
+        except KeyboardInterrupt:
+            raise
+        except Exception, error:
+            logging.error("Message {0} - Upload Error: {1}".format(self.msg_number, error))
+            metrics.count('upload_errors')
+            self.error = error
+
+"""
+ * uploadFootprint
+ *
+ * Args:
+ *     length: message length in bytes
+ *
+ * Returns:
+ *     bytes held in memory while the message is imported: the message and
+ *     the multipart request built from it, or a single resumable chunk
+"""
+def uploadFootprint(length):
+    if length > RESUMABLE_THRESHOLD:
+        return min(length, upload_chunk_size)
+    return 2 * length
+
+"""
+ * ByteBudget class
+ *
+ * Limit on the message data held in memory by the uploads in flight.  Each
+ * upload reserves its footprint before it is handed to the workers and gives
+ * it back when it finishes, so the mbox parser waits for memory instead of
+ * queueing more large messages.  A reservation larger than the whole budget
+ * is granted once nothing else is reserved, so no message waits forever.
+ *
+"""
+class ByteBudget(object):
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self.condition:
+            while self.used > 0 and self.used + nbytes > self.limit:
+                # wait with a timeout so that the main thread still receives
+                # KeyboardInterrupt
+                self.condition.wait(1)
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self.condition:
+            self.used -= nbytes
+            self.condition.notify_all()
+
+"""
+ * UploadPool class
+ *
+ * Bounded pool of upload worker threads.  The workers share one Gmail API
+ * service object, and with it one pool of keep-alive connections and one
+ * access token.  Worker threads run on small stacks, so a pool of hundreds
+ * of workers costs little more memory than the uploads in flight.
+ * UploadJobs are handed to the workers through a bounded queue so the mbox
+ * parser never runs too far ahead of the uploads, and the finished jobs are
+ * handed back through a second queue so that a single writer (the main
+ * thread) records them in the database.  A ByteBudget keeps the memory held
+ * by queued and running uploads within memory_budget bytes.
+ *
+"""
+class UploadPool(object):
+    def __init__(self, credentials, workers, memory_budget=MEMORY_BUDGET):
+        self.jobs = Queue.Queue(maxsize=workers*2)
+        self.done = Queue.Queue()
+        self.budget = ByteBudget(memory_budget)
+        self.outstanding = 0
+        self.threads = []
+        service = buildService(credentials)
+        stack_size = threading.stack_size(WORKER_STACK_SIZE)
+        try:
+            for n in range(workers):
+                thread = threading.Thread(target=self.work, args=(service,))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            threading.stack_size(stack_size)
+
+    def work(self, service):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            job.run(service)
+            self.budget.release(job.footprint)
+            self.done.put(job)
+
+    def submit(self, job):
+        # blocks while the memory budget is used up or the job queue is full.
+        # A timeout is used so that the main thread still receives
+        # KeyboardInterrupt while waiting.
+        job.footprint = uploadFootprint(job.fh.length)
+        self.budget.acquire(job.footprint)
+        while True:
+            try:
+                self.jobs.put(job, timeout=1)
+                break
+            except Queue.Full:
+                pass
+        self.outstanding += 1
+
+    def results(self, wait=False):
+        # yield finished jobs; when wait is set, yield until every submitted
+        # job has finished
+        while self.outstanding > 0:
+            try:
+                job = self.done.get(block=wait, timeout=1 if wait else None)
+            except Queue.Empty:
+                if wait:
+                    continue
+                break
+            self.outstanding -= 1
+            yield job
+
+    def close(self):
+        for thread in self.threads:
+            self.jobs.put(None)
+
+"""
+ * UploadClaims class
+ *
+ * Message-IDs and content hashes of the messages uploaded in this run.  A
+ * message is claimed before it is handed to the upload workers, and once
+ * the upload has finished the claim is replaced by the message's Gmail id,
+ * or given up if the upload failed.  A copy of the message met while the
+ * claim is held waits for that upload instead of being imported a second
+ * time.  The folder processes of a parallel migration share one store
+ * through a multiprocessing manager.
+ *
+"""
+class UploadClaims(object):
+    PENDING = object()
+
+    def __init__(self, store=None):
+        self.store = {} if store is None else store
+        self.claimed = 0
+
+    def keys(self, job):
+        keys = []
+        if job.message_id is not None:
+            keys.append('message-id:' + job.message_id)
+        if job.content_hash is not None:
+            keys.append('content-hash:' + job.content_hash)
+        return keys
+
+    def claim(self, job):
+        # claim the upload of a message.  Returns None when it is claimed,
+        # otherwise the Gmail id of the copy uploaded in this run or PENDING
+        # while that copy is still uploading.
+        self.claimed += 1
+        token = (os.getpid(), self.claimed)
+        taken = []
+        for key in self.keys(job):
+            value = self.store.setdefault(key, token)
+            if value != token:
+                for key in taken:
+                    self.store.pop(key, None)
+                return value if isinstance(value, basestring) else self.PENDING
+            taken.append(key)
+        job.claim = token
+        return None
+
+    def lookup(self, job):
+        # Gmail id of an uploaded copy of a message, PENDING while a copy is
+        # uploading, or None
+        values = [self.store.get(key) for key in self.keys(job)]
+        for value in values:
+            if isinstance(value, basestring):
+                return value
+        if any(value is not None for value in values):
+            return self.PENDING
+        return None
+
+    def settle(self, job):
+        # publish the Gmail id of a finished upload, or give up the claim of
+        # one that failed
+        for key in self.keys(job):
+            if job.google_id is not None:
+                self.store[key] = job.google_id
+            elif job.claim is not None and self.store.get(key) == job.claim:
+                self.store.pop(key, None)
+
+claims = UploadClaims()
+
+"""
+ * ignoreInterrupt
+ *
+ * Process initializer for helper processes that must outlive a Ctrl-C
+ * handled by the main process.
+ *
+"""
+def ignoreInterrupt():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+"""
+ * recordUpload
+ *
+ * Record the result of a message upload.  Messages that failed with a
+ * transient error are added to the retry queue.
+ *
+ * Args:
+ *     ledger: database Ledger
+ *     job: finished UploadJob
+ *     total_messages: total number of messages in the mbox file
+ *
+ * Returns:
+ *     True if the upload succeeded or was queued for retry, otherwise False
+"""
+def recordUpload(ledger, job, total_messages):
+    global message_info
+
+    # let copies of the message waiting for this upload go on
+    claims.settle(job)
+
+    if job.google_id is None:
+        if job.error is not None and isTransientError(job.error):
+            ledger.queueRetry(mailroot, job)
+            logging.info("Message {0} of {1} - Upload Failed - Queued for Retry".format(job.msg_number,total_messages))
+            return True
+        logging.error("Message {0} of {1} - Upload Failed!".format(job.msg_number,total_messages))
+        return False
+
+    # messages without a Message-ID can only be found by content hash
+    if job.message_id is not None:
+        message_info.record(ledger,job.message_id,job.google_id)
+    if job.content_hash is not None:
+        ledger.recordContentHash(job.content_hash,job.google_id)
+    ledger.recordLabels(job.google_id,job.labels)
+    logging.info('Message {0} of {1} - "{2}"- Upload Complete'.format(job.msg_number,total_messages,job.subject))
+    return True
+
+"""
+ * recordFinishedUploads
+ *
+ * Record the uploads an UploadPool has already finished, without waiting
+ * for the others, so that the messages of an interrupted run are not
+ * imported again by the next one.
+ *
+ * Args:
+ *     pool: UploadPool or None
+ *     ledger: database Ledger
+"""
+def recordFinishedUploads(pool, ledger):
+    if pool is None:
+        return
+    for job in pool.results():
+        if job.google_id is not None:
+            recordUpload(ledger, job, '?')
+
+"""
+ * LabelReconciler class
+ *
+ * Checks that messages which have already been uploaded carry all of their
+ * labels.  Missing labels are worked out from the label cache whenever the
+ * message's labels are cached, so the API is only called when labels need
+ * adding.  Messages that are not cached are checked through the Gmail API
+ * batch endpoint, up to 50 messages.get calls per batch.  Missing labels are
+ * added with messages.batchModify grouped by the set of labels to add.
+ * Checks and changes that still fail with a transient error after being
+ * retried hold the checkpoint, so the next run tries them again.
+ *
+ * When a FolderCheckpoint is given, the checkpoint is held at each message
+ * whose labels are still to be checked or added, so an interrupted run
+ * resumes at the first message whose label change was not sent.
+ *
+"""
+class LabelReconciler(object):
+    BATCH_SIZE = 50
+    MODIFY_SIZE = 1000
+
+    def __init__(self, service, ledger, total_messages, folder=None):
+        self.service = service
+        self.ledger = ledger
+        self.total_messages = total_messages
+        self.folder = folder
+        self.pending = []
+        self.modifications = {}
+
+    def add(self, msg_number, google_id, labels, start=None):
+        cached_labels = self.ledger.getLabels(google_id)
+        if cached_labels is None:
+            # labels not known locally; ask Gmail
+            self.hold(msg_number, start)
+            self.pending.append((msg_number, google_id, labels))
+            if len(self.pending) >= self.BATCH_SIZE:
+                self.flush()
+            return
+
+        missing_labels = tuple(sorted(item for item in labels if item not in cached_labels))
+        if missing_labels:
+            self.hold(msg_number, start)
+            self.modifications.setdefault(missing_labels, []).append((msg_number, google_id, cached_labels))
+            if len(self.modifications[missing_labels]) >= self.MODIFY_SIZE:
+                self.modify(missing_labels, self.modifications.pop(missing_labels))
+        else:
+            # Message has already been uploaded and no labels need to be added. Skip it.
+            logging.debug("Message {0} of {1} - Already Uploaded - Skipped".format(msg_number,self.total_messages))
+
+    def hold(self, msg_number, start):
+        # keep the checkpoint from moving past a queued message
+        if self.folder is not None:
+            self.folder.hold(msg_number, start)
+
+    def done(self, msg_number, succeeded=True):
+        # label check or change of a held message finished
+        if self.folder is not None:
+            self.folder.end(msg_number, succeeded)
+
+    def check(self):
+        # fetch current labels of all pending messages in one batch request
+        pending = self.pending
+        self.pending = []
+
+        requests = [(str(n), self.service.users().messages().get(userId='me', id=google_id, format='minimal'))
+                    for n, (msg_number, google_id, labels) in enumerate(pending)]
+        started = time.time()
+        try:
+            responses = executeBatch(self.service, requests, QUOTA_UNITS['get'])
+        except (errors.HttpError, socket.error, httplib.HTTPException, httplib2.HttpLib2Error), error:
+            # hold the messages at the checkpoint, to be checked next run
+            logging.error("Label check batch of {0} messages failed: {1}".format(len(pending), error))
+            for msg_number, google_id, labels in pending:
+                self.done(msg_number, False)
+            return
+        metrics.observe('label_check', time.time() - started)
+
+        # group messages by the labels they are missing
+        for n, (msg_number, google_id, labels) in enumerate(pending):
+            response, exception = responses.get(str(n), (None, None))
+            if exception is not None:
+                if isinstance(exception, errors.HttpError) and exception.resp.status == 404:
+                    # Message already uploaded but has been deleted manually
+                    logging.info("Message %s of %s - Already Uploaded and Manually Deleted - Skipped" % (msg_number,self.total_messages))
+                    self.done(msg_number)
+                else:
+                    logging.error("Message %s of %s - Error checking labels: %s" % (msg_number,self.total_messages,exception))
+                    self.done(msg_number, not isTransientError(exception))
+                continue
+            if response is None:
+                self.done(msg_number)
+                continue
+            msg_labels = response.get('labelIds', [])
+            self.ledger.recordLabels(google_id, msg_labels)
+            missing_labels = tuple(sorted(item for item in labels if item not in msg_labels))
+            if missing_labels:
+                self.modifications.setdefault(missing_labels, []).append((msg_number, google_id, set(msg_labels)))
+            else:
+                # Message has already been uploaded and no labels need to be added. Skip it.
+                logging.debug("Message {0} of {1} - Already Uploaded - Skipped".format(msg_number,self.total_messages))
+                self.done(msg_number)
+
+    def modify(self, missing_labels, messages):
+        # add missing labels
+        for i in range(0, len(messages), self.MODIFY_SIZE):
+            chunk = messages[i:i + self.MODIFY_SIZE]
+            label_modifications = {'ids': [google_id for msg_number, google_id, msg_labels in chunk],
+                                   'addLabelIds': list(missing_labels), 'removeLabelIds': []}
+            try:
+                executeWithRetry(self.service.users().messages().batchModify(userId='me', body=label_modifications),
+                                 QUOTA_UNITS['batchModify'])
+                for msg_number, google_id, msg_labels in chunk:
+                    self.ledger.recordLabels(google_id, msg_labels.union(missing_labels))
+                    logging.info("Message %s of %s - Added missing labels: %s" % (msg_number,self.total_messages,', '.join(missing_labels)))
+                    self.done(msg_number)
+            except (errors.HttpError, socket.error, httplib.HTTPException, httplib2.HttpLib2Error), error:
+                for msg_number, google_id, msg_labels in chunk:
+                    # cached labels may be stale; check with Gmail next time
+                    self.ledger.forgetLabels(google_id)
+                    logging.info("Message %s of %s - Error adding missing labels: %s - Error: %s" %
+                                  (msg_number,self.total_messages,', '.join(missing_labels),error))
+                    self.done(msg_number, not isTransientError(error))
+
+    def flush(self):
+        if self.pending:
+            self.check()
+        modifications = self.modifications
+        self.modifications = {}
+        for missing_labels, messages in modifications.items():
+            self.modify(missing_labels, messages)
+
+"""
+ * refreshLabelCache
+ *
+ * Bring the label cache up to date with the label changes made in Gmail
+ * since the last refresh, using history.list.
+ *
+ * Args:
+ *     service: Authorized Gmail API service instance.
+ *     ledger: database Ledger
+ *
+"""
+def refreshLabelCache(service, ledger):
+    start_history_id = getConfig(ledger.conn, 'history_id')
+    if start_history_id is None:
+        # nothing to replay; start tracking changes from now on
+        profile = executeWithRetry(service.users().getProfile(userId='me'), QUOTA_UNITS['getProfile'])
+        setConfig(ledger.conn, 'history_id', profile['historyId'])
+        return
+
+    history_id = start_history_id
+    page_token = None
+    changes = 0
+    while True:
+        try:
+            response = executeWithRetry(service.users().history().list(userId='me', startHistoryId=start_history_id,
+                                                                        pageToken=page_token),
+                                        QUOTA_UNITS['history.list'])
+        except errors.HttpError, error:
+            if error.resp.status == 404:
+                # history is too old to replay; forget all cached labels
+                logging.info("Label cache history expired.  Clearing label cache.")
+                ledger.flush()
+                ledger.conn.execute("DELETE FROM message_labels")
+                ledger.conn.commit()
+                profile = executeWithRetry(service.users().getProfile(userId='me'), QUOTA_UNITS['getProfile'])
+                setConfig(ledger.conn, 'history_id', profile['historyId'])
+                return
+            raise
+
+        for history in response.get('history', []):
+            for change in history.get('messagesDeleted', []):
+                ledger.forgetLabels(change['message']['id'])
+                changes += 1
+            for key in ('labelsAdded', 'labelsRemoved'):
+                for change in history.get(key, []):
+                    google_id = change['message']['id']
+                    cached_labels = ledger.getLabels(google_id)
+                    if cached_labels is None:
+                        continue
+                    if key == 'labelsAdded':
+                        cached_labels.update(change.get('labelIds', []))
+                    else:
+                        cached_labels.difference_update(change.get('labelIds', []))
+                    ledger.recordLabels(google_id, cached_labels)
+                    changes += 1
+
+        history_id = response.get('historyId', history_id)
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+
+    ledger.flush()
+    setConfig(ledger.conn, 'history_id', history_id)
+    logging.info("Label cache refreshed with {0} changes".format(changes))
+
+"""
+ * migrateMBOX
+ *
+ * Migrate MBOX.  Create label for MBOX folder, if necessary.  Migrate all
+ * messages and set label.
+ *
+ * Args:
+ *     service: Authorized Gmail API service instance.
+ *     file: path to MBOX file
+ *     label: label id to assign to MBOX messages
+ *     ledger: database Ledger
+ *     pool: optional UploadPool.  When given, messages are uploaded by the
+ *           pool's workers while this function keeps parsing the mbox.
+ *     start: byte offset to resume migration from
+ *     unit: optional WorkUnit leased from the shared work queue.  Only the
+ *           unit's byte range is migrated, and migration stops early if the
+ *           lease is lost.
+ *
+"""
+def migrateMBOX(service, file, label, ledger, pool=None, start=0, unit=None):
+    global message_info
+
+    # open mbox file or maildir folder for reading
+    mbox = openFolder(file, start, None if unit is None else unit.stop)
+
+    # get total number of messages in mbox file
+    started = time.time()
+    total_messages = len(mbox)
+    metrics.observe('scan', time.time() - started)
+
+    # message flags and Message-IDs from Thunderbird's summary file
+    summary = readSummary(file, mbox.mtime)
+    
+    # message, skip and failure counts shown as progress
+    progress = reporter.begin(file, os.path.relpath(file, mailroot).replace('.sbd', ''), total_messages,
+                              mbox.end - mbox.start)
+
+    # keep track of how far migration has safely got
+    if unit is None:
+        folder = FolderCheckpoint(file, mailroot, mbox)
+    else:
+        folder = UnitCheckpoint(unit, mailroot, mbox)
+    ledger.checkpoint(folder)
+
+    # label checks for already uploaded messages
+    reconciler = LabelReconciler(service, ledger, total_messages, folder)
+    if start > 0:
+        logging.info("Resuming folder at byte {0}".format(start))
+
+    def settle(job):
+        # record a finished upload
+        succeeded = recordUpload(ledger, job, total_messages)
+        folder.end(job.msg_number, succeeded)
+        if not succeeded:
+            progress.failed += 1
+        elif job.google_id is not None:
+            progress.uploaded += 1
+
+    # copies of messages whose first upload was still under way, with their
+    # start offsets
+    waiting = []
+
+    def place(job, start):
+        # upload a message unless a copy of it is uploaded or uploading in
+        # this run already
+        google_id = claims.claim(job)
+        if google_id is None:
+            folder.begin(job.msg_number, job.record)
+            if pool is not None:
+                # hand message to the upload workers
+                pool.submit(job)
+            else:
+                job.run(service)
+                settle(job)
+        elif google_id is claims.PENDING:
+            folder.hold(job.msg_number, start)
+            waiting.append((job, start))
+        else:
+            # add this folder's label to the uploaded copy instead
+            if job.message_id is not None:
+                message_info.record(ledger, job.message_id, google_id)
+            reconciler.add(job.msg_number, google_id, job.labels, start)
+            progress.skipped += 1
+
+    def resolve():
+        # deal with the waiting copies whose first upload has finished
+        for job, start in waiting[:]:
+            if claims.lookup(job) is not claims.PENDING:
+                waiting.remove((job, start))
+                place(job, start)
+    
+   # iterate over all messages in mbox file
+    msg_number = 0
+    for start, stop in mbox.spans():
+        # the messages before this one are dealt with or handed off.  This
+        # one is not until the next iteration starts, so an interrupt while
+        # it is parsed or uploaded leaves the checkpoint at its start.
+        folder.advance(start)
+
+        # leave the rest of the work unit to whoever took over its lease
+        if unit is not None and not unit.held():
+            logging.warning("Lease of work unit at byte {0} of {1} lost - Stopped".format(unit.start, file))
+            break
+
+        msg_number += 1
+        progress.messages = msg_number
+        progress.bytes = stop - mbox.start
+        reporter.tick()
+        
+        # record any uploads finished by the pool in the meantime
+        if pool is not None:
+            for job in pool.results():
+                settle(job)
+        resolve()
+
+        # initialize labels
+        # one label will always be 'CATEGORY_PERSONAL'
+        # one label will be based on the label provided
+        # one label will be 'UNREAD' if the message being uploaded has yet to be read
+        labels = ['CATEGORY_PERSONAL',label]
+    
+        # get x-mozilla-status and message-id values, if they exist, from the
+        # summary file when it has them, otherwise from the message header
+        status, message_id = summary.get(mbox.token(start), (None, None))
+        if message_id is not None:
+            record = None
+        else:
+            started = time.time()
+            record = mbox.record(start, stop)
+            x_mozilla_status = getHeader(record.headers, 'x-mozilla-status')
+            message_id = getHeader(record.headers, 'message-id')
+            metrics.observe('parse', time.time() - started)
+            status = None if x_mozilla_status is None else int(x_mozilla_status,16)
+        
+        if status is not None:
+            # determine if message is actually deleted
+            if status & 8:
+                # log some feedback
+                logging.debug("Message {0} of {1} - Already Deleted - Skipped".format(msg_number,total_messages))
+                
+                # skip message since it is marked as deleted
+                progress.skipped += 1
+                continue
+            
+            # determine if message is unread
+            if isUnread(status):
+                labels.append("UNREAD")
+        
+        # has message already been uploaded
+        google_id = message_info.get(ledger, message_id)
+        if google_id is not None:
+            # Yes.
+            # Check that its labels are set with the next batch of checks
+            reconciler.add(msg_number, google_id, labels, start)
+            progress.skipped += 1
+            continue
+
+        if record is None:
+            record = mbox.record(start, stop)
+
+        # byte ranges of the raw message without the x-mozilla-status and
+        # x-mozilla-status2 lines from the message header
+        started = time.time()
+        segments = spliceHeaders(record, MOZILLA_HEADERS)
+
+        # check message size is not greater than 35MB - 1024B (overhead just in case)
+        # before any of the message body is read
+        if sum(end - begin for begin, end in segments) > MAX_MESSAGE_SIZE:
+            # message is to big for Gmail to import
+            logging.info("Message %s of %s - Message is greater than 35MB.  Cannot upload." % (msg_number,total_messages))
+            progress.skipped += 1
+            continue
+
+        # has the same message been uploaded from another folder or mailbox
+        source = mbox.buffer(record)
+        content_hash = contentHash(source, record)
+        google_id = ledger.getContentHash(content_hash)
+        if google_id is not None:
+            # Yes.  Add this folder's label instead of uploading it again
+            if message_id is not None:
+                message_info.record(ledger, message_id, google_id)
+            reconciler.add(msg_number, google_id, labels, start)
+            progress.skipped += 1
+            continue
+
+        # raw message read straight from the mbox file
+        msg = MessageView(source, segments)
+        metrics.observe('serialize', time.time() - started)
+
+        subject = getHeader(record.headers, 'subject')
+        job = UploadJob(msg_number, message_id, subject, labels, file, record, msg)
+        job.content_hash = content_hash
+
+        # upload message
+        place(job, start)
+    else:
+        # the last message is dealt with too
+        folder.advance(mbox.end)
+
+    # wait for the remaining uploads of this mbox file, and for the copies
+    # waiting on uploads in other folder processes
+    while True:
+        if pool is not None:
+            for job in pool.results(wait=True):
+                settle(job)
+                reporter.tick()
+        resolve()
+        if not waiting and (pool is None or pool.outstanding == 0):
+            break
+        if waiting:
+            time.sleep(CLAIM_POLL_INTERVAL)
+
+    # check labels of the remaining already uploaded messages
+    reconciler.flush()
+
+    # save the final checkpoint for this mbox file
+    ledger.release(folder)
+    mbox.close()
+
+    reporter.end(file)
+    logging.info("Folder " + progress.summary())
+    
+    return total_messages, progress.failed
+      
+"""
+ * drainRetryQueue
+ *
+ * Try again to upload the messages of this mailbox that are in the retry
+ * queue, including any left over from earlier runs.  Messages are read back
+ * from their mbox files at the saved byte offsets; a message whose
+ * Message-ID no longer matches (the mbox file was compacted since) is
+ * dropped from the queue and will be picked up by the next migration of that
+ * folder.
+ *
+ * Args:
+ *     service: Authorized Gmail API service instance.
+ *     ledger: database Ledger
+ *     unit: optional WorkUnit of the retry queue leased from the shared work
+ *           queue.  Retrying stops early if the lease is lost.
+ *
+ * Returns:
+ *     number of retried messages, number that failed for good, number still
+ *     queued
+"""
+def drainRetryQueue(service, ledger, unit=None):
+    global message_info
+
+    ledger.flush()
+    rows = ledger.conn.execute("SELECT path, start, stop, message_id, label_ids, attempts FROM retry_queue "
+                               "WHERE mailbox = ? ORDER BY path, start", [mailroot]).fetchall()
+    total_retried = len(rows)
+    progress = reporter.begin('retry', 'Retry queue', total_retried, 0)
+    mbox = None
+    for n, (path, start, stop, message_id, label_ids, attempts) in enumerate(rows):
+        # leave the rest of the retry queue to whoever took over its lease
+        if unit is not None and not unit.held():
+            logging.warning("Lease of the retry queue lost - Stopped")
+            break
+
+        progress.messages = n+1
+        reporter.tick()
+
+        if message_info.get(ledger, message_id) is not None:
+            # uploaded in the meantime
+            ledger.dropRetry(path, start)
+            progress.skipped += 1
+            continue
+
+        if mbox is None or mbox.path != path:
+            if mbox is not None:
+                mbox.close()
+            mbox = None
+            if os.path.exists(path):
+                mbox = openFolder(path)
+
+        record = None
+        if mbox is not None and stop <= mbox.size:
+            record = mbox.record(start, stop)
+        if record is None or getHeader(record.headers, 'message-id') != message_id:
+            logging.info("Retry of message at byte {0} of {1} dropped - mbox file has changed".format(start, path))
+            ledger.dropRetry(path, start)
+            progress.skipped += 1
+            continue
+
+        labels = label_ids.split(',')
+        content_hash = contentHash(mbox.buffer(record), record)
+        if ledger.getContentHash(content_hash) is not None:
+            # same message uploaded from elsewhere in the meantime
+            ledger.dropRetry(path, start)
+            progress.skipped += 1
+            continue
+
+        job = UploadJob(n+1, message_id, getHeader(record.headers, 'subject'), labels, path, record,
+                        mbox.view(record, MOZILLA_HEADERS))
+        job.content_hash = content_hash
+        job.run(service)
+        if job.google_id is not None:
+            ledger.dropRetry(path, start)
+            recordUpload(ledger, job, total_retried)
+            progress.uploaded += 1
+        elif job.error is not None and isTransientError(job.error) and attempts + 1 < RETRY_LIMIT:
+            ledger.queueRetry(mailroot, job)
+        else:
+            ledger.dropRetry(path, start)
+            logging.error("Message {0} of {1} - Retry Failed!".format(n+1,total_retried))
+            progress.failed += 1
+
+    ledger.flush()
+    if mbox is not None:
+        mbox.close()
+    if total_retried > 0:
+        reporter.end('retry')
+    else:
+        reporter.folders.pop('retry')
+
+    remaining = ledger.conn.execute("SELECT COUNT(*) FROM retry_queue WHERE mailbox = ?", [mailroot]).fetchone()[0]
+    return total_retried, progress.failed, remaining
+
+"""
+ * folderLabel
+ *
+ * Args:
+ *     mailroot: root mail folder
+ *     dirName: directory holding the folder
+ *     name: MBOX file or maildir folder name
+ *
+ * Returns:
+ *     label name for the folder, or None if the folder is not migrated
+"""
+def folderLabel(mailroot, dirName, name):
+    if name in ["DRAFTS","Drafts"]:
+        # cannot import with Gmail API so skip
+        return None
+
+    if os.path.splitext(name)[0] in ['Unsent Messages','Trash']:
+        # ignore messages that have not sent or in trash
+        return None
+
+    # build label name
+    if dirName == mailroot:
+        return name
+    return dirName.replace(mailroot + '/','').replace('.sbd','') + '/' + name
+
+"""
+ * findMboxFiles
+ *
+ * Walk mail folder structure and determine mail folder hierarchy and MBOX
+ * files to migrate.  Folders of profiles that store one file per message
+ * are maildir directories, which are migrated like MBOX files.
+ *
+ * Args:
+ *     mailroot: root mail folder
+ *
+ * Returns:
+ *     generator of (path to MBOX file or maildir folder, label name) tuples
+"""
+def findMboxFiles(mailroot):
+    for dirName, subdirList, fileList in os.walk(mailroot):
+        # Option 1 : Attempt to migrate Trash folder
+        '''
+        if os.path.basename(dirName) == '[Gmail].sbd':
+            if 'Trash' in fileList:
+                label = 'Trash'
+                
+                # output some feedback
+                logging.info("Migrating folder: {0}".format(label))
+                print("\rFolder: {0} ".format((label.ljust(55,' ')[:53] + '..') if len(label.ljust(55,' ')) > 55 else label.ljust(55,' ')))
+                print(" *                                "),
+                
+                # migrate MBOX messages
+                migrateMBOX(service, dirName + '\\Trash', current_labels[label], ledger)
+            continue
+        '''
+        for mboxFile in fileList:
+            if mboxFile in ["msgFilterRules.dat","filterlog.html"] or re.match("popstate.*\.dat",mboxFile):
+                # not an MBOX file
+                continue
+            
+            fileName, fileExtension = os.path.splitext(mboxFile)
+            if fileExtension == ".msf":
+                # not an MBOX file
+                continue
+            
+            label = folderLabel(mailroot, dirName, mboxFile)
+            if label is not None:
+                yield dirName + '/' + mboxFile, label
+
+        # maildir folders are migrated whole rather than walked into
+        for folderName in sorted(subdirList):
+            if isMaildir(os.path.join(dirName, folderName)):
+                subdirList.remove(folderName)
+                label = folderLabel(mailroot, dirName, folderName)
+                if label is not None:
+                    yield dirName + '/' + folderName, label
+            
+        # Option 2 : Skip all Gmail custom folders
+        if '[Gmail].sbd' in subdirList:
+            del subdirList[subdirList.index("[Gmail].sbd")]
+
+"""
+ * initFolderProcess
+ *
+ * Set up a folder worker process: its own service object, database
+ * connection, upload workers and share of the request quota and memory budget.
+ *
+ * Args:
+ *     credentials_json: credentials object serialized with to_json()
+ *     channel: multiprocessing queue to the main process
+ *     processes: number of folder worker processes
+ *     workers: number of upload workers per process
+ *     memory_budget: bytes of message data the process's uploads may hold
+ *     stop: multiprocessing event set when the migration is interrupted
+ *     store: UploadClaims store shared by the folder processes
+ *
+"""
+def initFolderProcess(credentials_json, channel, processes, workers, memory_budget, stop, store):
+    global folder_process, progress_channel, quota, claims
+
+    # the main process handles Ctrl-C, and asks the folder processes to stop
+    # with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    channel.put(('started', os.getpid()))
+
+    # split the per-user quota between the processes
+    quota = QuotaScheduler(QUOTA_RATE / float(processes))
+
+    # copies of a message in folders of different processes are uploaded once
+    claims = UploadClaims(store)
+
+    credentials = SharedCredentials.from_json(credentials_json)
+    progress_channel = channel
+    folder_process = {'service': buildService(credentials),
+                      'ledger': ChannelLedger(sqlite3.connect(DATABASE), channel),
+                      'pool': UploadPool(credentials, workers, memory_budget) if workers > 1 else None,
+                      'stop': stop}
+
+"""
+ * stopFolderProcess
+ *
+ * SIGTERM handler of a folder worker process while it migrates a folder.
+ *
+"""
+def stopFolderProcess(signum, frame):
+    raise KeyboardInterrupt
+
+"""
+ * migrateFolderProcess
+ *
+ * Migrate one MBOX file in a folder worker process.  Results are reported to
+ * the main process with a ('done', path, label, messages, failed, error)
+ * message.  Once the migration is interrupted, the folder is left where it
+ * got to, with its finished uploads and checkpoint sent to the main process,
+ * and folders not started yet are reported done straight away.
+ *
+ * Args:
+ *     folder: (path to MBOX file, label name, label id, start offset) tuple
+ *
+"""
+def migrateFolderProcess(folder):
+    path, label, label_id, start = folder
+    ledger = folder_process['ledger']
+    number_messages, number_failed, error = 0, 0, None
+    signal.signal(signal.SIGTERM, stopFolderProcess)
+    try:
+        if not folder_process['stop'].is_set():
+            number_messages, number_failed = migrateMBOX(folder_process['service'], path, label_id, ledger,
+                                                         folder_process['pool'], start)
+    except KeyboardInterrupt:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        recordFinishedUploads(folder_process['pool'], ledger)
+        reporter.folders.pop(path, None)
+    except Exception:
+        error = traceback.format_exc()
+        reporter.folders.pop(path, None)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    ledger.flush()
+    progress_channel.put(('metrics', metrics.take()))
+    progress_channel.put(('done', path, label, number_messages, number_failed, error))
+
+"""
+ * migrateFoldersInParallel
+ *
+ * Migrate MBOX files in a pool of processes, largest first, so that CPU
+ * bound parsing runs on every core.  Each process has its own Gmail API
+ * service object.  The processes send their database writes and progress
+ * to this process, which records them.
+ *
+ * Args:
+ *     credentials: credentials object used to authorize requests
+ *     folders: list of (path to MBOX file, label name, start offset) tuples
+ *     current_labels: label name to label id dictionary
+ *     ledger: database Ledger
+ *     options: options dictionary
+ *
+ * Returns:
+ *     total number of messages, total number of failed messages
+"""
+def migrateFoldersInParallel(credentials, folders, current_labels, ledger, options):
+    processes = options['parallel_folders']
+    channel = multiprocessing.Queue()
+
+    # largest mbox files first so that they are not left until last
+    folders = sorted(folders, key=lambda folder: folderSize(folder[0]) - folder[2], reverse=True)
+
+    # upload claims shared by the folder processes, kept by a manager process
+    # that leaves Ctrl-C to this one
+    manager = multiprocessing.managers.SyncManager()
+    manager.start(ignoreInterrupt)
+    stop = multiprocessing.Event()
+    workers = multiprocessing.Pool(processes, initFolderProcess,
+                                   (credentials.to_json(), channel, processes, options['workers'],
+                                    options['memory_budget'] / processes, stop, manager.dict()))
+    for path, label, start in folders:
+        workers.apply_async(migrateFolderProcess, ((path, label, current_labels[label], start),))
+    workers.close()
+
+    total_messages = 0
+    total_failed = 0
+    remaining = len(folders)
+    pids = []
+    while remaining > 0:
+        try:
+            reporter.tick()
+            try:
+                message = channel.get(timeout=1)
+            except Queue.Empty:
+                continue
+
+            if message[0] == 'started':
+                pids.append(message[1])
+            elif message[0] == 'write':
+                ledger.apply(message[1], message[2])
+            elif message[0] == 'metrics':
+                metrics.merge(message[1])
+            elif message[0] == 'progress':
+                reporter.update(message[1], message[2])
+            elif message[0] == 'done':
+                path, label, number_messages, number_failed, error = message[1:]
+                remaining -= 1
+                if error is not None:
+                    logging.error("Folder {0} failed: {1}".format(label, error))
+                    number_failed += 1
+                    reporter.folders.pop(path, None)
+                    reporter.clear()
+                    print("Folder {0}: failed, see log file for details".format(label))
+                else:
+                    reporter.end(path)
+                logging.info("Migrated folder: {0}".format(label))
+                total_messages += number_messages
+                total_failed += number_failed
+        except KeyboardInterrupt:
+            if stop.is_set():
+                # interrupted again; don't wait for the folder processes
+                workers.terminate()
+                raise
+            # let the folder processes send what they have done before they
+            # stop
+            print "\n\nStopping folder processes..."
+            stop.set()
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    workers.join()
+    manager.shutdown()
+    ledger.flush()
+    if stop.is_set():
+        raise KeyboardInterrupt
+
+    return total_messages, total_failed
+
+"""
+ * planMBOX
+ *
+ * Work out what migrating an MBOX file would do, with a header-only pass
+ * over the file.
+ *
+ * Args:
+ *     file: path to MBOX file
+ *     offset: byte offset migration would resume from
+ *     ledger: database Ledger
+ *     seen: Message-IDs planned for upload from earlier MBOX files
+ *
+ * Returns:
+ *     dictionary of message counts, byte totals and estimated quota cost
+"""
+def planMBOX(file, offset, ledger, seen):
+    plan = {'messages': 0, 'bytes': 0, 'to_upload': 0, 'upload_bytes': 0, 'label_checks': 0,
+            'skipped': {'deleted': 0, 'already_uploaded': 0, 'oversized': 0}}
+
+    mbox = openFolder(file, offset)
+    summary = readSummary(file, mbox.mtime)
+    for start, stop in mbox.spans():
+        plan['messages'] += 1
+        plan['bytes'] += stop - start
+
+        status, message_id = summary.get(mbox.token(start), (None, None))
+        record = None
+        if message_id is None:
+            record = mbox.record(start, stop)
+            x_mozilla_status = getHeader(record.headers, 'x-mozilla-status')
+            message_id = getHeader(record.headers, 'message-id')
+            status = None if x_mozilla_status is None else int(x_mozilla_status,16)
+
+        if status is not None and status & 8:
+            plan['skipped']['deleted'] += 1
+            continue
+
+        google_id = message_info.get(ledger, message_id)
+        if google_id is not None or (message_id is not None and message_id in seen):
+            plan['skipped']['already_uploaded'] += 1
+            if google_id is None or ledger.getLabels(google_id) is None:
+                # labels will need checking with Gmail
+                plan['label_checks'] += 1
+            continue
+
+        if record is None:
+            record = mbox.record(start, stop)
+        length = sum(end - begin for begin, end in spliceHeaders(record, MOZILLA_HEADERS))
+        if length > MAX_MESSAGE_SIZE:
+            plan['skipped']['oversized'] += 1
+            continue
+
+        if message_id is not None:
+            seen.add(message_id)
+        plan['to_upload'] += 1
+        plan['upload_bytes'] += length
+    mbox.close()
+
+    plan['quota_units'] = plan['to_upload'] * QUOTA_UNITS['import'] + plan['label_checks'] * QUOTA_UNITS['get']
+    return plan
+
+"""
+ * planMigration
+ *
+ * Dry run of a migration.  Every MBOX file that would be migrated is scanned
+ * and a manifest with per folder counts, byte totals, skip reasons and
+ * estimated quota cost is written.  The manifest can be passed to a later
+ * run with --manifest to use as its work queue.
+ *
+ * Args:
+ *     mailroot: root mail folder
+ *     ledger: database Ledger
+ *     path: path to write the JSON manifest to
+ *     globs: label patterns of the folders to scan, or None for all folders
+ *
+ * Returns:
+ *     manifest dictionary
+"""
+def planMigration(mailroot, ledger, path, globs=None):
+    manifest = {'mailroot': mailroot, 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'folders': []}
+    totals = {'messages': 0, 'bytes': 0, 'to_upload': 0, 'upload_bytes': 0, 'label_checks': 0,
+              'quota_units': 0, 'skipped': {'deleted': 0, 'already_uploaded': 0, 'oversized': 0, 'unchanged': 0}}
+    seen = set()
+
+    for mboxPath, label in selectFolders(findMboxFiles(mailroot), globs):
+        print(BS32+BS32+"Scanning folder: {0}".format((label.ljust(40,' ')[:38] + '..') if len(label.ljust(40,' ')) > 40 else label.ljust(40,' '))),
+        start = getResumeOffset(ledger.conn, mboxPath)
+        if start is None:
+            # unchanged since it was fully migrated
+            plan = {'messages': 0, 'bytes': 0, 'to_upload': 0, 'upload_bytes': 0, 'label_checks': 0,
+                    'quota_units': 0, 'skipped': {'unchanged': True}}
+            totals['skipped']['unchanged'] += 1
+        else:
+            plan = planMBOX(mboxPath, start, ledger, seen)
+            for reason, count in plan['skipped'].items():
+                totals['skipped'][reason] += count
+        plan['path'] = mboxPath
+        plan['label'] = label
+        plan['size'] = folderSize(mboxPath)
+        plan['start'] = start
+        manifest['folders'].append(plan)
+        for key in ('messages', 'bytes', 'to_upload', 'upload_bytes', 'label_checks', 'quota_units'):
+            totals[key] += plan[key]
+    print("\r" + " "*64 + "\r"),
+
+    # largest uploads first
+    manifest['folders'].sort(key=lambda folder: folder['upload_bytes'], reverse=True)
+    totals['estimated_seconds'] = totals['quota_units'] / float(QUOTA_RATE)
+    manifest['totals'] = totals
+
+    fh = open(path, 'w')
+    try:
+        simplejson.dump(manifest, fh, indent=2)
+    finally:
+        fh.close()
+    logging.info("Migration plan written to {0}".format(path))
+
+    return manifest
+
+"""
+ * printPlan
+ *
+ * Print a summary of a migration manifest.
+ *
+ * Args:
+ *     manifest: manifest dictionary
+ *
+"""
+def printPlan(manifest):
+    totals = manifest['totals']
+    print("\nMigration plan for {0}\n".format(manifest['mailroot']))
+    for folder in manifest['folders']:
+        if folder['to_upload'] == 0 and folder['label_checks'] == 0:
+            continue
+        label = folder['label']
+        print("{0} {1:>8} messages {2:>10.1f} MB".format((label.ljust(45,' ')[:43] + '..') if len(label.ljust(45,' ')) > 45 else label.ljust(45,' '),
+                                                        folder['to_upload'], folder['upload_bytes'] / 1048576.0))
+    print
+    print("Messages found:              {0}".format(totals['messages']))
+    print("Messages to upload:          {0} ({1:.1f} MB)".format(totals['to_upload'], totals['upload_bytes'] / 1048576.0))
+    print("Already uploaded:            {0} ({1} label checks)".format(totals['skipped']['already_uploaded'], totals['label_checks']))
+    print("Deleted:                     {0}".format(totals['skipped']['deleted']))
+    print("Larger than 35MB:            {0}".format(totals['skipped']['oversized']))
+    print("Unchanged folders:           {0}".format(totals['skipped']['unchanged']))
+    print("Estimated quota units:       {0} (at least {1:.0f} minutes)".format(totals['quota_units'], totals['estimated_seconds'] / 60))
+    print
+
+"""
+ * loadManifest
+ *
+ * Read a migration manifest written by --plan.
+ *
+ * Args:
+ *     path: path to JSON manifest
+ *
+ * Returns:
+ *     manifest dictionary
+"""
+def loadManifest(path):
+    try:
+        fh = open(path)
+        try:
+            return simplejson.load(fh)
+        finally:
+            fh.close()
+    except (IOError, ValueError), error:
+        sys.exit("Cannot read manifest {0}: {1}".format(path, error))
+
+"""
+ * SPOOL_SCHEMA
+ *
+ * Tables of a staging spool's index, spool.db.  Each message row points at
+ * the blob file and byte range holding the message, ready to import; rows
+ * for messages with the same content share one copy.
+ *
+"""
+SPOOL_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS config (name text unique, value text)",
+    "CREATE TABLE IF NOT EXISTS folders (path text PRIMARY KEY, label text, size integer, mtime real)",
+    "CREATE TABLE IF NOT EXISTS messages (n integer PRIMARY KEY, path text, label text, unread integer, "
+    "message_id text, content_hash text, subject text, blob integer, offset integer, length integer, "
+    "stored integer, compressed integer)",
+    "CREATE INDEX IF NOT EXISTS messages_path ON messages (path)",
+    "CREATE INDEX IF NOT EXISTS messages_content_hash ON messages (content_hash)",
+]
+
+"""
+ * Spool class
+ *
+ * Staging spool: a directory of blob files holding messages with their
+ * X-Mozilla-Status lines already left out, optionally zlib compressed, and
+ * an index of each message's folder label, unread state, Message-ID and
+ * content hash.  A spool is written by stage and read by upload, which can
+ * run on another host.  Each folder's rows are committed when the folder is
+ * done, so an interrupted stage starts that folder over; the bytes it had
+ * written stay in the blob files unused.
+ *
+"""
+class Spool(object):
+    def __init__(self, path, mailroot=None):
+        self.path = path
+        index = os.path.join(path, 'spool.db')
+        if mailroot is None and not os.path.exists(index):
+            sys.exit("No staging spool in {0}".format(path))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.conn = sqlite3.connect(index)
+        for statement in SPOOL_SCHEMA:
+            self.conn.execute(statement)
+        if mailroot is not None:
+            staged = getConfig(self.conn, 'mailroot')
+            if staged is not None and staged != mailroot:
+                sys.exit("Spool {0} holds mailbox {1}".format(path, staged))
+            setConfig(self.conn, 'mailroot', mailroot)
+        self.mailroot = getConfig(self.conn, 'mailroot')
+        self.blob = None
+        self.blob_number = None
+
+    def blobPath(self, number):
+        return os.path.join(self.path, 'blob-{0:05d}'.format(number))
+
+    def staged(self, path, size, mtime):
+        # True if the folder is unchanged since it was staged
+        row = self.conn.execute("SELECT size, mtime FROM folders WHERE path = ?", [path]).fetchone()
+        return row is not None and row[0] == size and row[1] == mtime
+
+    def begin(self, path):
+        # forget what was staged of a folder before
+        self.conn.execute("DELETE FROM folders WHERE path = ?", [path])
+        self.conn.execute("DELETE FROM messages WHERE path = ?", [path])
+
+    def add(self, path, label, unread, message_id, content_hash, subject, fh, compress):
+        # stage a message, sharing the copy of an already staged message
+        # with the same content
+        row = self.conn.execute("SELECT blob, offset, length, stored, compressed FROM messages "
+                                "WHERE content_hash = ? LIMIT 1", [content_hash]).fetchone()
+        if row is None:
+            row = self.write(fh, compress)
+        self.conn.execute("INSERT INTO messages (path, label, unread, message_id, content_hash, subject, blob, "
+                          "offset, length, stored, compressed) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                          [path, label, int(unread), message_id, content_hash, subject] + list(row))
+
+    def write(self, fh, compress):
+        # append a message to the current blob file, starting a new one
+        # for each run and whenever the current one is full
+        if self.blob is None or self.blob.tell() >= SPOOL_BLOB_SIZE:
+            if self.blob is not None:
+                self.blob.close()
+            number = 0 if self.blob_number is None else self.blob_number + 1
+            while os.path.exists(self.blobPath(number)):
+                number += 1
+            self.blob = open(self.blobPath(number), 'wb')
+            self.blob_number = number
+        offset = self.blob.tell()
+        compressor = zlib.compressobj() if compress else None
+        length = 0
+        while True:
+            chunk = fh.read(1048576)
+            if not chunk:
+                break
+            length += len(chunk)
+            self.blob.write(compressor.compress(chunk) if compressor is not None else chunk)
+        if compressor is not None:
+            self.blob.write(compressor.flush())
+        return self.blob_number, offset, length, self.blob.tell() - offset, int(compress)
+
+    def end(self, path, label, size, mtime):
+        # commit a folder's messages once their blobs are on disk
+        if self.blob is not None:
+            self.blob.flush()
+            os.fsync(self.blob.fileno())
+        self.conn.execute("INSERT OR REPLACE INTO folders VALUES (?,?,?,?)", [path, label, size, mtime])
+        self.conn.commit()
+
+    def labels(self):
+        # folder labels of the staged messages
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT label FROM messages")]
+
+    def messages(self):
+        # every staged message row, in the order it was staged
+        return self.conn.execute("SELECT n, label, unread, message_id, content_hash, subject, blob, offset, "
+                                 "length, stored, compressed FROM messages ORDER BY n")
+
+    def open(self, blob, offset, length, stored, compressed):
+        # file object over a staged message
+        if not compressed:
+            return MessageView(FileBuffer(self.blobPath(blob)), [(offset, offset + length)])
+        data = zlib.decompress(FileBuffer(self.blobPath(blob))[offset:offset + stored])
+        return MessageView(data, [(0, len(data))])
+
+    def close(self):
+        if self.blob is not None:
+            self.blob.close()
+        self.conn.close()
+
+"""
+ * stageMBOX
+ *
+ * Stage the messages of an MBOX file or maildir folder that a migration
+ * would upload: deleted and oversized messages are left out, and the rest
+ * are written to the spool without their X-Mozilla-Status lines.
+ *
+ * Args:
+ *     spool: Spool to write to
+ *     file: path to MBOX file or maildir folder
+ *     label: label name of the folder
+ *     compress: whether to compress the staged messages
+ *
+ * Returns:
+ *     number of messages in the folder, number staged
+"""
+def stageMBOX(spool, file, label, compress):
+    mbox = openFolder(file)
+    if spool.staged(file, mbox.size, mbox.mtime):
+        logging.info("Folder unchanged since it was staged - Skipped: {0}".format(label))
+        mbox.close()
+        return 0, 0
+
+    summary = readSummary(file, mbox.mtime)
+    total_messages = len(mbox)
+    progress = reporter.begin(file, os.path.relpath(file, mailroot).replace('.sbd', ''), total_messages, mbox.size)
+    progress.verb = 'staged'
+    spool.begin(file)
+
+    msg_number = 0
+    for start, stop in mbox.spans():
+        msg_number += 1
+        progress.messages = msg_number
+        progress.bytes = stop
+        reporter.tick()
+
+        record = mbox.record(start, stop)
+        status, message_id = summary.get(mbox.token(start), (None, None))
+        if message_id is None:
+            x_mozilla_status = getHeader(record.headers, 'x-mozilla-status')
+            message_id = getHeader(record.headers, 'message-id')
+            status = None if x_mozilla_status is None else int(x_mozilla_status,16)
+
+        if status is not None and status & 8:
+            # deleted
+            progress.skipped += 1
+            continue
+
+        segments = spliceHeaders(record, MOZILLA_HEADERS)
+        if sum(end - begin for begin, end in segments) > MAX_MESSAGE_SIZE:
+            logging.info("Message %s of %s - Message is greater than 35MB.  Cannot upload." % (msg_number,total_messages))
+            progress.skipped += 1
+            continue
+
+        source = mbox.buffer(record)
+        spool.add(file, label, status is not None and isUnread(status), message_id, contentHash(source, record),
+                  getHeader(record.headers, 'subject'), MessageView(source, segments), compress)
+        progress.uploaded += 1
+
+    spool.end(file, label, mbox.size, mbox.mtime)
+    mbox.close()
+
+    reporter.end(file)
+    logging.info("Folder " + progress.summary())
+
+    return total_messages, progress.uploaded
+
+"""
+ * stageMailbox
+ *
+ * Parse every folder of a mailbox into a staging spool, so that a later
+ * upload needs no access to the mailbox.  Folders unchanged since they were
+ * staged are skipped.
+ *
+ * Args:
+ *     mailroot: root mail folder
+ *     path: spool directory
+ *     globs: label patterns of the folders to stage, or None for all folders
+ *     compress: whether to compress the staged messages
+ *
+ * Returns:
+ *     number of messages in the staged folders, number staged
+"""
+def stageMailbox(mailroot, path, globs, compress):
+    spool = Spool(path, mailroot)
+    total_messages = 0
+    total_staged = 0
+    try:
+        for mboxPath, label in selectFolders(findMboxFiles(mailroot), globs):
+            logging.info("Staging folder: {0}".format(label))
+            number_messages, number_staged = stageMBOX(spool, mboxPath, label, compress)
+            total_messages += number_messages
+            total_staged += number_staged
+    finally:
+        spool.close()
+    return total_messages, total_staged
+
+"""
+ * uploadSpool
+ *
+ * Upload the messages of a staging spool.  Messages are read straight from
+ * the blob files, with no mbox parsing, and go through the same already
+ * uploaded checks, label checks and ledger as a migration.  Failed uploads
+ * are not added to the retry queue; running the upload again retries them,
+ * and skips everything uploaded before.
+ *
+ * Args:
+ *     service: Authorized Gmail API service instance.
+ *     spool: Spool to upload
+ *     ledger: database Ledger
+ *     current_labels: label name to label id dictionary
+ *     pool: optional UploadPool
+ *
+ * Returns:
+ *     total number of messages, number of failed messages
+"""
+def uploadSpool(service, spool, ledger, current_labels, pool=None):
+    total_messages, total_bytes = spool.conn.execute("SELECT COUNT(*), SUM(length) FROM messages").fetchone()
+    progress = reporter.begin(spool.path, os.path.basename(spool.path.rstrip('/')), total_messages, total_bytes or 0)
+    reconciler = LabelReconciler(service, ledger, total_messages)
+
+    def settle(job):
+        # record a finished upload
+        if job.google_id is None:
+            logging.error("Message {0} of {1} - Upload Failed!".format(job.msg_number,total_messages))
+            claims.settle(job)
+            progress.failed += 1
+        else:
+            recordUpload(ledger, job, total_messages)
+            progress.uploaded += 1
+
+    # copies of messages whose first upload was still under way
+    waiting = []
+
+    def place(job):
+        # upload a message unless a copy of it is uploaded or uploading already
+        google_id = claims.claim(job)
+        if google_id is None:
+            if pool is not None:
+                pool.submit(job)
+            else:
+                job.run(service)
+                settle(job)
+        elif google_id is claims.PENDING:
+            waiting.append(job)
+        else:
+            if job.message_id is not None:
+                message_info.record(ledger, job.message_id, google_id)
+            reconciler.add(job.msg_number, google_id, job.labels)
+            progress.skipped += 1
+
+    def resolve():
+        # deal with the waiting copies whose first upload has finished
+        for job in waiting[:]:
+            if claims.lookup(job) is not claims.PENDING:
+                waiting.remove(job)
+                place(job)
+
+    msg_number = 0
+    for n, label, unread, message_id, content_hash, subject, blob, offset, length, stored, compressed in spool.messages():
+        msg_number += 1
+        progress.messages = msg_number
+        progress.bytes += length
+        reporter.tick()
+
+        if pool is not None:
+            for job in pool.results():
+                settle(job)
+        resolve()
+
+        if label not in current_labels:
+            # label could not be created
+            progress.skipped += 1
+            continue
+        labels = ['CATEGORY_PERSONAL', current_labels[label]]
+        if unread:
+            labels.append("UNREAD")
+
+        # has message already been uploaded, from this or another folder
+        google_id = message_info.get(ledger, message_id)
+        if google_id is None:
+            google_id = ledger.getContentHash(content_hash)
+            if google_id is not None and message_id is not None:
+                message_info.record(ledger, message_id, google_id)
+        if google_id is not None:
+            reconciler.add(msg_number, google_id, labels)
+            progress.skipped += 1
+            continue
+
+        job = UploadJob(msg_number, message_id, subject, labels, spool.path, None,
+                        spool.open(blob, offset, length, stored, compressed))
+        job.content_hash = content_hash
+        place(job)
+
+    # wait for the remaining uploads, then deal with the copies waiting on them
+    while pool is not None and (pool.outstanding > 0 or waiting):
+        for job in pool.results(wait=True):
+            settle(job)
+            reporter.tick()
+        resolve()
+    reconciler.flush()
+    ledger.flush()
+
+    reporter.end(spool.path)
+    logging.info("Spool " + progress.summary())
+
+    return msg_number, progress.failed
+
+"""
+ * WorkUnit class
+ *
+ * A byte range of a folder leased from the shared WorkQueue.  The offset is
+ * the start of the first message of the range that has not been migrated
+ * yet.  A unit with an empty path stands for the retry queue, which is
+ * drained once every folder has been migrated.
+ *
+ * While the unit is worked on, a heartbeat thread with its own database
+ * connection renews the lease every LEASE_HEARTBEAT seconds, however long
+ * a single upload, backoff or batch of label changes takes.
+ *
+"""
+class WorkUnit(object):
+    def __init__(self, queue, path, label, start, stop, offset, attempts):
+        self.queue = queue
+        self.path = path
+        self.label = label
+        self.start = start
+        self.stop = stop
+        self.offset = offset
+        self.attempts = attempts
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def startHeartbeat(self):
+        self.thread = threading.Thread(target=self.heartbeat)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stopHeartbeat(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def heartbeat(self):
+        # renew the lease until stopped or taken over
+        conn = self.queue.connect()
+        try:
+            while not self.stopped.wait(LEASE_HEARTBEAT):
+                try:
+                    if not self.queue.renew(self, conn):
+                        self.lost = True
+                        return
+                except sqlite3.Error, error:
+                    logging.warning("Lease of work unit at byte {0} of {1} not renewed: {2}".format(
+                        self.start, self.path, error))
+        finally:
+            conn.close()
+
+    def held(self):
+        # False once another worker has taken over the lease
+        return not self.lost
+
+"""
+ * UnitCheckpoint class
+ *
+ * FolderCheckpoint of a WorkUnit.  The offset is saved to the unit's row of
+ * the work_units table, in the same transaction as the message_info rows it
+ * covers, and only while this worker still holds the lease.
+ *
+"""
+class UnitCheckpoint(FolderCheckpoint):
+    SQL = "UPDATE work_units SET offset = ? WHERE path = ? AND start = ? AND owner = ?"
+
+    def __init__(self, unit, mailbox, mbox):
+        FolderCheckpoint.__init__(self, unit.path, mailbox, mbox)
+        self.unit = unit
+
+    def row(self):
+        self.unit.offset = self.offset()
+        return [self.unit.offset, self.unit.path, self.unit.start, self.unit.queue.owner]
+
+"""
+ * WorkQueue class
+ *
+ * Work queue shared by workers on several hosts through a database on shared
+ * storage.  Folders are split into WorkUnits of about WORK_UNIT_SIZE bytes,
+ * kept in the work_units table.  A worker claims a unit by taking its lease,
+ * renews the lease while it works, and marks the unit done at the end.  A
+ * unit whose lease has expired, because its worker died or lost touch with
+ * the database, goes to the next worker that asks, which resumes it at the
+ * saved offset.  Every change is a single statement, so the database lock
+ * keeps two workers from claiming the same unit.
+ *
+ * Another queue server can stand in for the database by providing the same
+ * methods.
+ *
+"""
+class WorkQueue(object):
+    CLAIMABLE = ("(state = 'pending' OR (state = 'leased' AND lease_expiry < ?)) "
+                 "AND (path <> '' OR NOT EXISTS (SELECT 1 FROM work_units WHERE path <> '' AND state <> 'done'))")
+
+    def __init__(self, conn, path):
+        self.conn = conn
+        self.path = path
+        self.owner = '{0}:{1}:{2:08x}'.format(socket.gethostname(), os.getpid(), random.getrandbits(32))
 
-        # create `config` table
-        conn.execute("CREATE TABLE IF NOT EXISTS config (name text unique, value text)")
+    def connect(self):
+        # another connection to the queue, for a heartbeat thread
+        return sqlite3.connect(self.path, timeout=SHARED_DATABASE_TIMEOUT)
 
-        # insert refresh_token into `config` table
-        conn.execute("INSERT OR REPLACE INTO config (name, value) VALUES ('refresh_token','{0}')".format(refresh_token))
+    def drained(self):
+        # True if no unit is left to migrate
+        return self.unfinished() == 0
 
-        # save changes
+    def unfinished(self):
+        # number of units not done yet, including the retry queue
+        return self.conn.execute("SELECT COUNT(*) FROM work_units WHERE state <> 'done'").fetchone()[0]
+
+    def populate(self, units):
+        # start a new migration with these (path, label, start, stop) units,
+        # unless another worker has already started one.  The DELETE takes
+        # the write lock before the table is checked.
+        self.conn.execute("DELETE FROM work_units WHERE NOT EXISTS (SELECT 1 FROM work_units WHERE state <> 'done')")
+        if self.conn.execute("SELECT COUNT(*) FROM work_units").fetchone()[0] == 0:
+            self.conn.executemany("INSERT INTO work_units VALUES (?,?,?,?,?,'pending',NULL,0,0)",
+                                  [(path, label, start, stop, start) for path, label, start, stop in units] +
+                                  [('', None, 0, 0, 0)])
+        self.conn.commit()
+
+    def labels(self):
+        # labels of the folders left to migrate
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT label FROM work_units "
+                                                     "WHERE path <> '' AND state <> 'done'")]
+
+    def claim(self):
+        # lease the next unit, or None if there is none to claim right now
+        now = time.time()
+        cursor = self.conn.execute("UPDATE work_units SET state = 'leased', owner = ?, lease_expiry = ?, "
+                                   "attempts = attempts + 1 WHERE rowid = (SELECT rowid FROM work_units WHERE " +
+                                   self.CLAIMABLE + " ORDER BY path = '', path, start LIMIT 1)",
+                                   [self.owner, now + LEASE_TTL, now])
+        self.conn.commit()
+        if cursor.rowcount == 0:
+            return None
+        row = self.conn.execute("SELECT path, label, start, stop, offset, attempts FROM work_units "
+                                "WHERE owner = ? AND state = 'leased'", [self.owner]).fetchone()
+        return WorkUnit(self, *row)
+
+    def renew(self, unit, conn):
+        # extend the lease of a unit; False if it has been taken over
+        cursor = conn.execute("UPDATE work_units SET lease_expiry = ? WHERE path = ? AND start = ? "
+                              "AND owner = ? AND state = 'leased'",
+                              [time.time() + LEASE_TTL, unit.path, unit.start, self.owner])
         conn.commit()
-    else:
-        refresh_token = result[1]
-        credentials = OAuth2Credentials(None, CLIENT_ID,
-                                   CLIENT_SECRET, refresh_token, None,
-                                   GOOGLE_TOKEN_URI, None,
-                                   revoke_uri=GOOGLE_REVOKE_URI,
-                                   id_token=None,
-                                   token_response=None)
+        return cursor.rowcount > 0
+
+    def release(self, unit):
+        # give a unit back unfinished
+        self.conn.execute("UPDATE work_units SET state = 'pending', owner = NULL WHERE path = ? AND start = ? "
+                          "AND owner = ?", [unit.path, unit.start, self.owner])
+        self.conn.commit()
+
+    def complete(self, unit):
+        # mark a unit done.  Once every unit of its folder is done the folder
+        # gets its folder_state row, with the offset of the first message
+        # that failed, so later runs resume the folder as usual.
+        cursor = self.conn.execute("UPDATE work_units SET state = 'done', owner = NULL WHERE path = ? AND start = ? "
+                                   "AND owner = ? AND state = 'leased'", [unit.path, unit.start, self.owner])
+        if cursor.rowcount > 0 and unit.path:
+            rows = self.conn.execute("SELECT state, offset, stop FROM work_units WHERE path = ? ORDER BY start",
+                                     [unit.path]).fetchall()
+            if all(state == 'done' for state, offset, stop in rows):
+                offset = min([offset for state, offset, stop in rows if offset < stop] or [rows[-1][2]])
+                if os.path.exists(unit.path):
+                    mbox = openFolder(unit.path)
+                    folder = FolderCheckpoint(unit.path, mailroot, mbox)
+                    folder.advance(offset)
+                    self.conn.execute(folder.SQL, folder.row())
+                    mbox.close()
+        self.conn.commit()
+        return cursor.rowcount > 0
 
-    return credentials
-    
 """
- * migrateMBOX
+ * planWorkUnits
  *
- * Migrate MBOX.  Create label for MBOX folder, if necessary.  Migrate all
- * messages and set label.
+ * Split the folders left to migrate into work units of about WORK_UNIT_SIZE
+ * bytes.  Units start at message boundaries, so every message belongs to
+ * exactly one unit.
+ *
+ * Args:
+ *     folders: list of (path, label, start offset) tuples
+ *
+ * Returns:
+ *     list of (path, label, start, stop) tuples
+"""
+def planWorkUnits(folders):
+    units = []
+    for path, label, start in folders:
+        mbox = openFolder(path, start)
+        unit_start = None
+        for offset in mbox.starts():
+            if unit_start is None:
+                unit_start = offset
+            elif offset - unit_start >= WORK_UNIT_SIZE:
+                units.append((path, label, unit_start, offset))
+                unit_start = offset
+        if unit_start is not None:
+            units.append((path, label, unit_start, mbox.size))
+        mbox.close()
+    return units
+
+"""
+ * migrateWorkQueue
+ *
+ * Migrate work units claimed from the shared work queue until every unit is
+ * done.  While the only units left are leased by other workers, wait in case
+ * one of their leases expires.  A unit taken over from another worker is
+ * resumed with a fresh MessageIndex, so the messages the other worker
+ * committed are not imported twice.
  *
  * Args:
  *     service: Authorized Gmail API service instance.
- *     file: path to MBOX file
- *     label: label id to assign to MBOX messages
- *     conn: database connection handle
+ *     queue: WorkQueue
+ *     ledger: database Ledger
+ *     current_labels: label name to label id dictionary
+ *     pool: optional UploadPool
  *
+ * Returns:
+ *     total number of messages, number of failed messages
 """
-def migrateMBOX(service, file, label, conn):
+def migrateWorkQueue(service, queue, ledger, current_labels, pool=None):
     global message_info
 
-    # open mbox file for reading
-    mbox = mailbox.mbox(file)
-
-    # get total number of messages in mbox file
-    total_messages = len(mbox)
-    
-    # initialize number of failed messages
+    total_messages = 0
     total_failed = 0
-    
-   # iterate over all messages in mbox file
-    msg_number = 0
-    for message in mbox:
-        msg_number += 1
-        print(BS32+"Migrating message: {0} of {1}".format(str(msg_number).zfill(4),str(total_messages).zfill(4))),
-        
-        # initialize labels
-        # one label will always be 'CATEGORY_PERSONAL'
-        # one label will be based on the label provided
-        # one label will be 'UNREAD' if the message being uploaded has yet to be read
-        labels = ['CATEGORY_PERSONAL',label]
-    
-        # get x-mozilla-status value, if it exists
-        x_mozilla_status = message.__getitem__('x-mozilla-status')
-        
-        if x_mozilla_status is not None:
-            # determine if message is actually deleted
-            if int(x_mozilla_status,16) & 8:
-                # log some feedback
-                logging.info("Message {0} of {1} - Already Deleted - Skipped".format(msg_number,total_messages))
-                
-                # skip message since it is marked as deleted
-                continue
-            
-            # determine if message is unread
-            if int(x_mozilla_status,16) == 0:
-                labels.append("UNREAD")
-        
-        # remove x-mozilla-status and x-mozilla-status2 lines from message header
-        message.__delitem__('x-mozilla-status')
-        message.__delitem__('x-mozilla-status2')
-        
-        # get message-id
-        message_id = message.__getitem__('message-id')
-        
-        # has message already been uploaded
-        if message_id in message_info:
-            # Yes.
-            # Check if current label is listed for this message
-            try:
-                response = service.users().messages().get(userId='me', id=message_info[message_id], format='minimal').execute()
-                msg_labels = response['labelIds']
-                missing_labels = [item for item in labels if item not in msg_labels]
-                if missing_labels:
-                    # Some label(s) are not set for this message.  Add missing label(s).
-                    try:
-                        label_modifications = {'addLabelIds': missing_labels, 'removeLabelIds': []}
-                        response = service.users().messages().modify(userId='me', id=message_info[message_id],
-                                                                     body=label_modifications).execute()
-                        logging.info("Message %s of %s - Added missing labels: %s" % (msg_number,total_messages,', '.join(missing_labels)))
-                        continue
-                    except errors.HttpError, error:
-                        logging.info("Message %s of %s - Error adding missing labels: %s - Error: %s" %
-                                      (msg_number,total_messages,', '.join(missing_labels),error))
-                        continue
-                    
-                # Message has already been uploaded and no labels need to be added. Skip it.
-                logging.info("Message {0} of {1} - Already Uploaded - Skipped".format(msg_number,total_messages))
-                continue
-            except errors.HttpError, e:
-                error = simplejson.loads(e.content)
-                if error['error']['code'] == 404:
-                    # Message already uploaded but has been deleted manually
-                    logging.info("Message %s of %s - Already Uploaded and Manually Deleted - Skipped" % (msg_number,total_messages))
-                continue
-
-         # extract raw message
-        msg = message.as_string()
-        
-        # check message size is not greater than 35MB - 1024B (overhead just in case)
-        if len(msg) > 36699136:
-            # message is to big for Gmail to import
-            logging.info("Message %s of %s - Message is greater than 35MB.  Cannot upload." % (msg_number,total_messages))
+    while True:
+        unit = queue.claim()
+        if unit is None:
+            if queue.drained():
+                break
+            time.sleep(LEASE_HEARTBEAT)
             continue
 
-        # create file object to stream message contents
-        fh = io.BytesIO(msg)
-        
-        # create media upload object
-        media = apiclient.http.MediaIoBaseUpload( fh, mimetype='message/rfc822', chunksize=1024*1024, resumable=True )
-        
-        # import message
-        postBody = { "labelIds": labels }
-        
-        # create import message request object
-        request = service.users().messages().import_(userId='me', body=postBody, media_body=media, internalDateSource=None,
-                                                     neverMarkSpam=True, processForCalendar=None, deleted=None) 
+        unit.startHeartbeat()
+        try:
+            if unit.attempts > 1:
+                message_info = getMigrateMessageInfo(ledger.conn, mailroot, False)
+
+            if not unit.path:
+                # every folder is done; retry the messages that failed
+                number_retried, number_failed, retries_remaining = drainRetryQueue(service, ledger, unit)
+                total_failed += number_failed
+            elif unit.label in current_labels and os.path.exists(unit.path):
+                logging.info("Migrating folder: {0} from byte {1}".format(unit.label, unit.offset))
+                number_messages, number_failed = migrateMBOX(service, unit.path, current_labels[unit.label],
+                                                             ledger, pool, unit.offset, unit)
+                total_messages += number_messages
+                total_failed += number_failed
+            ledger.flush()
+        except KeyboardInterrupt:
+            unit.stopHeartbeat()
+            ledger.flush()
+            queue.release(unit)
+            raise
+        unit.stopHeartbeat()
 
-        # upload message in resumable chunks
-        response = None
-        upload_failed = False
-        while response is None:
+        if not queue.complete(unit):
+            logging.warning("Lease of work unit at byte {0} of {1} lost".format(unit.start, unit.path))
+
+    return total_messages, total_failed
+
+"""
+ * selectMailroot
+ *
+ * Ask which Thunderbird profile and which account folder to migrate.
+ *
+ * Returns:
+ *     path to the selected account folder
+"""
+def selectMailroot():
+    # Set to Thunderbird Profiles directory
+    TBPROFILES = os.path.expanduser('~') + '/Library/Thunderbird/Profiles'
+
+    # Get available profiles
+    profiles = os.listdir(TBPROFILES)
+
+    if len(profiles) > 1:
+        # display profile selection menu
+        print("Please select the number of the profile you wish to migrate:")
+
+        # list available profiles
+        selection = 0
+        while not (selection > 0 and selection <= n):
+            n = 0
+            for profile in profiles:
+                n += 1
+                print("{0} : {1}".format(str(n).rjust(2),profile))
             try:
-                status, response = request.next_chunk()
-                '''
-                if status:
-                    sys.stdout.write('\r')
-                    i = int(status.progress() * 20)
-                    sys.stdout.write("[%-20s] %d%%" % ('='*i, 5*i))
-                    sys.stdout.flush()
-                '''
-            except KeyboardInterrupt:
-                print "\n\nUser ended execution"
-                sys.exit()
+                selection = int(raw_input("Selection: "))
+                if selection > 0 and selection <= n:
+                    selected_profile = profiles[selection-1]
+                else:
+                    print("Invalid selection!  Please try again.")
             except:
-                upload_failed = True
-                total_failed += 1
-                logging.error("Message {0} of {1} - Upload Failed!".format(msg_number,total_messages))
-                break
-            
-        if not upload_failed:
-            conn.execute("INSERT into message_info VALUES (?,?,?)", [mailroot,message_id,response['id']])
-            conn.commit()
-            message_info[message_id]=response['id']
-            logging.info('Message {0} of {1} - "{2}"- Upload Complete'.format(msg_number,total_messages,message['subject']))
+                print("Invalid selection!  Please try again.")
+    else:
+        selected_profile = profiles[0]
+
+    profile_dir = TBPROFILES + '/' + selected_profile
+
+    # Get folders to migrate
+    print("Select which account folder to migrate or local folders, if available:")
+
+    folders = {}
+
+    # does ImapMail exist?
+    if os.path.exists(profile_dir + '/ImapMail'):
+        # Yes:  are their directories in ImapMail folder?
+        imapMailAccountFolders = os.listdir(profile_dir + '/ImapMail')
+        for item in imapMailAccountFolders:
+            if os.path.isdir(profile_dir + '/ImapMail/' + item):
+                folders['IMAP Mail - ' + item] = profile_dir + '/ImapMail/' + item
+    # does Mail exist?
+    if os.path.exists(profile_dir + '/Mail'):
+        # Yes:  are their directories in Mail folder?
+        mailAccountFolders = os.listdir(profile_dir + '/Mail')
+        for item in mailAccountFolders:
+            if os.path.isdir(profile_dir + '/Mail/' + item):
+                folders['Mail - ' + item] = profile_dir + '/Mail/' + item
+        # if os.path.exists(profile_dir + '\Mail\Local Folders'):
+        #     folders['Local Folders'] = profile_dir + '\Mail\Local Folders'
+
+    # list account folders
+    selection = 0
+    while not (selection > 0 and selection <= n):
+        n = 0
+        folder_by_selection = []
+        for label in folders:
+            n += 1
+            print("{0} : {1}".format(str(n).rjust(2),label))
+            folder_by_selection.append(folders[label])
+        try:
+            selection = int(raw_input("Selection: "))
+            if selection > 0 and selection <= n:
+                selected_folder = folder_by_selection[selection-1]
+            else:
+                print("Invalid selection!  Please try again.")
+        except:
+            print("Invalid selection!  Please try again.")
+
+    return selected_folder
 
-        # close BaseIO object
-        fh.close()
-        
-    print("\r                                  "),
-    
-    return total_messages, total_failed
-      
 """
  * CustomHandler class
  *
@@ -472,190 +4660,395 @@ class CustomHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def log_message(self, format, *args):
         return
         
-# parse command line arguments
-reauth, redoall = parseCommandLine()
+"""
+ * openLog
+ *
+ * Send log records to a log file, in place of any log file used before.
+ *
+ * Args:
+ *     path: path to log file
+ *
+"""
+def openLog(path):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
 
-# open mbox-uploader-osx-tb database
-try:
-    conn = sqlite3.connect('mbox-uploader-osx-tb.db')
-except sqlite3.Error:
-    print "Error opening db.\n"
-
-# get authorized credentials
-credentials = getAuthCredentials(conn,reauth)
-
-# Create an httplib2.Http object to handle our HTTP requests and authorize it
-# with the credentials.
-http = httplib2.Http()
-http = credentials.authorize(http)
-
-# get Gmail API service object
-service = build('gmail', 'v1', http=http)
-
-# get list of current labels
-current_labels = getUserLabels(service, 'me')
-current_labels["DRAFTS"] = "DRAFTS"
-current_labels["Drafts"] = "DRAFTS"
-current_labels["INBOX"] = "INBOX"
-current_labels["Inbox"] = "INBOX"
-current_labels["Incoming"] = "INBOX"
-current_labels["SENT"] = "SENT"
-current_labels["Sent"] = "SENT"
-
-# Set to Thunderbird Profiles directory
-TBPROFILES = os.path.expanduser('~') + '/Library/Thunderbird/Profiles'
-
-# Get available profiles
-profiles = os.listdir(TBPROFILES)
-
-if len(profiles) > 1:
-    # display profile selection menu
-    print("Please select the number of the profile you wish to migrate:")
-    
-    # list available profiles
-    selection = 0
-    while not (selection > 0 and selection <= n):
-        n = 0
-        for profile in profiles:
-            n += 1
-            print("{0} : {1}".format(str(n).rjust(2),profile))
+"""
+ * selectFolders
+ *
+ * Args:
+ *     mboxFiles: (path to MBOX file, label name) tuples
+ *     globs: label patterns to migrate, or None to migrate all folders
+ *
+ * Returns:
+ *     generator of the (path to MBOX file, label name) tuples whose label
+ *     matches one of the patterns
+"""
+def selectFolders(mboxFiles, globs):
+    for mboxPath, label in mboxFiles:
+        if globs is None or any(fnmatch.fnmatchcase(label, glob) for glob in globs):
+            yield mboxPath, label
+
+"""
+ * migrateAccount
+ *
+ * Migrate one mailbox: the one given by --mailroot or --manifest, or else
+ * the one selected from the menus.
+ *
+ * Args:
+ *     options: options dictionary
+ *
+ * Returns:
+ *     total number of messages, total number of failed messages, number of
+ *     messages left in the retry queue
+"""
+def migrateAccount(options):
+    global message_info, mailroot, upload_chunk_size, DATABASE, metrics, quota, claims
+
+    # every account has its own database, log, metrics, request quota and
+    # upload claims.  Workers sharing a work queue share its database.
+    DATABASE = options['database'] if options['work_queue'] is None else options['work_queue']
+    openLog(options['log_file'])
+    metrics = Metrics(options['metrics_file'])
+    quota = QuotaScheduler(QUOTA_RATE)
+    claims = UploadClaims()
+
+    reauth = options['reauth']
+    redoall = options['redoall']
+    upload_chunk_size = options['chunk_size']
+
+    # open mbox-uploader-osx-tb database
+    try:
+        conn = openDatabase(DATABASE, options['work_queue'] is not None)
+    except sqlite3.Error:
+        print "Error opening db.\n"
+
+    # batch message_info writes
+    ledger = Ledger(conn)
+
+    # work units shared with the workers on other hosts
+    queue = None
+    if options['work_queue'] is not None and options['command'] is None and options['plan'] is None:
+        queue = WorkQueue(conn, DATABASE)
+
+    spool = None
+    if options['command'] == 'upload':
+        # upload the mailbox staged in the spool
+        spool = Spool(options['spool'])
+        manifest = None
+        mailroot = spool.mailroot
+    elif options['manifest'] is not None:
+        # migrate the mailbox the manifest was made for
+        manifest = loadManifest(options['manifest'])
+        mailroot = manifest['mailroot']
+    elif options['mailroot'] is not None:
+        manifest = None
+        mailroot = options['mailroot'].rstrip('/')
+    elif options['batch']:
+        sys.exit("No mailbox to migrate.  Use --mailroot or --manifest with --batch.")
+    else:
+        manifest = None
+        mailroot = selectMailroot()
+
+    # initial total messages and total failed messages counts
+    total_messages = 0
+    total_failed = 0
+
+    # Set to the root mail folder location
+    # For example, the local mail folder would be at:
+    #     APPDATA + '\Thunderbird\Profiles\iyvgb8d5.default\Mail\Local Folders'
+    #mailroot = APPDATA + '\Thunderbird\Profiles\iyvgb8d5.default\ImapMail\imap.googlemail.com'
+
+    if options['command'] == 'stage':
+        # only parse the mailbox into the spool
+        total_messages, total_staged = stageMailbox(mailroot, options['spool'], options['folders'], options['compress'])
+        conn.close()
+        metrics.report()
+        print("\r                                  ")
+        print("Staging Complete.\n")
+        print("Total # of Messages Processed: {0}".format(total_messages))
+        print("Messages staged in {0}: {1}\n".format(options['spool'], total_staged))
+        return total_messages, 0, 0
+
+    # get message information for this mailbox's already migrated messages
+    message_info = getMigrateMessageInfo(conn,mailroot,redoall and options['plan'] is None)
+
+    if options['plan'] is not None:
+        # only work out what would be migrated
+        plan = planMigration(mailroot, ledger, options['plan'], options['folders'])
+        printPlan(plan)
+        conn.close()
+        return 0, 0, 0
+
+    # get authorized credentials
+    credentials = getAuthCredentials(conn,reauth,options['token_file'],options['batch'])
+
+    # get Gmail API service object
+    service = buildService(credentials)
+
+    # bring the label cache up to date, or start tracking label changes
+    if options['verify_remote'] or getConfig(conn, 'history_id') is None:
         try:
-            selection = int(raw_input("Selection: "))
-            if selection > 0 and selection <= n:
-                selected_profile = profiles[selection-1]
-            else:
-                print("Invalid selection!  Please try again.")
-        except:
-            print("Invalid selection!  Please try again.")
-else:
-    selected_profile = profiles[0]
-
-profile_dir = TBPROFILES + '/' + selected_profile
-
-# Get folders to migrate
-print("Select which account folder to migrate or local folders, if available:")
-
-folders = {}
-
-# does ImapMail exist?
-if os.path.exists(profile_dir + '/ImapMail'):
-    # Yes:  are their directories in ImapMail folder?
-    imapMailAccountFolders = os.listdir(profile_dir + '/ImapMail')
-    for item in imapMailAccountFolders:
-        if os.path.isdir(profile_dir + '/ImapMail/' + item):
-            folders['IMAP Mail - ' + item] = profile_dir + '/ImapMail/' + item
-# does Mail exist?
-if os.path.exists(profile_dir + '/Mail'):
-    # Yes:  are their directories in Mail folder?
-    mailAccountFolders = os.listdir(profile_dir + '/Mail')
-    for item in mailAccountFolders:
-        if os.path.isdir(profile_dir + '/Mail/' + item):
-            folders['Mail - ' + item] = profile_dir + '/Mail/' + item
-    # if os.path.exists(profile_dir + '\Mail\Local Folders'):
-    #     folders['Local Folders'] = profile_dir + '\Mail\Local Folders'
-
-# list account folders
-selection = 0
-while not (selection > 0 and selection <= n):
-    n = 0
-    folder_by_selection = []
-    for label in folders:
-        n += 1
-        print("{0} : {1}".format(str(n).rjust(2),label))
-        folder_by_selection.append(folders[label])
+            refreshLabelCache(service, ledger)
+        except errors.HttpError, error:
+            logging.error('Label cache refresh failed: %s' % error)
+            print 'An error occurred: %s' % error
+
+    # get label ids, from the label cache while it is up to date
+    labels = LabelManager(service, conn)
+    try:
+        labels.load(options['verify_remote'])
+    except errors.HttpError, error:
+        logging.error('Label list failed: %s' % error)
+        print 'An error occurred: %s' % error
+
+    # start upload workers when uploading messages in parallel
+    if options['workers'] > 1 and (options['parallel_folders'] <= 1 or spool is not None or queue is not None):
+        pool = UploadPool(credentials, options['workers'], options['memory_budget'])
+    else:
+        pool = None
+
+    print("\nBeginning migration...\n")
+
+    # find MBOX files to migrate, from the manifest when one is given.  A
+    # work queue that other workers are still draining is joined instead.
+    joined = queue is not None and not queue.drained()
+    if spool is not None or joined:
+        mboxFiles = []
+    elif manifest is not None:
+        mboxFiles = [(folder['path'], folder['label']) for folder in manifest['folders']
+                     if folder['to_upload'] > 0 or folder['label_checks'] > 0]
+    else:
+        mboxFiles = findMboxFiles(mailroot)
+    folders = []
+    for mboxPath, label in selectFolders(mboxFiles, options['folders']):
+        # skip mbox files that are unchanged since they were fully migrated
+        start = getResumeOffset(conn, mboxPath)
+        if start is None:
+            logging.info("Folder unchanged since last migration - Skipped: {0}".format(label))
+            continue
+
+        folders.append((mboxPath, label, start))
+
+    if queue is not None:
+        # split the folders into work units, unless another worker already has
+        if not joined:
+            queue.populate(planWorkUnits(folders))
+        folders = []
+
+    # add the labels that don't exist, and their parents, all at once
+    if spool is not None:
+        names = spool.labels()
+    elif queue is not None:
+        names = queue.labels()
+    else:
+        names = [label for mboxPath, label, start in folders]
+    try:
+        labels.ensure(names)
+    except errors.HttpError, error:
+        logging.error('Label creation failed: %s' % error)
+        print 'An error occurred: %s' % error
+    folders = [folder for folder in folders if folder[1] in labels.ids]
+    current_labels = labels.ids
+
     try:
-        selection = int(raw_input("Selection: "))
-        if selection > 0 and selection <= n:
-            selected_folder = folder_by_selection[selection-1]
+        if spool is not None:
+            # upload the staged messages
+            total_messages, total_failed = uploadSpool(service, spool, ledger, current_labels, pool)
+            spool.close()
+        elif queue is not None:
+            # migrate work units until the shared work queue is drained
+            total_messages, total_failed = migrateWorkQueue(service, queue, ledger, current_labels, pool)
+        elif options['parallel_folders'] > 1:
+            # migrate MBOX files in several processes
+            total_messages, total_failed = migrateFoldersInParallel(credentials, folders, current_labels, ledger, options)
+
+            # pick up messages migrated by the other processes
+            message_info = getMigrateMessageInfo(conn,mailroot,False)
         else:
-            print("Invalid selection!  Please try again.")
-    except:
-        print("Invalid selection!  Please try again.")
+            for mboxPath, label, start in folders:
+                # output some feedback
+                logging.info("Migrating folder: {0}".format(label))
 
-mailroot = selected_folder
+                # migrate MBOX messages
+                number_messages, number_failed = migrateMBOX(service, mboxPath, current_labels[label], ledger, pool, start)
 
-# initial total messages and total failed messages counts
-total_messages = 0
-total_failed = 0
+                total_messages += number_messages
+                total_failed += number_failed
+    except KeyboardInterrupt:
+        print "\n\nUser ended execution"
+        metrics.report()
+        sys.exit()
+    finally:
+        # save the uploads made so far, however the migration ended
+        recordFinishedUploads(pool, ledger)
+        ledger.flush()
 
-# Set to the root mail folder location
-# For example, the local mail folder would be at:
-#     APPDATA + '\Thunderbird\Profiles\iyvgb8d5.default\Mail\Local Folders'
-#mailroot = APPDATA + '\Thunderbird\Profiles\iyvgb8d5.default\ImapMail\imap.googlemail.com'
+    # retry messages that failed with transient errors; the work queue has
+    # already done so as its last unit
+    try:
+        if queue is not None:
+            ledger.flush()
+            retries_remaining = conn.execute("SELECT COUNT(*) FROM retry_queue WHERE mailbox = ?",
+                                             [mailroot]).fetchone()[0]
+        else:
+            number_retried, number_failed, retries_remaining = drainRetryQueue(service, ledger)
+            total_failed += number_failed
+    except KeyboardInterrupt:
+        print "\n\nUser ended execution"
+        metrics.report()
+        sys.exit()
+    finally:
+        # save the uploads made so far, however the migration ended
+        recordFinishedUploads(pool, ledger)
+        ledger.flush()
 
-print("\nBeginning migration...\n")
+    # stop upload workers
+    if pool is not None:
+        pool.close()
 
-# get message information for this mailbox's already migrated messages
-message_info = getMigrateMessageInfo(conn,mailroot,redoall)
+    # save any pending message_info rows and close database connection
+    ledger.flush()
+    conn.close()
+    metrics.report()
 
-# walk mail folder structure and determine mail folder hierarchy and MBOX files to migrate
-for dirName, subdirList, fileList in os.walk(mailroot):
-    # Option 1 : Attempt to migrate Trash folder
-    '''
-    if os.path.basename(dirName) == '[Gmail].sbd':
-        if 'Trash' in fileList:
-            label = 'Trash'
-            
-            # output some feedback
-            logging.info("Migrating folder: {0}".format(label))
-            print("\rFolder: {0} ".format((label.ljust(55,' ')[:53] + '..') if len(label.ljust(55,' ')) > 55 else label.ljust(55,' ')))
-            print(" *                                "),
-            
-            # migrate MBOX messages
-            migrateMBOX(service, dirName + '\\Trash', current_labels[label], conn)
-        continue
-    '''
-    for mboxFile in fileList:
-        if mboxFile in ["msgFilterRules.dat","filterlog.html"] or re.match("popstate.*\.dat",mboxFile):
-            # not an MBOX file
-            continue
-        
-        if mboxFile in ["DRAFTS","Drafts"]:
-            # cannot import with Gmail API so skip
-            continue
-        
-        fileName, fileExtension = os.path.splitext(mboxFile)
-        if fileExtension == ".msf":
-            # not an MBOX file
-            continue
-        
-        if fileName in ['Unsent Messages','Trash']:
-            # ignore messages that have not sent or in trash
+    print("\r                                  ")
+    print("Migration Complete.\n")
+    print("Total # of Messages Processed: {0}".format(total_messages))
+    if total_failed > 0:
+        print("There were {0} messages that had errors during processing.  See log file for details.\n".format(total_failed))
+    else:
+        print("There were no errors in processing.\n")
+    if retries_remaining > 0:
+        print("{0} messages could not be uploaded right now and will be retried on the next run.\n".format(retries_remaining))
+
+    return total_messages, total_failed, retries_remaining
+
+"""
+ * migrateAccountProcess
+ *
+ * Migrate one account of a config file in its own process.  Output goes to
+ * the account's log file only.  The result is reported to the main process
+ * with an (n, name, messages, failed, retries remaining, error) message.
+ *
+ * Args:
+ *     n: index of the account in the config file
+ *     options: options dictionary of the account
+ *     channel: multiprocessing queue to the main process
+ *
+"""
+def migrateAccountProcess(n, options, channel):
+    # the main process handles Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        result = (n, options['name']) + migrateAccount(options) + (None,)
+    except SystemExit, error:
+        result = (n, options['name'], 0, 0, 0, str(error.code))
+    except Exception:
+        result = (n, options['name'], 0, 0, 0, traceback.format_exc())
+    channel.put(result)
+
+"""
+ * migrateAccounts
+ *
+ * Migrate every account of a config file in batch mode, one after another
+ * or several at the same time in separate processes.
+ *
+ * Args:
+ *     accounts: list of options dictionaries, one per account
+ *     concurrent: number of accounts to migrate at the same time
+ *
+ * Returns:
+ *     True if every account was migrated without errors
+"""
+def migrateAccounts(accounts, concurrent):
+    results = []
+    if concurrent > 1:
+        # a new process for every account, so that no state is shared.  The
+        # processes are not pool workers, so they can start folder processes
+        # of their own.
+        channel = multiprocessing.Queue()
+        waiting = list(enumerate(accounts))
+        running = {}
+        try:
+            while waiting or running:
+                while waiting and len(running) < concurrent:
+                    n, options = waiting.pop(0)
+                    running[n] = multiprocessing.Process(target=migrateAccountProcess, args=(n, options, channel))
+                    running[n].start()
+                    print("Started account: {0}".format(options['name']))
+                try:
+                    result = channel.get(timeout=1)
+                except Queue.Empty:
+                    for n, process in running.items():
+                        if not process.is_alive() and process.exitcode != 0:
+                            # died without reporting back
+                            del running[n]
+                            results.append((n, accounts[n]['name'], 0, 0, 0,
+                                            "process exited with code {0}".format(process.exitcode)))
+                    continue
+                running.pop(result[0]).join()
+                results.append(result)
+                print("Finished account: {0}".format(result[1]))
+        except KeyboardInterrupt:
+            for process in running.values():
+                process.terminate()
+            raise
+        results = [result[1:] for result in sorted(results)]
+    else:
+        for options in accounts:
+            print("\nAccount: {0}".format(options['name']))
+            try:
+                results.append((options['name'],) + migrateAccount(options) + (None,))
+            except SystemExit, error:
+                if error.code is None:
+                    # the user ended execution
+                    raise
+                # one account's fatal error does not stop the others
+                results.append((options['name'], 0, 0, 0, str(error.code)))
+
+    print("\nBatch Complete.\n")
+    succeeded = True
+    for name, total_messages, total_failed, retries_remaining, error in results:
+        if error is not None:
+            succeeded = False
+            print("{0}: failed: {1}".format(name, error.strip()))
             continue
-            
-        # build label name
-        if dirName == mailroot:
-            label = mboxFile
-        else:
-            label = dirName.replace(mailroot + '/','').replace('.sbd','') + '/' + mboxFile
-        
-        # add label if it doesn't exist
-        checkAddLabel(service, label, current_labels)
-        
-        # output some feedback
-        logging.info("Migrating folder: {0}".format(label))
-        print("\rFolder: {0} ".format((label.ljust(55,' ')[:53] + '..') if len(label.ljust(55,' ')) > 55 else label.ljust(55,' ')))
-        print(" *                                "),
-        
-        # migrate MBOX messages
-        number_messages, number_failed = migrateMBOX(service, dirName + '/' + mboxFile, current_labels[label], conn)
-        
-        total_messages += number_messages
-        total_failed += number_failed
-        
-    # Option 2 : Skip all Gmail custom folders
-    if '[Gmail].sbd' in subdirList:
-        del subdirList[subdirList.index("[Gmail].sbd")]
-    
-# close database connection
-conn.close()
-
-print("\r                                  ")
-print("Migration Complete.\n")
-print("Total # of Messages Processed: {0}".format(total_messages))
-if total_failed > 0:
-    print("There were {0} messages that had errors during processing.  See log file for details.\n".format(total_failed))
-else:
-    print("There were no errors in processing.\n")
-
-raw_input("Press Enter to close application...")
+        succeeded = succeeded and total_failed == 0
+        print("{0}: {1} messages processed, {2} errors, {3} queued for retry".format(
+            name, total_messages, total_failed, retries_remaining))
+    return succeeded
+
+"""
+ * main
+ *
+ * Select a mailbox and migrate it, or migrate every account of a config
+ * file.
+ *
+"""
+def main():
+    sys.stdout = Unbuffered(sys.stdout)
+
+    # parse command line arguments
+    options = parseCommandLine()
+
+    if options['config'] is not None:
+        accounts, concurrent = loadConfig(options['config'], options)
+        if not migrateAccounts(accounts, concurrent):
+            sys.exit(1)
+        return
+
+    migrateAccount(options)
+
+    if not options['batch']:
+        raw_input("Press Enter to close application...")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import imp
+import os
+import shutil
+import tempfile
+import unittest
+
+uploader = imp.load_source('mbox_uploader', os.path.join(os.path.dirname(__file__), '..', 'mbox-uploader-osx-tb.py'))
+
+
+def message(n):
+    return 'From - Mon Jan  1 00:00:00 2015\nMessage-ID: <m{0}@x>\n\nbody {0}\n\n'.format(n)
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'Inbox')
+        self.writeMbox(range(5))
+        self.conn = uploader.openDatabase(os.path.join(self.dir, 'mbox-uploader-osx-tb.db'))
+        self.ledger = uploader.Ledger(self.conn)
+        uploader.mailroot = self.dir
+        uploader.message_info = uploader.getMigrateMessageInfo(self.conn, self.dir, False)
+        uploader.metrics = uploader.Metrics()
+        uploader.reporter = uploader.ProgressReporter()
+        self.uploaded = []
+        self.interrupt = None
+        self.uploadWithRetry = uploader.uploadWithRetry
+        uploader.uploadWithRetry = self.upload
+
+    def tearDown(self):
+        uploader.uploadWithRetry = self.uploadWithRetry
+        self.conn.close()
+        shutil.rmtree(self.dir)
+
+    def writeMbox(self, numbers, mode='w'):
+        fh = open(self.path, mode)
+        fh.write(''.join(message(n) for n in numbers))
+        fh.close()
+
+    def upload(self, service, fh, labels):
+        # stand-in for the Gmail import, interrupted at the chosen message
+        data = fh.read(fh.length)
+        if len(self.uploaded) == self.interrupt:
+            raise KeyboardInterrupt
+        self.uploaded.append(data)
+        return 'g{0}'.format(len(self.uploaded))
+
+    def migrate(self, pool=None):
+        # each run starts with no uploads claimed, as migrateAccount does
+        uploader.claims = uploader.UploadClaims()
+        start = uploader.getResumeOffset(self.conn, self.path)
+        if start is None:
+            return start
+        try:
+            uploader.migrateMBOX(None, self.path, 'Label_1', self.ledger, pool, start)
+        finally:
+            # as the interrupt handler of migrateAccount does
+            uploader.recordFinishedUploads(pool, self.ledger)
+            self.ledger.flush()
+        return start
+
+    def testInterruptedUpload(self):
+        self.interrupt = 2
+        self.assertRaises(KeyboardInterrupt, self.migrate)
+        self.assertEqual(len(self.uploaded), 2)
+        # the interrupted message is where the next run starts
+        self.assertEqual(uploader.getResumeOffset(self.conn, self.path), 2 * len(message(0)))
+
+        self.interrupt = None
+        self.migrate()
+        self.assertEqual(len(self.uploaded), 5)
+        self.assertEqual(uploader.getResumeOffset(self.conn, self.path), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
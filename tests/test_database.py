@@ -0,0 +1,71 @@
+import imp
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+uploader = imp.load_source('mbox_uploader', os.path.join(os.path.dirname(__file__), '..', 'mbox-uploader-osx-tb.py'))
+
+
+class SchemaUpgradeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'mbox-uploader-osx-tb.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def createBaseline(self):
+        # database as written by the original version, including messages
+        # recorded without a Message-ID
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE message_info (mailbox text, message_id text, google_id text, "
+                     "UNIQUE (mailbox, message_id))")
+        conn.execute("CREATE TABLE IF NOT EXISTS config (name text unique, value text)")
+        conn.execute("INSERT OR REPLACE INTO config (name, value) VALUES ('refresh_token','token')")
+        conn.execute("INSERT into message_info VALUES (?,?,?)", ['/mail', '<a@b>', 'g1'])
+        conn.execute("INSERT into message_info VALUES (?,?,?)", ['/mail', None, 'g2'])
+        conn.execute("INSERT into message_info VALUES (?,?,?)", ['/mail', None, 'g3'])
+        conn.commit()
+        conn.close()
+
+    def testUpgradeBaseline(self):
+        self.createBaseline()
+        conn = uploader.openDatabase(self.path)
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], len(uploader.SCHEMA))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM message_info").fetchone()[0], 3)
+        self.assertEqual(uploader.getConfig(conn, 'refresh_token'), 'token')
+
+        index = uploader.getMigrateMessageInfo(conn, '/mail', False)
+        ledger = uploader.Ledger(conn)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.get(ledger, '<a@b>'), 'g1')
+        self.assertEqual(index.get(ledger, '<c@d>'), None)
+        conn.close()
+
+        # reopening finds nothing left to upgrade
+        conn = uploader.openDatabase(self.path)
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], len(uploader.SCHEMA))
+        conn.close()
+
+    def testFailedUpgradeRollsBack(self):
+        self.createBaseline()
+        schema = uploader.SCHEMA
+        uploader.SCHEMA = schema[:1] + [["CREATE TABLE broken (name text)", "INSERT INTO missing VALUES (1)"]]
+        try:
+            self.assertRaises(sqlite3.OperationalError, uploader.openDatabase, self.path)
+        finally:
+            uploader.SCHEMA = schema
+
+        conn = sqlite3.connect(self.path)
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], 1)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'broken'").fetchone()[0], 0)
+        conn.close()
+
+        # the real upgrade still applies afterwards
+        uploader.openDatabase(self.path).close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import imp
+import os
+import unittest
+
+uploader = imp.load_source('mbox_uploader', os.path.join(os.path.dirname(__file__), '..', 'mbox-uploader-osx-tb.py'))
+
+HEADERS = ('From: a@example.com\r\n'
+           'Message-ID:\r\n'
+           ' <c@d>\r\n'
+           'Subject: Long\r\n'
+           '\tsubject \r\n'
+           'X-Mozilla-Status: 0001\n')
+
+
+class GetHeaderTest(unittest.TestCase):
+    def testPlain(self):
+        self.assertEqual(uploader.getHeader(HEADERS, 'from'), 'a@example.com')
+        self.assertEqual(uploader.getHeader(HEADERS, 'X-Mozilla-Status'), '0001')
+
+    def testFolded(self):
+        self.assertEqual(uploader.getHeader(HEADERS, 'Message-ID'), '<c@d>')
+        self.assertEqual(uploader.getHeader(HEADERS, 'subject'), 'Long subject')
+
+    def testMissing(self):
+        self.assertEqual(uploader.getHeader(HEADERS, 'references'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import imp
+import os
+import shutil
+import tempfile
+import unittest
+
+uploader = imp.load_source('mbox_uploader', os.path.join(os.path.dirname(__file__), '..', 'mbox-uploader-osx-tb.py'))
+
+MSGS = 'ns:msg:db:row:scope:msgs:all'
+
+# summary of a folder in the layout Thunderbird writes: column and atom
+# dictionaries, the folder info table, the message table and later updates
+SUMMARY = r'''// <!-- <mdb:mork:z v="1.4"/> -->
+< <(a=c)> // (f=iso-8859-1)
+  (80=ns:msg:db:row:scope:dbfolderinfo:all)(81=subject)(82=message-id)
+  (86=flags)(87=storeToken)(88=msgOffset)(89=ns:msg:db:row:scope:msgs:all)
+  (8A=ns:msg:db:table:kind:msgs)(8B=numMsgs)>
+
+<(90=Hello)(91=a@example.com)(92=b@example.com)(93=md5:0123456789abcdef)>
+
+{1:^80 {(k^8A:c)(s=9)}
+  [1:^80(^8B=4)]}
+{1:^89 {(k^8A:c)(s=9)}
+  [1(^81^90)(^82^91)(^86=1)(^87=0)]
+  [2(^81=Long \
+subject$2C split)(^82^92)(^86=90)(^88=2A)]
+  [3(^82^93)(^86=0)(^87=80)]
+  [4(^82=c@example.com)(^86=1)]}
+
+@$${2{@
+[1:^89(^86=8)]
+[2(^86=91)]
+@$$}2}@
+'''
+
+
+class MorkTest(unittest.TestCase):
+    def setUp(self):
+        self.rows = uploader.parseMork(SUMMARY)
+
+    def testColumnsAndAtoms(self):
+        row = self.rows[(MSGS, '1')]
+        self.assertEqual(row['subject'], 'Hello')
+        self.assertEqual(row['message-id'], 'a@example.com')
+        self.assertEqual(row['storeToken'], '0')
+
+    def testTableScopes(self):
+        self.assertEqual(self.rows[('ns:msg:db:row:scope:dbfolderinfo:all', '1')], {'numMsgs': '4'})
+        self.assertEqual(sorted(row_id for scope, row_id in self.rows if scope == MSGS), ['1', '2', '3', '4'])
+
+    def testEscapes(self):
+        self.assertEqual(self.rows[(MSGS, '2')]['subject'], 'Long subject, split')
+
+    def testUpdates(self):
+        # updates with and without a scope are merged into the message rows
+        self.assertEqual(self.rows[(MSGS, '1')]['flags'], '8')
+        self.assertEqual(self.rows[(MSGS, '2')]['flags'], '91')
+        self.assertEqual(self.rows[(MSGS, '2')]['msgOffset'], '2A')
+        self.assertFalse(None in [scope for scope, row_id in self.rows])
+
+    def testCut(self):
+        rows = uploader.parseMork(SUMMARY + '[-3:^89(^86=1)]\n')
+        self.assertEqual(rows[(MSGS, '3')], {'flags': '1'})
+
+
+class ReadSummaryTest(unittest.TestCase):
+    def setUp(self):
+        uploader.metrics = uploader.Metrics()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'Inbox')
+        open(self.path, 'w').close()
+        fh = open(self.path + '.msf', 'w')
+        fh.write(SUMMARY)
+        fh.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testOffsets(self):
+        summary = uploader.readSummary(self.path, os.path.getmtime(self.path))
+        self.assertEqual(summary, {0: (8, '<a@example.com>'),
+                                   42: (0x91, '<b@example.com>'),
+                                   80: (0, None)})
+
+    def testStale(self):
+        summary = uploader.readSummary(self.path, os.path.getmtime(self.path + '.msf') + 1)
+        self.assertEqual(summary, {})
+
+
+class UnreadTest(unittest.TestCase):
+    def testReadFlag(self):
+        self.assertTrue(uploader.isUnread(0))
+        # Offline, Marked and HasRe
+        self.assertTrue(uploader.isUnread(0x80 | 0x4 | 0x10))
+        self.assertFalse(uploader.isUnread(0x1))
+        self.assertFalse(uploader.isUnread(0x91))
+
+
+if __name__ == '__main__':
+    unittest.main()